@@ -3,8 +3,7 @@ import mariadb
 import threading
 from classes.database_connection import DatabaseConnection
 from database_management.execute_query import execute_query_modify, execute_query_ask
-from ai_management.ai_wrapper import generate_answer, AnswerRequest
-from ai_management.ai_wrapper import humanize_response, HumanizeRequest
+from ai_management.ai_wrapper import generate_humanized_answer, AnswerRequest
 
 def process_ai_response(question_payload: str,  db_pool_manager : DatabaseConnection) -> None:
     """
@@ -19,14 +18,11 @@ def process_ai_response(question_payload: str,  db_pool_manager : DatabaseConnec
         try:
 
             data = AnswerRequest(argomento=question_payload, livello=i+1)
-            # Invia la richiesta ed estrare la risposta
+            # Invia la richiesta (generazione + umanizzazione in un'unica chiamata) ed estrae la risposta
             # CONTROLLARE PERCHÈ ORA I LIVELLI SONO DA 1 A 5 MA IL LOOP ARRIVA SOLO A 3
-            ai_response = generate_answer(data)
-            actual_answer = ai_response.risposta
-            print(actual_answer)
+            ai_response = generate_humanized_answer(data, level=3)
+            print(ai_response.risposta)
 
-            data = HumanizeRequest(llm_response=actual_answer, level=3)    
-            ai_response = humanize_response(data)
             humanized_answer = ai_response.humanized_response
             print(humanized_answer)
 
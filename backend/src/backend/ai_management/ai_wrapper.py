@@ -1,11 +1,17 @@
 import requests
 from os import getenv
-from classes.models import AnswerRequest, AnswerResponse, HumanizeRequest, HumanizeResponse, EvaluateRequest, EvaluateResponse
+from classes.models import AnswerRequest, AnswerResponse, HumanizeRequest, HumanizeResponse, EvaluateRequest, EvaluateResponse, AnswerPipelineResponse
 
 
 AI_CYAN_URL = getenv("AI_CYAN_URL", "http://all_in_one:8071/cyan")
 AI_MAGENTA_URL = getenv("AI_MAGENTA_URL", "http://all_in_one:8071/magenta")
 AI_GREEN_QT_URL = getenv("AI_GREEN_QT_URL", "http://all_in_one:8071/green_coherence_QT")
+AI_PIPELINE_URL = getenv("AI_PIPELINE_URL", "http://all_in_one:8071/pipeline")
+
+# Classe di priorità nella coda del server IA: i controlli con l'utente in attesa passano
+# davanti alle risposte generate in background
+INTERACTIVE = {"X-Priority": "interactive"}
+BACKGROUND = {"X-Priority": "background"}
 
 
 def generate_answer(data: AnswerRequest) -> AnswerResponse:
@@ -34,10 +40,32 @@ def humanize_response(data: HumanizeRequest) -> HumanizeResponse:
         return HumanizeResponse(humanized_response=f"Errore IA: {e}", raw="")
 
 
+def generate_humanized_answer(data: AnswerRequest, level: int) -> AnswerPipelineResponse:
+    # Generazione (cyan) e umanizzazione (magenta) in un'unica chiamata al server IA
+    payload = {
+        "inputs": {"argomento": data.argomento, "livello": data.livello},
+        "steps": [
+            {"task": "cyan"},
+            # La risposta viene salvata troncata a 511 caratteri: inutile generarne di più
+            {"task": "magenta", "map": {"risposta": "llm_response"}, "inputs": {"level": level},
+             "generation": {"max_chars": 511}},
+        ],
+    }
+    try:
+        r = requests.post(AI_PIPELINE_URL, json=payload, headers=BACKGROUND)
+        r.raise_for_status()
+        steps = r.json().get("steps", [])
+        risposta = steps[0].get("risposta", "") if steps else ""
+        humanized = steps[-1].get("humanized_response", "") if steps else ""
+        return AnswerPipelineResponse(risposta=risposta, humanized_response=humanized)
+    except Exception as e:
+        return AnswerPipelineResponse(risposta=f"Errore IA: {e}", humanized_response=f"Errore IA: {e}")
+
+
 def check_theme_coherence(data: EvaluateRequest) -> EvaluateResponse:
     payload = {"question": data.question, "theme": data.theme}
     try:
-        r = requests.post(AI_GREEN_QT_URL, json=payload)
+        r = requests.post(AI_GREEN_QT_URL, json=payload, headers=INTERACTIVE)
         r.raise_for_status()
         resp = r.json()
         bool_val = resp.get("bool", "")
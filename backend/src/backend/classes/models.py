@@ -88,6 +88,10 @@ class HumanizeResponse(BaseModel):
     humanized_response: str
     raw: str
 
+class AnswerPipelineResponse(BaseModel):
+    risposta: str
+    humanized_response: str
+
 
 class EvaluateRequest(BaseModel):
     question:str
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark dell'esecuzione compilata (COMPILE_MODE).
+
+Per ogni modalità (eager, KV-cache statica, torch.compile) genera (greedy) le
+risposte agli esempi dei task, in batch di --batch prompt e partendo dalla
+KV-cache del prefisso come il server, poi confronta la velocità di decodifica
+(token/s), il tempo della prima chiamata (che per "compile" include la
+compilazione, o il caricamento dalla cache) e l'uguaglianza degli output con eager.
+Lanciato due volte con la stessa --cache-dir mostra il costo di compilazione
+dopo un riavvio.
+
+Uso: python benchmarks/bench_compile.py --model MODEL_ID [--tasks cyan magenta] [--modes static compile]
+         [--samples N] [--batch B] [--max-new-tokens N] [--cache-dir DIR]
+"""
+import argparse
+import pathlib
+import sys
+import time
+from dataclasses import replace
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+
+def task_batches(configs, tokenizer, names, samples, batch):
+    """(prefisso, batch di prompt) costruiti dagli esempi dei task"""
+    batches = []
+    for name in names:
+        config = configs[name]
+        prompts = []
+        for example in config.examples[:samples] or [{}]:
+            data = {field: str(example.get(field) or field) for field in config.input_fields}
+            prompts.append(config.prompt.render(data) if config.prompt else
+                           server.format_messages(server.create_messages_for_task(config, data), tokenizer))
+        prefix = config.prompt.prefix if config.prompt else server.render_static_prefix(config, tokenizer)
+        batches.extend((name, prefix, prompts[i:i + batch]) for i in range(0, len(prompts), batch))
+    return batches
+
+
+def run(engine, configs, batches, max_new_tokens):
+    """Output, token generati e secondi di decodifica di tutti i batch"""
+    outputs, new_tokens, decode_seconds = [], 0, 0.0
+    for name, prefix, prompts in batches:
+        params = replace(configs[name].generation_params(), max_new_tokens=max_new_tokens, do_sample=False)
+        timing = server.GenerationTiming()
+        outputs.extend(engine.generate_batch(prompts, params, prefix=prefix, timing=timing))
+        # Il primo token di ogni sequenza viene dal prefill
+        new_tokens += sum(max(0, count - 1) for count in timing.new_tokens)
+        decode_seconds += timing.decode_seconds
+    return outputs, new_tokens, decode_seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark esecuzione eager / statica / compilata")
+    parser.add_argument("--model", default=server.MODEL_ID)
+    parser.add_argument("--tasks", nargs="+", default=["cyan", "magenta"])
+    parser.add_argument("--modes", nargs="+", default=["static", "compile"], choices=["static", "compile"])
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--cache-dir", default=server.COMPILE_CACHE_DIR)
+    args = parser.parse_args()
+
+    server.COMPILE_CACHE_DIR = args.cache_dir
+    model, tokenizer, device = server.load_model_and_tokenizer(args.model)
+    if model is None:
+        sys.exit("Il motore stub non esegue il modello: usare un modello reale o random:")
+    server.TASKS_DIR = ROOT / "tasks"
+    configs = server.load_task_configs(tokenizer)
+    batches = task_batches(configs, tokenizer, args.tasks, args.samples, args.batch)
+
+    print(f"\n{'modalità':<10}{'prima chiamata (s)':>20}{'token/s':>10}{'uguali':>9}")
+    baseline, fallback = None, False
+    for mode in ["", *args.modes]:
+        engine = server.GenerationEngine(model, tokenizer, device)
+        if mode:
+            engine.configure_compilation(mode)
+        # Prima chiamata: compilazione (o lettura dalla cache) e allocazione della cache statica
+        start = time.perf_counter()
+        run(engine, configs, batches[:1], args.max_new_tokens)
+        first_call = time.perf_counter() - start
+
+        outputs, new_tokens, decode_seconds = run(engine, configs, batches, args.max_new_tokens)
+        baseline = baseline or outputs
+        label = mode or "eager"
+        if mode and engine.compile_mode != mode:
+            label += " (*)"
+            fallback = True
+        same = sum(a == b for a, b in zip(baseline, outputs))
+        print(f"{label:<10}{first_call:>20.2f}{new_tokens / max(decode_seconds, 1e-9):>10.1f}"
+              f"{f'{same}/{len(outputs)}':>9}")
+    if fallback:
+        print("\n(*) errore della modalità compilata, misurata in eager")
+
+
+if __name__ == "__main__":
+    main()
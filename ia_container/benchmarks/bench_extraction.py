@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark dell'estrazione degli output.
+
+Su un corpus di output grezzi (una riga JSON {"task", "raw"} per output)
+verifica che l'estrattore precompilato del server (TaskExtractor) dia esattamente
+gli stessi risultati dell'estrazione originale, riportata qui sotto come
+riferimento (extract_results), e confronta i tempi. Il corpus di default è
+sintetico: varianti di formato generate da template, non dal modello. Per
+misurare su output reali registrarli con RECORD_RAW_OUTPUTS e passarli con --corpus.
+
+Uso: python benchmarks/bench_extraction.py [--corpus FILE] [--iterations N]
+"""
+import argparse
+import json
+import pathlib
+import re
+import sys
+import timeit
+from collections import defaultdict
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+
+def load_corpus(path):
+    """Output grezzi raggruppati per task"""
+    corpus = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                corpus[record["task"]].append(record["raw"])
+    return corpus
+
+
+# Estrazione originale del server (regex compilate a ogni chiamata), sostituita da TaskExtractor
+
+
+def extract_single_result(raw_output, output_config, task_name):
+    """Estrae un singolo risultato dall'output del modello"""
+    output = raw_output.strip()
+
+    # Se c'è un pattern di estrazione specifico
+    if output_config.extract_pattern:
+        match = re.search(output_config.extract_pattern, output, re.IGNORECASE | re.DOTALL)
+        if match:
+            result = match.group(1) if match.groups() else match.group(0)
+            return server.convert_value(result, output_config.type)
+
+    # Euristiche di fallback basate sul nome del campo
+    output_name = output_config.name.lower()
+
+    # Campi che restituiscono punteggi numerici
+    if "score" in output_name or output_name in ["punteggio", "voto", "rating"]:
+        # Cerca specificamente dopo "Punteggio:" o simili
+        score_patterns = [
+            rf"{output_config.name}:\s*(\d+)",
+            r"Punteggio:\s*(\d+)",
+            r"Score:\s*(\d+)",
+            r"Voto:\s*(\d+)"
+        ]
+        for pattern in score_patterns:
+            match = re.search(pattern, output, re.IGNORECASE)
+            if match:
+                return server.convert_value(match.group(1), output_config.type)
+
+        # Altrimenti prendi l'ultimo numero trovato
+        nums = re.findall(r"\d+", output)
+        if nums:
+            return server.convert_value(nums[-1], output_config.type)
+
+    # Campi che restituiscono booleani
+    elif output_config.type == "bool" or output_name in ["bool", "boolean", "vero_falso"]:
+        bool_match = re.search(r"\b(Vero|Falso|True|False)\b", output, re.IGNORECASE)
+        if bool_match:
+            return server.convert_value(bool_match.group(1), "bool")
+
+    # Campi che restituiscono tag o etichette
+    elif output_name in ["tag", "tags", "label", "etichetta"]:
+        # Cerca dopo "Tags:", "Tag:", etc.
+        tag_patterns = [
+            rf"{output_config.name}:\s*(.+?)(?:\n|$)",
+            r"Tags?:\s*(.+?)(?:\n|$)",
+            r"Etichett[ae]:\s*(.+?)(?:\n|$)"
+        ]
+        for pattern in tag_patterns:
+            match = re.search(pattern, output, re.IGNORECASE)
+            if match:
+                return match.group(1).strip().strip('"\'')
+
+    # Feedback o commenti
+    elif output_name in ["feedback", "commento", "comment", "spiegazione"]:
+        feedback_patterns = [
+            rf"{output_config.name}:\s*(.+?)(?:\n|$)",
+            r"Feedback:\s*(.+?)(?:\n|$)",
+            r"Commento:\s*(.+?)(?:\n|$)"
+        ]
+        for pattern in feedback_patterns:
+            match = re.search(pattern, output, re.IGNORECASE | re.DOTALL)
+            if match:
+                return match.group(1).strip()
+
+    # Default: ritorna None se non trovato
+    return None
+
+
+def extract_results(raw_output, task_config):
+    """Estrae tutti i risultati dall'output del modello"""
+    results = {}
+
+    # Se c'è un solo output (modalità legacy)
+    if len(task_config.outputs) == 1 and task_config.output_field:
+        output_name = task_config.output_field
+        output_config = task_config.outputs[output_name]
+        result = extract_single_result(raw_output, output_config, task_config.name)
+
+        # Se non trovato, prova euristica legacy
+        if result is None:
+            result = extract_result_legacy(raw_output, task_config)
+
+        results[output_name] = result
+    else:
+        # Estrai ogni output definito
+        for output_name, output_config in task_config.outputs.items():
+            result = extract_single_result(raw_output, output_config, task_config.name)
+            if result is not None:
+                results[output_name] = result
+
+    return results
+
+
+def extract_result_legacy(raw_output, task_config):
+    """Estrae il risultato usando le euristiche legacy (per retrocompatibilità)"""
+    output = raw_output.strip()
+    task_name = task_config.name.lower()
+
+    # Task che restituiscono punteggi numerici
+    if task_name in ["red", "green_validity", "green_cultural", "green_coherence_qa"]:
+        score_match = re.search(r"Punteggio:\s*(\d+)", output, re.IGNORECASE)
+        if score_match:
+            return int(score_match.group(1))
+        nums = re.findall(r"\d+", output)
+        if nums:
+            return int(nums[-1])
+
+    # Task che restituiscono booleani
+    elif task_name == "green_coherence_qt":
+        bool_match = re.search(r"\b(Vero|Falso)\b", output, re.IGNORECASE)
+        if bool_match:
+            return bool_match.group(1).capitalize()
+
+    # Task che restituiscono tag
+    elif task_name == "orange":
+        clean_output = output
+        if clean_output.lower().startswith("tags:"):
+            clean_output = clean_output[5:].strip()
+        return clean_output.strip('"\'')
+
+    # Default
+    return output
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark estrazione output")
+    parser.add_argument("--corpus", default=str(ROOT / "benchmarks" / "raw_outputs_synthetic.jsonl"))
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    server.TASKS_DIR = ROOT / "tasks"
+    configs = server.load_task_configs()
+    corpus = load_corpus(args.corpus)
+
+    print(f"\n{'task':<22}{'output':>8}{'originale (µs)':>16}{'compilato (µs)':>16}{'speedup':>10}")
+    for name, raws in sorted(corpus.items()):
+        config = configs.get(name)
+        if config is None:
+            print(f"{name:<22}{'task non trovato':>24}")
+            continue
+
+        for raw in raws:
+            expected = extract_results(raw, config)
+            actual = config.extractor.extract(raw)
+            assert actual == expected, f"{name}: {raw!r} -> {actual} != {expected}"
+
+        def before():
+            for raw in raws:
+                extract_results(raw, config)
+
+        def after():
+            for raw in raws:
+                config.extractor.extract(raw)
+
+        per_output = args.iterations * len(raws)
+        t_before = timeit.timeit(before, number=args.iterations) / per_output * 1e6
+        t_after = timeit.timeit(after, number=args.iterations) / per_output * 1e6
+        print(f"{name:<22}{len(raws):>8}{t_before:>16.2f}{t_after:>16.2f}{t_before / t_after:>9.1f}x")
+
+    print("\n✅ Risultati identici su tutto il corpus")
+
+
+if __name__ == "__main__":
+    main()
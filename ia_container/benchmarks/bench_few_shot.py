@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark della selezione degli esempi few-shot.
+
+Per ogni task con "few_shot" nel config.json confronta il prompt con i primi
+MAX_PROMPT_EXAMPLES esempi e quello con gli esempi scelti entro il budget di
+token: token del prompt e tempo di prefill (un forward pass sul prompt intero,
+senza KV-cache del prefisso), usando come input gli esempi stessi del task.
+
+Uso: python benchmarks/bench_few_shot.py --model MODEL_ID [--tasks cyan green_validity] [--repeat N]
+"""
+import argparse
+import pathlib
+import statistics
+import sys
+import time
+from dataclasses import replace
+
+import torch
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+
+def prefill_seconds(model, tokenizer, device, prompt, repeat):
+    """Tempo mediano di un forward pass sul prompt"""
+    inputs = tokenizer(prompt, return_tensors="pt").to(device)
+    times = []
+    with torch.inference_mode():
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model(**inputs)
+            times.append(time.perf_counter() - start)
+    return statistics.median(times), inputs["input_ids"].shape[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark selezione esempi few-shot")
+    parser.add_argument("--model", default=server.MODEL_ID)
+    parser.add_argument("--tasks", nargs="+")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    model, tokenizer, device = server.load_model_and_tokenizer(args.model)
+    server.TASKS_DIR = ROOT / "tasks"
+    configs = server.load_task_configs(tokenizer)
+    names = args.tasks or [name for name, config in configs.items() if config.few_shot is not None]
+
+    print(f"\n{'task':<18}{'esempi':>10}{'token':>14}{'prefill (ms)':>18}")
+    for name in names:
+        config = configs[name]
+        baseline = replace(config, few_shot=None, selector=None)
+        tokens_before, tokens_after, seconds_before, seconds_after, examples_after = [], [], [], [], []
+
+        for example in config.examples:
+            data = {field: str(example.get(field, "")) for field in config.input_fields}
+            selection = config.selector.select(data)
+            examples_after.append(len(selection))
+
+            prompt = server.format_messages(server.create_messages_for_task(baseline, data), tokenizer)
+            seconds, tokens = prefill_seconds(model, tokenizer, device, prompt, args.repeat)
+            seconds_before.append(seconds)
+            tokens_before.append(tokens)
+
+            prompt = server.format_messages(server.create_messages_for_task(config, data, selection), tokenizer)
+            seconds, tokens = prefill_seconds(model, tokenizer, device, prompt, args.repeat)
+            seconds_after.append(seconds)
+            tokens_after.append(tokens)
+
+        count = min(len(config.examples), server.MAX_PROMPT_EXAMPLES)
+        print(f"{name:<18}{f'{count} -> {statistics.mean(examples_after):.1f}':>10}"
+              f"{f'{statistics.mean(tokens_before):.0f} -> {statistics.mean(tokens_after):.0f}':>14}"
+              f"{f'{statistics.mean(seconds_before) * 1000:.1f} -> {statistics.mean(seconds_after) * 1000:.1f}':>18}")
+
+
+if __name__ == "__main__":
+    main()
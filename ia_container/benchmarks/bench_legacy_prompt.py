@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark del prompt legacy (modelli senza chat template).
+
+Confronta il formatter nativo del server (LegacyPrompt) con il percorso LangChain
+che sostituisce (PromptTemplate + LLMChain):
+- tempo di import in un interprete nuovo: `import server` e, a parte, i moduli
+  LangChain che il server importava all'avvio (dopo torch / transformers / fastapi,
+  già necessari comunque)
+- per ogni task, sugli input degli esempi: prompt identici byte per byte e costo per
+  richiesta di LLMChain.invoke (con un LLM finto, quindi senza generazione: solo
+  templating, callback e wrapping del risultato) contro LegacyPrompt.format
+
+Richiede i pacchetti langchain / langchain-community, non più usati dal server.
+
+Uso: python benchmarks/bench_legacy_prompt.py [--tasks cyan red] [--repeat N] [--imports N]
+"""
+import argparse
+import pathlib
+import statistics
+import subprocess
+import sys
+import time
+import warnings
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+# Import LangChain che il server eseguiva all'avvio (modalità legacy)
+LANGCHAIN_IMPORTS = """
+import torch, transformers, fastapi
+start = time.perf_counter()
+try:
+    from langchain_community.llms import HuggingFacePipeline
+except ImportError:
+    from langchain.llms import HuggingFacePipeline
+from langchain.prompts import PromptTemplate
+from langchain.chains import LLMChain
+"""
+
+SERVER_IMPORT = """
+start = time.perf_counter()
+import server
+"""
+
+
+def import_seconds(code, runs):
+    """Tempo mediano di import (secondi) del codice in un interprete nuovo"""
+    script = f"import time\n{code}\nprint(time.perf_counter() - start)"
+    times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def per_call_seconds(func, repeat):
+    """Tempo medio di una chiamata"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark prompt legacy nativo vs LangChain")
+    parser.add_argument("--tasks", nargs="+")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--imports", type=int, default=3, help="Interpreti avviati per misurare gli import")
+    args = parser.parse_args()
+
+    try:
+        from langchain.chains import LLMChain
+        from langchain.prompts import PromptTemplate
+        from langchain_core.language_models.fake import FakeListLLM
+    except ImportError:
+        sys.exit("LangChain non installato: pip install langchain langchain-community")
+    # LLMChain è deprecata, ma è quella che usava il server
+    warnings.filterwarnings("ignore", message=".*LLMChain.*")
+
+    print(f"\n{'import':<22}{'secondi':>10}")
+    print(f"{'server':<22}{import_seconds(SERVER_IMPORT, args.imports):>10.2f}")
+    print(f"{'langchain (prima)':<22}{import_seconds(LANGCHAIN_IMPORTS, args.imports):>10.2f}")
+
+    server.TASKS_DIR = ROOT / "tasks"
+    configs = server.load_task_configs()
+    names = args.tasks or list(configs)
+    llm = FakeListLLM(responses=[""])
+
+    print(f"\n{'task':<22}{'identici':>10}{'LLMChain (µs)':>15}{'nativo (µs)':>13}")
+    for name in names:
+        config = configs[name]
+        prompt = server.build_legacy_prompt(config)
+        template = PromptTemplate(input_variables=config.input_fields, template=prompt.template)
+        chain = LLMChain(llm=llm, prompt=template)
+        inputs = [{field: str(example.get(field, "")) for field in config.input_fields}
+                  for example in config.examples] or [server.sample_task_input(config)]
+
+        same = sum(prompt.format(**data) == template.format(**data) for data in inputs)
+        chain_seconds = statistics.mean(
+            per_call_seconds(lambda: chain.invoke(data), max(1, args.repeat // 10)) for data in inputs
+        )
+        native_seconds = statistics.mean(
+            per_call_seconds(lambda: prompt.format(**data), args.repeat) for data in inputs
+        )
+        print(f"{name:<22}{f'{same}/{len(inputs)}':>10}{chain_seconds * 1e6:>15.1f}{native_seconds * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
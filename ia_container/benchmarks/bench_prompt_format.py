@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark della formattazione del prompt per richiesta.
+
+Confronta, per ogni task, il percorso completo (create_messages_for_task +
+apply_chat_template + tokenizzazione dell'intero prompt) con il template
+precompilato (concatenazione di stringhe + tokenizzazione del solo suffisso,
+come nel server, dove il prefisso arriva dalla KV-cache dei prefissi).
+
+Uso: python benchmarks/bench_prompt_format.py [--model MODEL_ID] [--iterations N]
+"""
+import argparse
+import pathlib
+import sys
+import timeit
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+import transformers  # noqa: E402
+
+
+def sample_input(task_config):
+    """Input d'esempio: i campi del primo esempio del task"""
+    example = task_config.examples[0]
+    return {name: example.get(name, "valore di prova") for name in task_config.input_fields}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark formattazione prompt")
+    parser.add_argument("--model", default=server.MODEL_ID, help="Modello da cui caricare il tokenizer")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    server.TASKS_DIR = ROOT / "tasks"
+    if args.model.startswith((server.STUB_MODEL_PREFIX, server.RANDOM_MODEL_PREFIX)):
+        tokenizer = server.build_offline_tokenizer()
+    else:
+        tokenizer = transformers.AutoTokenizer.from_pretrained(
+            args.model, trust_remote_code=True, use_fast=True, padding_side="left"
+        )
+    configs = server.load_task_configs(tokenizer)
+
+    print(f"\n{'task':<22}{'completo (µs)':>16}{'compilato (µs)':>16}{'speedup':>10}")
+    for name, config in sorted(configs.items()):
+        if config.prompt is None:
+            print(f"{name:<22}{'n/d':>16}")
+            continue
+        data = sample_input(config)
+
+        def before():
+            messages = server.create_messages_for_task(config, data)
+            formatted = server.format_messages(messages, tokenizer)
+            return tokenizer(formatted)["input_ids"]
+
+        def after():
+            config.prompt.render(data)
+            return tokenizer(config.prompt.suffix(data), add_special_tokens=False)["input_ids"]
+
+        assert config.prompt.render(data) == server.format_messages(
+            server.create_messages_for_task(config, data), tokenizer
+        )
+
+        t_before = timeit.timeit(before, number=args.iterations) / args.iterations * 1e6
+        t_after = timeit.timeit(after, number=args.iterations) / args.iterations * 1e6
+        print(f"{name:<22}{t_before:>16.1f}{t_after:>16.1f}{t_before / t_after:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
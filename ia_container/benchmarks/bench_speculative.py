@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Benchmark della decodifica speculativa.
+
+Per ogni task genera (greedy) le risposte agli esempi del task con il solo
+modello principale e con la generazione assistita dal modello draft, poi
+confronta token/s, tasso di accettazione e uguaglianza degli output.
+Pensato per girare su CPU con modelli piccoli locali.
+
+Uso: python benchmarks/bench_speculative.py --model MODEL_ID --draft DRAFT_ID
+         [--tasks cyan magenta] [--samples N] [--max-new-tokens N]
+"""
+import argparse
+import pathlib
+import sys
+import time
+from dataclasses import replace
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+
+def task_prompts(config, tokenizer, samples):
+    """Prompt costruiti dagli esempi del task (uno per esempio, al massimo samples)"""
+    prompts = []
+    for example in config.examples[:samples] or [{}]:
+        data = {name: str(example.get(name) or name) for name in config.input_fields}
+        prompts.append(server.format_messages(server.create_messages_for_task(config, data), tokenizer))
+    return prompts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark decodifica speculativa")
+    parser.add_argument("--model", default=server.MODEL_ID)
+    parser.add_argument("--draft", default=server.DRAFT_MODEL_ID, required=not server.DRAFT_MODEL_ID)
+    parser.add_argument("--tasks", nargs="+", default=["cyan", "magenta"])
+    parser.add_argument("--samples", type=int, default=3)
+    parser.add_argument("--max-new-tokens", type=int, default=128)
+    args = parser.parse_args()
+
+    model, tokenizer, device = server.load_model_and_tokenizer(args.model)
+    draft, draft_tokenizer = server.load_draft_model(args.draft, model, tokenizer)
+    engine = server.GenerationEngine(model, tokenizer, device, draft, draft_tokenizer)
+    server.TASKS_DIR = ROOT / "tasks"
+    configs = server.load_task_configs()
+
+    print(f"\n{'task':<12}{'base (tok/s)':>14}{'draft (tok/s)':>15}{'speedup':>9}{'accettazione':>14}{'uguali':>8}")
+    for name in args.tasks:
+        config = configs[name]
+        params = replace(config.generation_params(), max_new_tokens=args.max_new_tokens, do_sample=False)
+        prompts = task_prompts(config, tokenizer, args.samples)
+
+        base_tokens, base_seconds = 0, 0.0
+        baseline_outputs = []
+        for prompt in prompts:
+            start = time.perf_counter()
+            output = engine.generate_batch([prompt], params)[0]
+            base_seconds += time.perf_counter() - start
+            base_tokens += len(tokenizer(output, add_special_tokens=False)["input_ids"])
+            baseline_outputs.append(output)
+
+        stats = server.SpeculativeStats()
+        assisted_outputs = []
+        for prompt in prompts:
+            output, run = engine.generate_assisted(prompt, params)
+            stats.record(name, run)
+            assisted_outputs.append(output)
+        stats.record_baseline(name, base_tokens, base_seconds)
+
+        result = stats.task_snapshot(name)
+        same = sum(a == b for a, b in zip(baseline_outputs, assisted_outputs))
+        print(f"{name:<12}{result['baseline_tokens_per_second']:>14}{result['tokens_per_second']:>15}"
+              f"{result['speedup']:>8}x{result['acceptance_rate']:>14}{f'{same}/{len(prompts)}':>8}")
+
+
+if __name__ == "__main__":
+    main()
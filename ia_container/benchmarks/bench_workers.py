@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Benchmark della modalità multi-processo su CPU.
+
+Avvia il server due volte sugli stessi core: un solo processo che usa tutti i
+core (WORKERS=1) e N worker con core/N core ciascuno (WORKERS=N), poi invia a
+entrambi lo stesso carico a ciclo chiuso (C client concorrenti) su un task e
+confronta throughput e latenze (p50 / p95).
+
+Uso: python benchmarks/bench_workers.py --workers N [--model MODEL_ID] [--task yellow]
+         [--concurrency C] [--requests R] [--max-new-tokens N] [--port PORT]
+"""
+import argparse
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+
+def wait_ready(url, process, timeout):
+    """Attende che /ready risponda 200 (o che il server termini)"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server terminato (exit {process.returncode})")
+        try:
+            with urllib.request.urlopen(f"{url}/ready", timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (urllib.error.URLError, OSError):
+            pass
+        time.sleep(1)
+    raise RuntimeError(f"Server non pronto entro {timeout}s")
+
+
+def post(url, payload):
+    """POST JSON, restituisce la latenza in secondi"""
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode("utf-8"), headers={"Content-Type": "application/json"}
+    )
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def run_load(url, payloads, concurrency):
+    """Carico a ciclo chiuso: concurrency client che inviano le richieste una dopo l'altra"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(lambda payload: post(url, payload), payloads))
+    return latencies, time.perf_counter() - start
+
+
+def bench(args, workers, cores, payloads):
+    env = dict(
+        os.environ,
+        MODEL_ID=args.model,
+        PORT=str(args.port),
+        WORKERS=str(workers),
+        WORKER_BASE_PORT=str(args.port + 1),
+        CPU_CORES=",".join(str(core) for core in cores),
+        RESPONSE_CACHE_DIR="",
+    )
+    process = subprocess.Popen(
+        [sys.executable, str(ROOT / "server.py")], cwd=ROOT, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_ready(url, process, args.timeout)
+        # Attende che siano pronti tutti i worker, non solo il primo
+        while workers > 1:
+            with urllib.request.urlopen(f"{url}/ready") as response:
+                if json.load(response)["ready"] == workers:
+                    break
+            time.sleep(1)
+        run_load(f"{url}/{args.task}", payloads[:args.concurrency], args.concurrency)
+        latencies, elapsed = run_load(f"{url}/{args.task}", payloads, args.concurrency)
+    finally:
+        process.terminate()
+        process.wait()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark worker multi-processo")
+    parser.add_argument("--model", default=server.MODEL_ID)
+    parser.add_argument("--workers", type=int, required=True)
+    parser.add_argument("--task", default="yellow")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8171)
+    parser.add_argument("--timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    cores = server.available_cores()
+    if args.workers > len(cores):
+        sys.exit(f"--workers ({args.workers}) maggiore dei core disponibili ({len(cores)})")
+
+    server.TASKS_DIR = ROOT / "tasks"
+    config = server.load_task_configs()[args.task]
+    # Input diversi per richiesta (nessun hit di cache), lunghezza di generazione fissata
+    payloads = []
+    for i in range(args.requests):
+        data = {name: f"{value} ({i})" for name, value in server.sample_task_input(config).items()}
+        data["generation"] = {"max_new_tokens": args.max_new_tokens, "do_sample": False}
+        payloads.append(data)
+
+    print(f"\n{'configurazione':<22}{'richieste/s':>12}{'p50 (s)':>10}{'p95 (s)':>10}")
+    for workers in (1, args.workers):
+        latencies, elapsed = bench(args, workers, cores, payloads)
+        label = f"{workers} x {len(cores) // workers} core"
+        print(f"{label:<22}{len(latencies) / elapsed:>12.2f}"
+              f"{server.percentile(latencies, 50):>10.2f}{server.percentile(latencies, 95):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,285 @@
 #!/usr/bin/env python3
 """
-Script interattivo per inviare richieste POST a un server specificato.
+Generatore di carico per il server unificato.
 
-- Chiede IP/localhost, porta ed endpoint.
-- Consente di definire una lista di parametri (nome e tipo), terminando con "STOP".
-- Per ogni invio, chiede i valori dei parametri e invia la richiesta in JSON.
-- Stampa la risposta JSON (o il testo se non è JSON).
+Legge uno scenario JSON (mix di task, corpus di input, concorrenza, rate, durata) e invia
+le richieste con asyncio:
+- ciclo chiuso ("closed"): `concurrency` client, ognuno invia la richiesta successiva
+  appena riceve la risposta
+- ciclo aperto ("open"): arrivi di Poisson a `rate` richieste/s indipendenti dalle risposte;
+  la latenza parte dall'istante di arrivo previsto, anche se l'invio è in ritardo
+
+Per ogni task riporta throughput, latenze p50 / p95 / p99 (delle risposte 2xx) ed error rate;
+con --output scrive i risultati in JSON, con --baseline li confronta con un'esecuzione precedente.
+
+Uso: python request_sender.py SCENARIO.json [--url URL] [--mode closed|open] [--concurrency C]
+         [--rate R] [--duration S] [--output FILE] [--baseline FILE]
 """
-import requests
+import argparse
+import asyncio
+import json
+import pathlib
+import random
 import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
 
-def get_parameters():
-    """Legge da input nome e tipo di ciascun parametro."""
-    params = []
-    while True:
-        entry = input("Inserisci nome parametro e tipo (string,int,float) separati da spazio (o STOP per terminare): ")
-        if entry.strip().upper() == "STOP":
-            break
-        parts = entry.strip().split()
-        if len(parts) != 2:
-            print("Formato non valido. Riprovare.")
-            continue
-        name, type_str = parts
-        type_str = type_str.lower()
-        if type_str not in ("string", "int", "float"):
-            print("Tipo non valido. Usa 'string', 'int' o 'float'.")
-            continue
-        params.append((name, type_str))
-    return params
+import httpx
 
+ROOT = pathlib.Path(__file__).resolve().parent
 
-def cast_value(value_str, type_str):
-    """Converte la stringa di input nel tipo richiesto."""
-    if type_str == "int":
-        return int(value_str)
-    if type_str == "float":
-        return float(value_str)
-    # string
-    return value_str
+# Valori di default dello scenario
+DEFAULT_SCENARIO = {
+    "url": "http://localhost:8071",
+    "mode": "closed",         # "closed" | "open"
+    "concurrency": 4,         # Client concorrenti (ciclo chiuso)
+    "rate": 2.0,              # Richieste al secondo (ciclo aperto)
+    "max_in_flight": 256,     # Richieste in corso oltre le quali gli arrivi vengono scartati (ciclo aperto)
+    "duration": 30.0,         # Secondi di invio
+    "warmup": 0.0,            # Secondi iniziali esclusi dalle statistiche
+    "timeout": 300.0,         # Timeout di ogni richiesta
+    "ready_timeout": 600.0,   # Attesa massima di /ready prima di iniziare
+    "seed": 0,
+    "unique_inputs": False,   # Rende ogni input diverso (nessun hit della cache delle risposte)
+    "tasks": {},              # nome -> {"weight", "inputs", "generation", "headers"}
+}
 
 
-def main():
-    # Configurazione server
-    ip = input("Inserisci indirizzo IP o localhost: ").strip()
-    port = input("Inserisci porta: ").strip()
-    endpoint = input("Inserisci endpoint (senza slash iniziale): ").strip()
-
-    # Definizione parametri
-    params = get_parameters()
-    if not params:
-        print("Nessun parametro specificato. Uscita.")
-        return
+@dataclass
+class Record:
+    task: str
+    start: float    # Secondi dall'inizio del test (arrivo previsto nel ciclo aperto)
+    latency: float
+    status: str     # Status HTTP, "timeout", "errore di rete" o "scartata"
 
-    # Ciclo di invio richieste
-    while True:
-        data = {}
-        # Raccolta valori
-        for name, type_str in params:
-            val = input(f"Inserisci valore per '{name}' ({type_str}): ")
-            try:
-                data[name] = cast_value(val, type_str)
-            except ValueError:
-                print(f"Valore non valido per tipo {type_str}. Riprovare.")
+    @property
+    def ok(self) -> bool:
+        return self.status.startswith("2")
+
+
+def percentile(values, q):
+    """Percentile q (0-100) con il metodo nearest-rank"""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def load_scenario(path, overrides):
+    scenario = dict(DEFAULT_SCENARIO)
+    scenario.update(json.loads(pathlib.Path(path).read_text("utf-8")))
+    scenario.update({name: value for name, value in overrides.items() if value is not None})
+    if scenario["mode"] not in ("closed", "open"):
+        raise SystemExit(f"mode non valido: '{scenario['mode']}' (closed o open)")
+    if not scenario["tasks"]:
+        raise SystemExit("Lo scenario non contiene task")
+    if float(scenario["warmup"]) >= float(scenario["duration"]):
+        raise SystemExit("warmup deve essere minore di duration")
+    return scenario
+
+
+def load_inputs(task, spec, base_dir):
+    """
+    Corpus di input del task: lista nello scenario, file .json (lista) o .jsonl relativo allo
+    scenario, altrimenti gli esempi del task (i campi che non sono input vengono ignorati dal
+    server, gli esempi con campi vuoti verrebbero rifiutati e sono esclusi)
+    """
+    inputs = spec.get("inputs")
+    if isinstance(inputs, list):
+        return inputs
+    if inputs:
+        path = base_dir / inputs
+        text = path.read_text("utf-8")
+        if path.suffix == ".jsonl":
+            return [json.loads(line) for line in text.splitlines() if line.strip()]
+        return json.loads(text)
+    examples = json.loads((ROOT / "tasks" / task / "examples.json").read_text("utf-8"))
+    return [example for example in examples if all(value not in ("", None) for value in example.values())]
+
+
+class LoadGenerator:
+    def __init__(self, scenario, corpus):
+        self.scenario = scenario
+        self.corpus = corpus
+        self.names = list(corpus)
+        self.weights = [float(scenario["tasks"][name].get("weight", 1)) for name in self.names]
+        self.rng = random.Random(scenario["seed"])
+        self.records = []
+        self.sent = 0
+        self.in_flight = 0
+        self.started = 0.0
+
+    def next_request(self):
+        """Task (pesato) e payload della prossima richiesta"""
+        task = self.rng.choices(self.names, self.weights)[0]
+        spec = self.scenario["tasks"][task]
+        payload = dict(self.rng.choice(self.corpus[task]))
+        self.sent += 1
+        if self.scenario["unique_inputs"]:
+            payload = {name: f"{value} [{self.sent}]" if isinstance(value, str) else value
+                       for name, value in payload.items()}
+        if "generation" in spec:
+            payload["generation"] = spec["generation"]
+        return task, payload, spec.get("headers", {})
+
+    async def send(self, client, task, payload, headers, scheduled):
+        self.in_flight += 1
+        try:
+            response = await client.post(f"/{task}", json=payload, headers=headers)
+            status = str(response.status_code)
+        except httpx.TimeoutException:
+            status = "timeout"
+        except httpx.HTTPError:
+            status = "errore di rete"
+        finally:
+            self.in_flight -= 1
+        self.records.append(Record(task, scheduled - self.started, time.perf_counter() - scheduled, status))
+
+    async def closed_loop(self, client, end):
+        async def worker():
+            while time.perf_counter() < end:
+                await self.send(client, *self.next_request(), time.perf_counter())
+
+        await asyncio.gather(*(worker() for _ in range(int(self.scenario["concurrency"]))))
+
+    async def open_loop(self, client, end):
+        pending = set()
+        scheduled = self.started
+        while True:
+            scheduled += self.rng.expovariate(float(self.scenario["rate"]))
+            if scheduled >= end:
                 break
-        else:
-            # Invio richiesta
-            print("Invio richiesta...")
-            time_start = time.time()
-            url = f"http://{ip}:{port}/{endpoint}"
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            task, payload, headers = self.next_request()
+            if self.in_flight >= self.scenario["max_in_flight"]:
+                self.records.append(Record(task, scheduled - self.started, 0.0, "scartata"))
+                continue
+            request = asyncio.create_task(self.send(client, task, payload, headers, scheduled))
+            pending.add(request)
+            request.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+
+    async def wait_ready(self, client):
+        deadline = time.monotonic() + float(self.scenario["ready_timeout"])
+        while True:
             try:
-                response = requests.post(url, json=data)
-                response.raise_for_status()
-                try:
-                    print("Risposta JSON:", response.json())
-                except ValueError:
-                    print("Risposta non in formato JSON:", response.text)
-            except requests.RequestException as e:
-                print("Errore nella richiesta:", e)
+                if (await client.get("/ready")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise SystemExit(f"Server non pronto su {self.scenario['url']}")
+            await asyncio.sleep(1)
+
+    async def run(self):
+        scenario = self.scenario
+        limits = httpx.Limits(max_connections=max(int(scenario["concurrency"]), int(scenario["max_in_flight"])))
+        async with httpx.AsyncClient(base_url=scenario["url"], timeout=float(scenario["timeout"]),
+                                     limits=limits) as client:
+            await self.wait_ready(client)
+            print(f"🚀 Carico a ciclo {'chiuso' if scenario['mode'] == 'closed' else 'aperto'} "
+                  f"su {scenario['url']} per {scenario['duration']:g}s")
+            self.started = time.perf_counter()
+            end = self.started + float(scenario["duration"])
+            if scenario["mode"] == "closed":
+                await self.closed_loop(client, end)
+            else:
+                await self.open_loop(client, end)
+            return time.perf_counter() - self.started
+
+
+def summarize(records, window):
+    """Statistiche di un gruppo di richieste (misurate su window secondi)"""
+    latencies = [round(r.latency, 4) for r in records if r.ok]
+    errors = {}
+    for r in records:
+        if not r.ok:
+            errors[r.status] = errors.get(r.status, 0) + 1
+    return {
+        "requests": len(records),
+        "ok": len(latencies),
+        "errors": errors,
+        "error_rate": round(1 - len(latencies) / len(records), 4) if records else 0.0,
+        "throughput": round(len(latencies) / window, 3),
+        "latency": {
+            "mean": round(sum(latencies) / len(latencies), 4) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=None),
+        },
+    }
+
 
-            time_end = time.time()
-            print(f"Tempo di risposta: {time_end - time_start:.2f} secondi")
+def report(records, scenario):
+    warmup = float(scenario["warmup"])
+    window = max(1e-9, float(scenario["duration"]) - warmup)
+    measured = [r for r in records if r.start >= warmup]
+    results = {task: summarize([r for r in measured if r.task == task], window)
+               for task in sorted({r.task for r in measured})}
+    results["totale"] = summarize(measured, window)
+    return results
 
-        # Proseguire o terminare?
-        again = input("Vuoi inviare un'altra richiesta? (s/n): ").strip().lower()
-        if again != 's':
-            print("Terminato.")
-            break
+
+def fmt(seconds):
+    return f"{seconds:.3f}" if seconds is not None else "-"
+
+
+def print_results(results, baseline=None):
+    print(f"\n{'task':<22}{'richieste':>10}{'ok/s':>9}{'p50 (s)':>9}{'p95 (s)':>9}{'p99 (s)':>9}{'errori':>9}")
+    for task, stats in results.items():
+        latency = stats["latency"]
+        print(f"{task:<22}{stats['requests']:>10}{stats['throughput']:>9.2f}{fmt(latency['p50']):>9}"
+              f"{fmt(latency['p95']):>9}{fmt(latency['p99']):>9}{stats['error_rate']:>9.1%}")
+        for status, count in sorted(stats["errors"].items()):
+            print(f"{'':<22}{count:>10} x {status}")
+
+    if baseline is None:
+        return
+    print(f"\n{'task':<22}{'ok/s':>18}{'p95 (s)':>20}")
+    for task, stats in results.items():
+        before = baseline.get(task)
+        if before is None:
+            continue
+        throughput = f"{before['throughput']:.2f} -> {stats['throughput']:.2f}"
+        p95 = f"{fmt(before['latency']['p95'])} -> {fmt(stats['latency']['p95'])}"
+        print(f"{task:<22}{throughput:>18}{p95:>20}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generatore di carico per il server unificato")
+    parser.add_argument("scenario")
+    parser.add_argument("--url")
+    parser.add_argument("--mode", choices=["closed", "open"])
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--rate", type=float)
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--output", help="File JSON in cui scrivere scenario e risultati")
+    parser.add_argument("--baseline", help="Risultati JSON di un'esecuzione precedente da confrontare")
+    args = parser.parse_args()
+
+    overrides = {name: getattr(args, name) for name in ("url", "mode", "concurrency", "rate", "duration")}
+    scenario = load_scenario(args.scenario, overrides)
+    base_dir = pathlib.Path(args.scenario).resolve().parent
+    corpus = {task: load_inputs(task, spec, base_dir) for task, spec in scenario["tasks"].items()}
+
+    generator = LoadGenerator(scenario, corpus)
+    started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    elapsed = asyncio.run(generator.run())
+    results = report(generator.records, scenario)
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(pathlib.Path(args.baseline).read_text("utf-8"))["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        output = {"started_at": started_at, "elapsed_seconds": round(elapsed, 3),
+                  "scenario": scenario, "results": results}
+        pathlib.Path(args.output).write_text(json.dumps(output, indent=2, ensure_ascii=False), "utf-8")
+        print(f"\n💾 Risultati salvati in {args.output}")
 
 
 if __name__ == "__main__":
     main()
-
@@ -41,22 +41,38 @@ Uso: python unified_llm_server.py
 """
 
 # ---------------- PATCH anti‑Triton ------------------
+# (torch.compile viene riattivato solo con COMPILE_MODE=compile, vedi configure_compilation)
 import os
 os.environ["TORCH_COMPILE_DISABLE"] = "1"
 # ----------------------------------------------------
 
+import asyncio
+import bisect
+import copy
+import hashlib
 import json
+import math
 import pathlib
 import re
+import string
+import subprocess
 import sys
+import threading
+import time
 import warnings
-from typing import Optional, Tuple, List, Dict, Any, Union
-from dataclasses import dataclass, field
+from concurrent.futures import Future, InvalidStateError
+from typing import Optional, Tuple, List, Dict, Any, Union, Callable, Awaitable
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, replace
 import traceback
 
+import httpx
 import torch
 import transformers
 from fastapi import FastAPI, HTTPException, Request
+from fastapi.routing import APIRoute
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel, Field, create_model
 from dotenv import load_dotenv
 import uvicorn
@@ -68,14 +84,6 @@ load_dotenv()
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 warnings.filterwarnings("ignore", category=FutureWarning)
 
-# LangChain imports per compatibilità legacy
-try:
-    from langchain_community.llms import HuggingFacePipeline
-except ImportError:
-    from langchain.llms import HuggingFacePipeline
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-
 # ---------------------------------------------------------------------------
 # CONFIGURAZIONE GLOBALE
 # ---------------------------------------------------------------------------
@@ -83,8 +91,88 @@ from langchain.chains import LLMChain
 TASKS_DIR = pathlib.Path("tasks")  # Directory con le configurazioni dei task
 MODEL_ID = os.getenv("MODEL_ID", "sapienzanlp/Minerva-7B-instruct-v1.0")
 QUANT = os.getenv("QUANT", None)
+
+# Backend offline, senza download: MODEL_ID="stub:" simula la generazione con risposte deterministiche
+# prese dagli esempi dei task (STUB_TOKEN_LATENCY_MS per token), MODEL_ID="random:" (o
+# "random:<layer>x<hidden>") usa un piccolo modello Llama con pesi casuali
+STUB_MODEL_PREFIX = "stub:"
+RANDOM_MODEL_PREFIX = "random:"
+STUB_TOKEN_LATENCY_MS = float(os.getenv("STUB_TOKEN_LATENCY_MS", 20))
+
+# Inferenza su CPU: thread intra-op / inter-op di torch (0 = default di torch, o un thread per
+# core se CPU_CORES è impostato), core a cui legare il processo (formato taskset, es. "0-7,16";
+# vuoto = nessun vincolo) e token generati all'avvio per misurare la velocità (0 = nessuna misura)
+CPU_THREADS = int(os.getenv("CPU_THREADS", 0))
+CPU_INTEROP_THREADS = int(os.getenv("CPU_INTEROP_THREADS", 0))
+CPU_CORES = os.getenv("CPU_CORES", "")
+CPU_BENCH_TOKENS = int(os.getenv("CPU_BENCH_TOKENS", 16))
+HOST = os.getenv("HOST", "0.0.0.0")
 PORT = int(os.getenv("PORT", 8071))
 
+# Modalità multi-processo (CPU): WORKERS processi di inferenza, ognuno con il proprio modello e
+# un insieme disgiunto di core, dietro un dispatcher su PORT (1 = processo singolo). I worker
+# ascoltano in locale sulle porte WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+WORKERS = int(os.getenv("WORKERS", 1))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", PORT + 1))
+WORKER_INDEX = os.getenv("WORKER_INDEX", "")  # Impostato dal dispatcher nei processi worker
+
+# Micro-batching: finestra di raccolta delle richieste e dimensione massima del batch
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", 20))
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 8))
+
+# Backpressure: richieste massime in coda di inferenza e Retry-After suggerito quando è piena
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 64))
+RETRY_AFTER_SECONDS = int(os.getenv("RETRY_AFTER_SECONDS", 5))
+
+# Classi di priorità (header X-Priority o "priority" nel config.json), dalla più urgente; oltre
+# PRIORITY_MAX_WAIT_MS di attesa una richiesta passa davanti alle classi più prioritarie
+PRIORITY_CLASSES = ("interactive", "normal", "background")
+DEFAULT_PRIORITY = "normal"
+PRIORITY_MAX_WAIT_MS = float(os.getenv("PRIORITY_MAX_WAIT_MS", 10000))
+
+# Endpoint /batch: elementi massimi elaborati insieme (ridotti in base alla memoria libera)
+BATCH_CHUNK_SIZE = int(os.getenv("BATCH_CHUNK_SIZE", 32))
+
+# Cache delle risposte per i task che la abilitano nel config.json
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 24 * 3600))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "/models_cache/response_cache")
+# Voci massime del livello su disco (0 = nessun limite, si eliminano solo le scadute)
+RESPONSE_CACHE_DISK_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_ENTRIES", 100000))
+
+# Registrazione degli output grezzi (JSONL) per il benchmark di estrazione, vuoto = disattivata
+RECORD_RAW_OUTPUTS = os.getenv("RECORD_RAW_OUTPUTS", "")
+
+# Decodifica speculativa: modello draft (piccolo) per i task che la abilitano nel config.json,
+# vuoto = disattivata. Ogni DRAFT_BASELINE_EVERY richieste una gira senza draft per misurare lo speedup
+DRAFT_MODEL_ID = os.getenv("DRAFT_MODEL_ID", "")
+DRAFT_BASELINE_EVERY = int(os.getenv("DRAFT_BASELINE_EVERY", 20))
+
+# Ricaricamento automatico dei task: intervallo (secondi) di controllo delle modifiche, 0 = disattivato
+TASKS_WATCH_INTERVAL = float(os.getenv("TASKS_WATCH_INTERVAL", 0))
+
+# Warm-up all'avvio: token generati per task prima di dichiarare il server pronto, 0 = disattivato
+WARMUP_MAX_NEW_TOKENS = int(os.getenv("WARMUP_MAX_NEW_TOKENS", 8))
+
+# Budget adattivo di max_new_tokens: percentile delle lunghezze utili osservate per task più un margine,
+# applicato dopo ADAPTIVE_BUDGET_MIN_SAMPLES richieste sulle ultime ADAPTIVE_BUDGET_WINDOW (percentile 0 = disattivato)
+ADAPTIVE_BUDGET_PERCENTILE = float(os.getenv("ADAPTIVE_BUDGET_PERCENTILE", 95))
+ADAPTIVE_BUDGET_MARGIN = float(os.getenv("ADAPTIVE_BUDGET_MARGIN", 0.25))
+ADAPTIVE_BUDGET_MIN_SAMPLES = int(os.getenv("ADAPTIVE_BUDGET_MIN_SAMPLES", 50))
+ADAPTIVE_BUDGET_WINDOW = int(os.getenv("ADAPTIVE_BUDGET_WINDOW", 500))
+
+# KV-cache dei prefissi statici (system prompt + esempi): budget massimo in token, 0 = disattivata
+PREFIX_CACHE_MAX_TOKENS = int(os.getenv("PREFIX_CACHE_MAX_TOKENS", 16384))
+
+# Esecuzione compilata (opt-in): "" = eager (default), "static" = KV-cache statica preallocata,
+# "compile" = KV-cache statica e torch.compile del passo di decodifica. Gli artefatti di compilazione
+# sono salvati in COMPILE_CACHE_DIR (volume /models_cache), così i riavvii non ricompilano; la
+# lunghezza della cache statica è arrotondata a multipli di STATIC_CACHE_BUCKET token
+COMPILE_MODES = ("", "static", "compile")
+COMPILE_MODE = os.getenv("COMPILE_MODE", "")
+COMPILE_CACHE_DIR = os.getenv("COMPILE_CACHE_DIR", "/models_cache/torch_compile")
+STATIC_CACHE_BUCKET = int(os.getenv("STATIC_CACHE_BUCKET", 256))
+
 # ---------------------------------------------------------------------------
 # DATA CLASSES
 # ---------------------------------------------------------------------------
@@ -96,6 +184,98 @@ class OutputConfig:
     extract_pattern: Optional[str] = None
     type: str = "str"  # "str", "int", "float", "bool"
 
+# Parametri di generazione sovrascrivibili per singola richiesta (campo "generation")
+GENERATION_OVERRIDES = {
+    "max_new_tokens": int,
+    "temperature": float,
+    "top_p": float,
+    "do_sample": bool,
+    "seed": int,
+    "stop": list,
+    "stop_regex": list,
+    "max_lines": int,
+    "max_chars": int,
+}
+
+# Override che accorciano l'output: le richieste che li usano non entrano nelle statistiche del budget
+# adattivo, altrimenti il budget appreso sotto un limite verrebbe applicato anche alle richieste senza
+LENGTH_CAP_OVERRIDES = ("max_new_tokens", "stop", "stop_regex", "max_lines", "max_chars")
+
+@dataclass(frozen=True)
+class GenerationParams:
+    """Parametri di generazione di una richiesta (hashable, usati come chiave di batch)"""
+    max_new_tokens: int = 512
+    temperature: float = 0.7
+    top_p: float = 0.9
+    do_sample: bool = True
+    seed: Optional[int] = None
+    stop: Tuple[str, ...] = ()
+    stop_regex: Tuple[str, ...] = ()  # Regex che chiudono l'output (escluse, come le stop sequence)
+    max_lines: int = 0  # Righe massime dell'output, 0 = nessun limite
+    max_chars: int = 0  # Caratteri massimi dell'output, 0 = nessun limite
+    stop_patterns: Tuple[str, ...] = ()  # Pattern di estrazione: stop quando corrispondono tutti
+    assisted: bool = False  # Generazione assistita dal modello draft (se caricato)
+    
+    @property
+    def deterministic(self) -> bool:
+        """True se a parità di prompt l'output è riproducibile (greedy o seed fissato)"""
+        return not self.do_sample or self.temperature <= 0 or self.seed is not None
+    
+    @property
+    def seeded(self) -> bool:
+        """True se l'output è campionato con un seed fissato (riproducibile solo generando da solo)"""
+        return self.do_sample and self.temperature > 0 and self.seed is not None
+    
+    @property
+    def early_stop(self) -> bool:
+        """True se l'output può terminare prima di EOS / max_new_tokens"""
+        return bool(self.stop or self.stop_regex or self.max_lines > 0 or self.max_chars > 0 or self.stop_patterns)
+    
+    def with_overrides(self, overrides: Optional[Dict[str, Any]]) -> "GenerationParams":
+        """Applica ai default del task gli override passati nella richiesta"""
+        if not overrides:
+            return self
+        if not isinstance(overrides, dict):
+            raise ValueError("Il campo 'generation' deve essere un oggetto JSON")
+        
+        unknown = set(overrides) - set(GENERATION_OVERRIDES)
+        if unknown:
+            raise ValueError(f"Parametri di generazione non supportati: {sorted(unknown)}")
+        
+        values = {}
+        for name, value in overrides.items():
+            if value is None:
+                continue
+            if name in ("stop", "stop_regex"):
+                stop = [value] if isinstance(value, str) else value
+                values[name] = tuple(str(s) for s in stop)
+                if name == "stop_regex":
+                    for pattern in values[name]:
+                        re.compile(pattern)
+            else:
+                values[name] = GENERATION_OVERRIDES[name](value)
+        return replace(self, **values)
+
+@dataclass
+class ClassificationConfig:
+    """Modalità classificazione: l'output è scelto tra etichette chiuse confrontandone i logit"""
+    output: str
+    labels: List[str]
+    prefix: str = ""  # Testo che precede l'etichetta nella risposta (es. "Bool: ")
+    
+    def continuations(self) -> List[str]:
+        return [f"{self.prefix}{label}" for label in self.labels]
+
+# Esempi few-shot inclusi al massimo nel prompt
+MAX_PROMPT_EXAMPLES = 8
+
+@dataclass
+class FewShotConfig:
+    """Esempi few-shot scelti entro un budget di token del prompt"""
+    token_budget: int  # Token massimi di system prompt + esempi
+    selection: str = "priority"  # "priority" (selezione fissa) o "similarity" (similarità lessicale con l'input)
+    max_examples: int = MAX_PROMPT_EXAMPLES
+
 @dataclass
 class TaskConfig:
     """Configurazione per un singolo task"""
@@ -105,9 +285,80 @@ class TaskConfig:
     input_fields: List[str]  # Campi richiesti in input
     outputs: Dict[str, OutputConfig] = field(default_factory=dict)  # Output multipli
     max_new_tokens: int = 512
+    # Default di generazione del task (sovrascrivibili per richiesta)
+    temperature: float = 0.7
+    top_p: float = 0.9
+    do_sample: bool = True
+    seed: Optional[int] = None
+    stop: List[str] = field(default_factory=list)
+    # Terminazione anticipata: regex di stop, righe massime, stop appena corrispondono i pattern di estrazione
+    stop_regex: List[str] = field(default_factory=list)
+    max_lines: int = 0
+    max_chars: int = 0
+    stop_on_match: bool = False
+    # Budget di max_new_tokens appreso dalle lunghezze osservate (opt-in, vedi ADAPTIVE_BUDGET_*)
+    adaptive_budget: bool = False
+    # Decodifica speculativa con il modello draft (DRAFT_MODEL_ID)
+    speculative: bool = False
+    # Classificazione a etichette chiuse (nessuna generazione libera)
+    classification: Optional[ClassificationConfig] = None
+    # Esempi few-shot entro un budget di token (None = i primi MAX_PROMPT_EXAMPLES)
+    few_shot: Optional[FewShotConfig] = None
+    # Cache delle risposte (opt-in dal config.json)
+    cache_enabled: bool = False
+    cache_ttl: float = RESPONSE_CACHE_TTL
+    # Coalescenza delle richieste identiche in corso (opt-in dal config.json)
+    deterministic: bool = False
+    # Classe di priorità di default nella coda di inferenza (vedi PRIORITY_CLASSES)
+    priority: str = DEFAULT_PRIORITY
+    template_hash: str = ""
     # Legacy fields per retrocompatibilità
     output_field: Optional[str] = None
     extract_pattern: Optional[str] = None
+    # Template precompilato (impostato da load_task_configs quando è disponibile il tokenizer)
+    prompt: Optional["CompiledPrompt"] = None
+    # Estrattore degli output precompilato
+    extractor: Optional["TaskExtractor"] = None
+    # Selettore degli esempi few-shot (impostato con il tokenizer se few_shot è configurato)
+    selector: Optional["ExampleSelector"] = None
+    
+    def prompt_examples(self, selection: Optional[Tuple[int, ...]] = None) -> List[Dict[str, Any]]:
+        """Esempi inclusi nel prompt: quelli della selezione indicata, altrimenti la selezione fissa"""
+        if selection is None and self.selector is not None:
+            selection = self.selector.fixed
+        if selection is None:
+            return self.examples[:MAX_PROMPT_EXAMPLES]
+        return [self.examples[i] for i in selection]
+    
+    def generation_params(self) -> GenerationParams:
+        """Parametri di generazione di default del task"""
+        return GenerationParams(
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            do_sample=self.do_sample,
+            seed=self.seed,
+            stop=tuple(self.stop),
+            stop_regex=tuple(self.stop_regex),
+            max_lines=self.max_lines,
+            max_chars=self.max_chars,
+            stop_patterns=tuple(
+                o.extract_pattern for o in self.outputs.values() if o.extract_pattern
+            ) if self.stop_on_match else (),
+            assisted=self.speculative,
+        )
+
+class PipelineStep(BaseModel):
+    """Passo di una pipeline di task"""
+    task: str
+    map: Dict[str, str] = Field(default_factory=dict, description="Output del passo precedente -> campo di input")
+    inputs: Dict[str, Any] = Field(default_factory=dict, description="Input aggiuntivi del passo")
+    generation: Optional[Dict[str, Any]] = Field(None, description="Override dei parametri di generazione")
+
+class PipelineRequest(BaseModel):
+    """Richiesta all'endpoint /pipeline: input iniziali e passi eseguiti in ordine"""
+    inputs: Dict[str, Any] = Field(default_factory=dict)
+    steps: List[PipelineStep]
 
 # ---------------------------------------------------------------------------
 # MODEL LOADING
@@ -116,6 +367,9 @@ class TaskConfig:
 def load_model_and_tokenizer(model_id: str) -> Tuple[Any, Any, str]:
     """Carica modello e tokenizer una sola volta"""
     
+    if model_id.startswith((STUB_MODEL_PREFIX, RANDOM_MODEL_PREFIX)):
+        return load_offline_model(model_id)
+    
     is_gptq_model = "gptq" in model_id.lower()
     
     if is_gptq_model:
@@ -131,6 +385,13 @@ def load_model_and_tokenizer(model_id: str) -> Tuple[Any, Any, str]:
     
     print(f"💻 Device selezionato: {device}")
     
+    cpu_quant = QUANT if QUANT in {"cpu-int8", "cpu-bf16"} else None
+    if cpu_quant and device != "cpu":
+        print(f"⚠️  QUANT={QUANT} vale solo su CPU – ignorato sul device {device}")
+        cpu_quant = None
+    if device == "cpu":
+        configure_cpu_threads()
+    
     # Tokenizer
     print(f"📝 Caricamento tokenizer: {model_id}")
     tokenizer = transformers.AutoTokenizer.from_pretrained(
@@ -181,6 +442,10 @@ def load_model_and_tokenizer(model_id: str) -> Tuple[Any, Any, str]:
         })
         if not is_gptq_model and quant_cfg:
             common_kwargs["quantization_config"] = quant_cfg
+    elif cpu_quant == "cpu-bf16":
+        common_kwargs["torch_dtype"] = torch.bfloat16
+        did_quantize = True
+        print("✨ Pesi bf16 su CPU")
     else:
         common_kwargs["torch_dtype"] = torch.float32
     
@@ -191,270 +456,2138 @@ def load_model_and_tokenizer(model_id: str) -> Tuple[Any, Any, str]:
     
     model.eval()
     
+    if cpu_quant == "cpu-int8":
+        # Quantizzazione dinamica int8 dei layer Linear (attivazioni quantizzate al volo)
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        did_quantize = True
+        print("✨ Quantizzazione dinamica int8 dei layer Linear")
+    
     print("✅ Modello caricato" + (" e quantizzato" if did_quantize else ""))
     
+    if device == "cpu":
+        report_cpu_performance(model, tokenizer)
+    
     return model, tokenizer, device
 
-# ---------------------------------------------------------------------------
-# PIPELINE CREATION
-# ---------------------------------------------------------------------------
+# Chat template del tokenizer offline (le risposte dell'assistente sono chiuse da </s>)
+OFFLINE_CHAT_TEMPLATE = (
+    "{{ bos_token }}{% for m in messages %}<|{{ m['role'] }}|>\n{{ m['content'] }}</s>\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+OFFLINE_VOCAB_SIZE = 2000
 
-def create_pipeline(model, tokenizer, device: str, max_new_tokens: int = 512):
-    """Crea pipeline per generazione testo"""
-    gen_cfg = {
-        "max_new_tokens": max_new_tokens,
-        "do_sample": True,
-        "temperature": 0.7,
-        "top_p": 0.9,
-        "pad_token_id": tokenizer.pad_token_id,
-        "eos_token_id": tokenizer.eos_token_id,
-    }
-    
-    pipe_kwargs = {
-        "task": "text-generation",
-        "model": model,
-        "tokenizer": tokenizer,
-        "return_full_text": False,
-        **gen_cfg,
-    }
+def build_offline_tokenizer():
+    """
+    Tokenizer BPE byte-level addestrato sui file dei task (system prompt, esempi, config):
+    deterministico, senza download, con un chat template a ruoli.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
     
-    if not hasattr(model, "hf_device_map"):
-        pipe_kwargs["device"] = 0 if device == "cuda" else -1
+    texts = [path.read_text(encoding="utf-8", errors="ignore")
+             for path in sorted(TASKS_DIR.rglob("*")) if path.is_file()]
+    bpe = Tokenizer(models.BPE())
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=OFFLINE_VOCAB_SIZE,
+        special_tokens=["<s>", "</s>", "<pad>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False,
+    ))
     
-    return transformers.pipeline(**pipe_kwargs)
-
-# ---------------------------------------------------------------------------
-# TASK LOADING
-# ---------------------------------------------------------------------------
+    tokenizer = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=bpe, bos_token="<s>", eos_token="</s>", pad_token="<pad>", padding_side="left"
+    )
+    tokenizer.chat_template = OFFLINE_CHAT_TEMPLATE
+    print(f"📝 Tokenizer offline addestrato sui task: {len(tokenizer)} token")
+    return tokenizer
 
-def load_task_configs() -> Dict[str, TaskConfig]:
-    """Carica tutte le configurazioni dei task dalle cartelle"""
-    configs = {}
+def load_offline_model(model_id: str) -> Tuple[Any, Any, str]:
+    """
+    Backend offline su CPU. Con "stub:" il modello è None (la generazione è simulata da
+    StubEngine); con "random:<layer>x<hidden>" viene creato un modello Llama con pesi
+    casuali (seed fisso), così tokenizzazione, batching e KV-cache sono quelli reali.
+    """
+    configure_cpu_threads()
+    tokenizer = build_offline_tokenizer()
     
-    print(f"📁 Cercando task in: {TASKS_DIR.absolute()}")
+    if model_id.startswith(STUB_MODEL_PREFIX):
+        print(f"🧪 Motore stub: {STUB_TOKEN_LATENCY_MS:g} ms per token")
+        return None, tokenizer, "cpu"
     
-    if not TASKS_DIR.exists():
-        print(f"⚠️ Directory '{TASKS_DIR}' non trovata. Creala e aggiungi i task.")
-        return configs
+    spec = model_id[len(RANDOM_MODEL_PREFIX):] or "2x64"
+    match = re.fullmatch(r"(\d+)x(\d+)", spec)
+    if match is None or int(match.group(2)) % 16:
+        raise ValueError(f"MODEL_ID non valido: '{model_id}' (atteso random:<layer>x<hidden>, hidden multiplo di 16)")
+    layers, hidden = int(match.group(1)), int(match.group(2))
+    heads = hidden // 16
     
-    task_dirs = list(TASKS_DIR.iterdir())
-    print(f"📂 Directory trovate: {[d.name for d in task_dirs if d.is_dir()]}")
+    torch.manual_seed(0)
+    config = transformers.LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden,
+        intermediate_size=2 * hidden,
+        num_hidden_layers=layers,
+        num_attention_heads=heads,
+        num_key_value_heads=heads // 2 or 1,
+        max_position_embeddings=8192,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = transformers.LlamaForCausalLM(config)
+    model.eval()
+    print(f"🎲 Modello casuale: {layers} layer, hidden {hidden}")
     
-    for task_dir in TASKS_DIR.iterdir():
-        if not task_dir.is_dir():
-            continue
-            
-        task_name = task_dir.name
-        system_prompt_file = task_dir / "system_prompt.txt"
-        examples_file = task_dir / "examples.json"
-        config_file = task_dir / "config.json"  # Opzionale per configurazioni extra
-        
-        if not system_prompt_file.exists() or not examples_file.exists():
-            print(f"⚠️ Task '{task_name}' manca di file richiesti, saltato.")
+    report_cpu_performance(model, tokenizer)
+    return model, tokenizer, "cpu"
+
+def load_draft_model(draft_id: str, model, tokenizer) -> Tuple[Any, Optional[Any]]:
+    """
+    Carica il modello draft per la decodifica speculativa, sullo stesso device e dtype
+    del modello principale. Restituisce anche il suo tokenizer se il vocabolario è
+    diverso (generazione assistita con tokenizer differenti), altrimenti None.
+    """
+    print(f"🪶 Caricamento modello draft: {draft_id}")
+    draft_tokenizer = transformers.AutoTokenizer.from_pretrained(draft_id, trust_remote_code=True, use_fast=True)
+    draft = transformers.AutoModelForCausalLM.from_pretrained(
+        draft_id,
+        trust_remote_code=True,
+        low_cpu_mem_usage=True,
+        torch_dtype=model.dtype,
+    )
+    draft.to(model.device)
+    draft.eval()
+    
+    same_vocab = draft_tokenizer.get_vocab() == tokenizer.get_vocab()
+    print("✅ Modello draft caricato" + ("" if same_vocab else " (vocabolario diverso dal modello principale)"))
+    return draft, None if same_vocab else draft_tokenizer
+
+def parse_cpu_list(spec: str) -> List[int]:
+    """Elenco di core nel formato di taskset / cpuset (es. "0-3,8,10-11")"""
+    cores = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
             continue
-        
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cores.extend(range(int(first), int(last) + 1))
+        else:
+            cores.append(int(part))
+    return cores
+
+def available_cores() -> List[int]:
+    """Core utilizzabili dal processo (CPU_CORES se impostato)"""
+    if CPU_CORES:
+        return parse_cpu_list(CPU_CORES)
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def configure_cpu_threads():
+    """Lega il processo ai core di CPU_CORES e imposta i thread intra-op / inter-op di torch"""
+    threads = CPU_THREADS
+    if CPU_CORES:
+        cores = parse_cpu_list(CPU_CORES)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+            print(f"📌 Processo legato ai core {CPU_CORES}")
+        else:
+            print("⚠️  CPU_CORES ignorato: affinità dei core non supportata dal sistema")
+        # Un thread per core assegnato, salvo CPU_THREADS esplicito
+        threads = threads or len(cores)
+    if threads > 0:
+        torch.set_num_threads(threads)
+    if CPU_INTEROP_THREADS > 0:
         try:
-            # Carica system prompt
-            system_prompt = system_prompt_file.read_text("utf-8").strip()
-            
-            # Carica esempi
-            examples = json.loads(examples_file.read_text("utf-8"))
-            
-            # Carica configurazione extra se presente
-            extra_config = {}
-            if config_file.exists():
-                extra_config = json.loads(config_file.read_text("utf-8"))
-            
-            # Determina campi input/output dagli esempi
-            if not examples:
-                print(f"⚠️ Task '{task_name}' non ha esempi, saltato.")
-                continue
-                
-            first_example = examples[0]
-            all_fields = list(first_example.keys())
-            
-            # Campi di input
-            input_fields = extra_config.get("input_fields", [])
-            if not input_fields:
-                # Prova a indovinare dai nomi comuni
-                possible_inputs = ["question", "answer", "feedback", "llm_response", 
-                                 "text", "input", "prompt", "query", "content",
-                                 "argomento", "livello", "argument", "level", "theme"]
-                input_fields = [f for f in all_fields if f in possible_inputs]
-            
-            # Gestisci outputs
-            outputs = {}
-            
-            if "outputs" in extra_config:
-                # Nuova modalità: output multipli definiti esplicitamente
-                for output_name, output_cfg in extra_config["outputs"].items():
-                    outputs[output_name] = OutputConfig(
-                        name=output_name,
-                        extract_pattern=output_cfg.get("extract_pattern"),
-                        type=output_cfg.get("type", "str")
-                    )
-            else:
-                # Modalità legacy: singolo output
-                output_field = extra_config.get("output_field", "")
-                
-                if not output_field:
-                    # Prova a indovinare l'output
-                    possible_outputs = ["score", "humanized_response", "result", 
-                                      "output", "response", "tag", "tags", "summary",
-                                      "risposta", "bool", "question_generated"]
-                    for f in all_fields:
-                        if f in possible_outputs:
-                            output_field = f
-                            break
-                    if not output_field:
-                        output_field = "result"  # Default
-                
-                # Crea configurazione output legacy
-                outputs[output_field] = OutputConfig(
-                    name=output_field,
-                    extract_pattern=extra_config.get("extract_pattern"),
-                    type="int" if "score" in output_field else "str"
-                )
-            
-            # Crea configurazione
-            config = TaskConfig(
-                name=task_name,
-                system_prompt=system_prompt,
-                examples=examples,
-                input_fields=input_fields,
-                outputs=outputs,
-                max_new_tokens=extra_config.get("max_new_tokens", 512),
-                # Legacy fields per retrocompatibilità
-                output_field=list(outputs.keys())[0] if len(outputs) == 1 else None,
-                extract_pattern=list(outputs.values())[0].extract_pattern if len(outputs) == 1 else None
-            )
-            
-            output_names = list(outputs.keys())
-            configs[task_name] = config
-            print(f"✅ Task '{task_name}' caricato - Input: {input_fields}, Output: {output_names}")
-                
-        except Exception as e:
-            print(f"❌ Errore caricamento task '{task_name}': {e}")
-            traceback.print_exc()
+            torch.set_num_interop_threads(CPU_INTEROP_THREADS)
+        except RuntimeError as e:
+            # Ammesso solo prima di qualunque lavoro parallelo
+            print(f"⚠️  Thread inter-op non impostati: {e}")
+    print(f"🧵 Thread CPU: intra-op {torch.get_num_threads()}, inter-op {torch.get_num_interop_threads()}")
+
+def process_rss_bytes() -> Optional[int]:
+    """Memoria residente del processo (None se non determinabile)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def model_weight_bytes(model) -> int:
+    """Memoria occupata da pesi e buffer del modello, inclusi i pesi int8 impacchettati"""
+    seen = set()
+    total = 0
     
-    return configs
+    def add(value):
+        nonlocal total
+        if isinstance(value, torch.Tensor):
+            key = (value.data_ptr(), value.nelement())
+            if key not in seen:
+                seen.add(key)
+                total += value.nelement() * value.element_size()
+        elif isinstance(value, (tuple, list)):
+            for item in value:
+                add(item)
+    
+    for value in model.state_dict().values():
+        add(value)
+    return total
+
+def mapped_weight_bytes(model) -> Optional[int]:
+    """
+    Byte dei pesi che puntano direttamente ai file safetensors mappati in memoria:
+    restano nella page cache e sono condivisi tra i processi che caricano lo stesso
+    modello (None se non determinabile)
+    """
+    try:
+        with open("/proc/self/maps") as f:
+            regions = []
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 6 and parts[5].endswith(".safetensors"):
+                    start, end = parts[0].split("-")
+                    regions.append((int(start, 16), int(end, 16)))
+    except OSError:
+        return None
+    regions.sort()
+    starts = [start for start, _ in regions]
+    
+    seen = set()
+    total = 0
+    for tensor in model.state_dict().values():
+        if not isinstance(tensor, torch.Tensor) or tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        i = bisect.bisect_right(starts, tensor.data_ptr()) - 1
+        if i >= 0 and tensor.data_ptr() < regions[i][1]:
+            total += tensor.nelement() * tensor.element_size()
+    return total
+
+def report_cpu_performance(model, tokenizer):
+    """Stampa memoria occupata e token/s di una breve generazione greedy"""
+    rss = process_rss_bytes()
+    mapped = mapped_weight_bytes(model)
+    print(f"📏 Pesi del modello: {model_weight_bytes(model) / 2**20:.1f} MiB"
+          + (f" ({mapped / 2**20:.1f} MiB condivisi via mmap)" if mapped else "")
+          + (f" - RSS processo: {rss / 2**20:.1f} MiB" if rss is not None else ""))
+    
+    if CPU_BENCH_TOKENS <= 0:
+        return
+    inputs = tokenizer("Una breve frase di prova per misurare la velocità", return_tensors="pt")
+    with torch.inference_mode():
+        start = time.perf_counter()
+        output = model.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            max_new_tokens=CPU_BENCH_TOKENS,
+            min_new_tokens=CPU_BENCH_TOKENS,
+            do_sample=False,
+            pad_token_id=tokenizer.pad_token_id,
+        )
+        elapsed = time.perf_counter() - start
+    generated = output.shape[1] - inputs["input_ids"].shape[1]
+    print(f"⏱️  Velocità CPU: {generated / elapsed:.1f} token/s ({generated} token in {elapsed:.2f}s)")
 
 # ---------------------------------------------------------------------------
-# PROMPT FORMATTING
+# GENERATION ENGINE
 # ---------------------------------------------------------------------------
 
-def is_role_based_model(model_id: str, tokenizer) -> bool:
-    """Determina se il modello supporta role-based prompting"""
-    role_based_models = [
-        "gemma", "llama", "mistral", "mixtral", "qwen", "phi",
-        "chatglm", "baichuan", "internlm", "yi", "deepseek"
-    ]
+def output_stop_index(text: str, params: GenerationParams) -> Optional[int]:
+    """
+    Posizione in cui l'output è completo secondo i criteri di terminazione dei
+    parametri (None se non lo è ancora): stop sequence e stop regex sono escluse,
+    dopo max_lines righe si taglia a fine riga, dopo max_chars caratteri si tronca,
+    con i pattern di estrazione si taglia subito dopo l'ultima corrispondenza.
+    """
+    cuts = []
+    for stop_seq in params.stop:
+        idx = text.find(stop_seq)
+        if idx != -1:
+            cuts.append(idx)
+    for pattern in params.stop_regex:
+        match = re.search(pattern, text)
+        if match:
+            cuts.append(match.start())
+    if params.max_lines > 0:
+        # Le righe vuote iniziali non contano
+        pos = len(text) - len(text.lstrip())
+        for _ in range(params.max_lines):
+            pos = text.find("\n", pos)
+            if pos == -1:
+                break
+            pos += 1
+        else:
+            cuts.append(pos - 1)
+    if params.max_chars > 0:
+        # Come per le righe, gli spazi iniziali (rimossi dallo strip dell'output) non contano
+        start = len(text) - len(text.lstrip())
+        if len(text) - start >= params.max_chars:
+            cuts.append(start + params.max_chars)
+    if params.stop_patterns:
+        # Una corrispondenza è definitiva solo se è seguita da altro testo: altrimenti
+        # il token successivo potrebbe ancora estenderla (es. "1" -> "10")
+        ends = []
+        for pattern in params.stop_patterns:
+            match = re.search(pattern, text, re.IGNORECASE | re.DOTALL)
+            if not match or match.end() >= len(text):
+                break
+            ends.append(match.end())
+        else:
+            cuts.append(max(ends))
+    return min(cuts) if cuts else None
+
+def trim_output(text: str, params: GenerationParams) -> str:
+    """Rimuove dall'output il testo successivo al punto di terminazione"""
+    cut = output_stop_index(text, params)
+    return text if cut is None else text[:cut]
+
+class OutputStoppingCriteria(transformers.StoppingCriteria):
+    """
+    Interrompe ogni sequenza appena l'output generato è completo (vedi output_stop_index).
+    Se la lunghezza del prompt non è nota viene ricavata alla prima chiamata.
+    """
     
-    model_lower = model_id.lower()
-    for model_name in role_based_models:
-        if model_name in model_lower:
-            return True
+    def __init__(self, tokenizer, params: GenerationParams, prompt_len: Optional[int] = None):
+        self.tokenizer = tokenizer
+        self.params = params
+        self.prompt_len = prompt_len
+        self._done: Optional[List[bool]] = None
     
-    return hasattr(tokenizer, 'apply_chat_template')
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_len is None:
+            self.prompt_len = input_ids.shape[1] - 1
+        if self._done is None:
+            self._done = [False] * input_ids.shape[0]
+        for row, ids in enumerate(input_ids):
+            if not self._done[row]:
+                text = self.tokenizer.decode(ids[self.prompt_len:], skip_special_tokens=True)
+                self._done[row] = output_stop_index(text, self.params) is not None
+        return torch.tensor(self._done, dtype=torch.bool, device=input_ids.device)
 
-def create_messages_for_task(task_config: TaskConfig, input_data: Dict[str, Any]) -> List[Dict[str, str]]:
-    """Crea messaggi per modelli role-based"""
-    messages = [{"role": "system", "content": task_config.system_prompt}]
+class PrefixCache:
+    """
+    Cache LRU dei past_key_values dei prefissi statici dei task, limitata
+    dal numero totale di token memorizzati.
+    """
     
-    # Aggiungi esempi
-    for ex in task_config.examples[:8]:  # Max 8 esempi
-        # Costruisci contenuto user dai campi input
-        user_parts = []
-        for field in task_config.input_fields:
-            if field in ex:
-                # Capitalizza il nome del campo per renderlo più leggibile
-                field_name = field.replace("_", " ").title()
-                user_parts.append(f"{field_name}: {ex[field]}")
-        
-        user_content = "\n".join(user_parts)
-        
-        # Risposta assistant con tutti gli output
-        assistant_parts = []
-        for output_name in task_config.outputs:
-            if output_name in ex:
-                output_label = output_name.replace("_", " ").title()
-                assistant_parts.append(f"{output_label}: {ex[output_name]}")
-        
-        assistant_content = "\n".join(assistant_parts) if assistant_parts else ""
-        
-        messages.append({"role": "user", "content": user_content})
-        messages.append({"role": "assistant", "content": assistant_content})
+    def __init__(self, max_tokens: int = PREFIX_CACHE_MAX_TOKENS):
+        self.max_tokens = max_tokens
+        self._entries: "OrderedDict[str, Tuple[Any, Any]]" = OrderedDict()
+        self._tokens = 0
+        self._lock = threading.Lock()
     
-    # Aggiungi input corrente
-    current_parts = []
-    for field in task_config.input_fields:
-        if field in input_data:
-            field_name = field.replace("_", " ").title()
-            current_parts.append(f"{field_name}: {input_data[field]}")
+    @property
+    def enabled(self) -> bool:
+        return self.max_tokens > 0
     
-    current_content = "\n".join(current_parts)
-    messages.append({"role": "user", "content": current_content})
+    def get(self, prefix: str) -> Optional[Tuple[Any, Any]]:
+        with self._lock:
+            entry = self._entries.get(prefix)
+            if entry is not None:
+                self._entries.move_to_end(prefix)
+            return entry
     
-    return messages
+    def put(self, prefix: str, prefix_ids, past_key_values):
+        size = prefix_ids.shape[-1]
+        if size > self.max_tokens:
+            return
+        with self._lock:
+            if prefix in self._entries:
+                return
+            self._entries[prefix] = (prefix_ids, past_key_values)
+            self._tokens += size
+            while self._tokens > self.max_tokens:
+                _, (old_ids, _) = self._entries.popitem(last=False)
+                self._tokens -= old_ids.shape[-1]
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens = 0
 
-def format_messages(messages: List[Dict[str, str]], tokenizer) -> str:
-    """Formatta messaggi per il modello"""
-    if hasattr(tokenizer, 'apply_chat_template'):
-        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-    else:
-        # Fallback generico
-        formatted = ""
-        for msg in messages:
-            role = msg["role"]
-            content = msg["content"]
-            if role == "system":
-                formatted += f"Sistema: {content}\n\n"
-            elif role == "user":
-                formatted += f"Utente: {content}\n"
-            elif role == "assistant":
-                formatted += f"Assistente: {content}\n\n"
-        return formatted
+@dataclass
+class GenerationTiming:
+    """Misure di una chiamata a generate, compilate dal motore quando richieste"""
+    prompt_tokens: List[int] = field(default_factory=list)
+    new_tokens: List[int] = field(default_factory=list)
+    prefill_seconds: float = 0.0
+    decode_seconds: float = 0.0
 
-def build_legacy_chain(llm, task_config: TaskConfig) -> LLMChain:
-    """Crea chain per modelli legacy"""
-    parts = [task_config.system_prompt + "\n\nESEMPI:"]
+class FirstTokenTimer(transformers.StoppingCriteria):
+    """Registra l'istante del primo token generato (fine del prefill), senza mai interrompere la generazione"""
+    
+    def __init__(self):
+        self.first_token_at: Optional[float] = None
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class GenerationEngine:
+    """
+    Motore di generazione unico condiviso da tutti i task: possiede modello
+    e tokenizer, mentre i parametri di generazione arrivano con ogni richiesta.
+    """
     
-    for ex in task_config.examples[:8]:
-        example_parts = []
+    def __init__(self, model, tokenizer, device: str, draft_model=None, draft_tokenizer=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.prefix_cache = PrefixCache()
+        # Esecuzione compilata / KV-cache statica (vedi configure_compilation)
+        self.compile_mode = ""
+        self.compile_config = None
+        self._static_cache: Optional[Tuple[int, Any]] = None
+        # Il padding dei batch è fatto con tokenizer.pad (vedi _encode_padded): niente avviso
+        tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
         
-        # Input fields
-        for field in task_config.input_fields:
-            if field in ex:
-                field_name = field.replace("_", " ").title()
-                example_parts.append(f"{field_name}: {ex[field]}")
+        # Decodifica speculativa: i forward pass dei due modelli vengono contati per
+        # stimare il tasso di accettazione dei token proposti dal draft
+        self.draft_model = draft_model
+        self.draft_tokenizer = draft_tokenizer
+        self._forward_calls = {"model": 0, "draft": 0}
+        if draft_model is not None:
+            model.register_forward_hook(self._counter("model"))
+            draft_model.register_forward_hook(self._counter("draft"))
+    
+    def _counter(self, name: str):
+        def hook(module, inputs, output):
+            self._forward_calls[name] += 1
+        return hook
+    
+    def generation_kwargs(self, params: GenerationParams) -> Dict[str, Any]:
+        """Traduce i GenerationParams negli argomenti di model.generate"""
+        do_sample = params.do_sample and params.temperature > 0
+        kwargs = {
+            "max_new_tokens": params.max_new_tokens,
+            "do_sample": do_sample,
+            "pad_token_id": self.tokenizer.pad_token_id,
+            "eos_token_id": self.tokenizer.eos_token_id,
+        }
+        if do_sample:
+            kwargs["temperature"] = params.temperature
+            kwargs["top_p"] = params.top_p
+        return kwargs
+    
+    def _prepare_generate(self, params: GenerationParams, prompt_len: Optional[int] = None) -> Dict[str, Any]:
+        gen_kwargs = self.generation_kwargs(params)
+        if params.early_stop:
+            # Interrompe ogni sequenza appena l'output è completo
+            gen_kwargs["stopping_criteria"] = transformers.StoppingCriteriaList(
+                [OutputStoppingCriteria(self.tokenizer, params, prompt_len)]
+            )
+        if params.seed is not None:
+            torch.manual_seed(params.seed)
+        return gen_kwargs
+    
+    def configure_compilation(self, mode: str):
+        """
+        Attiva l'esecuzione compilata: con "static" la generazione usa una KV-cache statica
+        preallocata (riusata tra le chiamate), con "compile" in più il forward dei passi di
+        decodifica viene compilato con torch.compile (il prefill resta eager). Gli artefatti di
+        Inductor sono salvati in COMPILE_CACHE_DIR. Se qualcosa fallisce si torna a eager.
+        """
+        if mode not in COMPILE_MODES:
+            print(f"⚠️ COMPILE_MODE '{mode}' non valido (static o compile): esecuzione eager")
+            return
+        if mode == "compile":
+            if COMPILE_CACHE_DIR:
+                try:
+                    pathlib.Path(COMPILE_CACHE_DIR).mkdir(parents=True, exist_ok=True)
+                    os.environ["TORCHINDUCTOR_CACHE_DIR"] = COMPILE_CACHE_DIR
+                except OSError as e:
+                    print(f"⚠️ Cache di compilazione non utilizzabile ({COMPILE_CACHE_DIR}): {e}")
+            # "reduce-overhead" usa i CUDA graph, su CPU si compila in modalità standard
+            compile_config = transformers.CompileConfig(
+                mode="reduce-overhead" if self.device == "cuda" else "default"
+            )
+            if self.device != "cuda":
+                # Fuori da CUDA generate compila solo con _compile_all_devices, attributo privato di
+                # CompileConfig (transformers 4.56): se una versione futura lo rimuove non si può
+                # forzare la compilazione e si resta sulla sola cache statica
+                if not hasattr(compile_config, "_compile_all_devices"):
+                    print("⚠️ transformers non permette di compilare su questo device: esecuzione static")
+                    compile_config, mode = None, "static"
+                else:
+                    compile_config._compile_all_devices = True
+            if compile_config is not None:
+                torch._dynamo.config.disable = False
+                self.compile_config = compile_config
+        self.compile_mode = mode
+        cache_dir = os.environ.get("TORCHINDUCTOR_CACHE_DIR", "-") if mode == "compile" else "-"
+        print(f"⚙️  Esecuzione: {mode} (cache di compilazione: {cache_dir})")
+    
+    def disable_compilation(self, error: Exception):
+        """Torna all'esecuzione eager dopo un errore della modalità compilata"""
+        print(f"⚠️ Esecuzione {self.compile_mode} fallita, si torna a eager: {error}")
+        self.compile_mode, self.compile_config, self._static_cache = "", None, None
+        self.model.__dict__.pop("_compiled_call", None)
+        METRICS.compile_fallbacks.inc()
+    
+    def _static_generate_kwargs(self, inputs: Dict[str, Any], gen_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Argomenti di generate con la KV-cache statica: la cache è riusata finché batch e
+        lunghezza lo consentono (stessi tensori, quindi nessuna ricompilazione) e, se c'è,
+        viene riempita con la KV-cache del prefisso già replicata sul batch.
+        """
+        batch_size, input_len = inputs["input_ids"].shape
+        needed = input_len + gen_kwargs["max_new_tokens"]
+        if (self._static_cache is None or self._static_cache[0] != batch_size
+                or self._static_cache[1].max_cache_len < needed):
+            length = -(-needed // STATIC_CACHE_BUCKET) * STATIC_CACHE_BUCKET
+            self._static_cache = (batch_size, transformers.StaticCache(config=self.model.config, max_cache_len=length))
+        cache = self._static_cache[1]
+        cache.reset()
         
-        # Outputs
-        for output_name in task_config.outputs:
-            if output_name in ex:
-                output_label = output_name.replace("_", " ").title()
-                example_parts.append(f"{output_label}: {ex[output_name]}")
+        prefix_kv = gen_kwargs.get("past_key_values")
+        if prefix_kv is not None:
+            positions = torch.arange(prefix_kv.get_seq_length(), device=self.model.device)
+            for idx, layer in enumerate(prefix_kv.layers):
+                cache.update(layer.keys, layer.values, idx, {"cache_position": positions})
         
-        parts.append("\n".join(example_parts))
+        kwargs = dict(gen_kwargs, past_key_values=cache)
+        if self.compile_config is not None:
+            kwargs["compile_config"] = self.compile_config
+        return kwargs
     
-    base_prompt = "\n\n".join(parts)
+    def _model_generate(self, inputs: Dict[str, Any], gen_kwargs: Dict[str, Any]):
+        """model.generate in modalità compilata se attiva (non con il draft), altrimenti eager"""
+        if self.compile_mode and "assistant_model" not in gen_kwargs:
+            try:
+                with torch.inference_mode():
+                    return self.model.generate(**inputs, **self._static_generate_kwargs(inputs, gen_kwargs))
+            except Exception as e:
+                self.disable_compilation(e)
+        with torch.inference_mode():
+            return self.model.generate(**inputs, **gen_kwargs)
     
-    # Template con placeholders
-    template_parts = [base_prompt, "\n\nNUOVA VALUTAZIONE:"]
-    for field in task_config.input_fields:
-        field_name = field.replace("_", " ").title()
-        template_parts.append(f"{field_name}: {{{field}}}")
+    def _run_generate(self, inputs: Dict[str, Any], gen_kwargs: Dict[str, Any],
+                      timing: Optional[GenerationTiming] = None):
+        """model.generate, misurando prefill e decodifica se è passato un GenerationTiming"""
+        if timing is None:
+            return self._model_generate(inputs, gen_kwargs)
+        
+        timer = FirstTokenTimer()
+        criteria = gen_kwargs.pop("stopping_criteria", None) or transformers.StoppingCriteriaList()
+        criteria.append(timer)
+        start = time.perf_counter()
+        output_ids = self._model_generate(inputs, dict(gen_kwargs, stopping_criteria=criteria))
+        end = time.perf_counter()
+        
+        first_token_at = timer.first_token_at or end
+        prompt_len = inputs["input_ids"].shape[1]
+        timing.prefill_seconds = first_token_at - start
+        timing.decode_seconds = end - first_token_at
+        timing.prompt_tokens = inputs["attention_mask"].sum(dim=1).tolist()
+        timing.new_tokens = [self._count_new_tokens(ids[prompt_len:]) for ids in output_ids]
+        return output_ids
     
-    # Aggiungi prompt per ogni output atteso
-    for output_name in task_config.outputs:
-        output_label = output_name.replace("_", " ").title()
-        template_parts.append(f"{output_label}: ")
+    def _count_new_tokens(self, generated) -> int:
+        """Token generati fino al primo EOS compreso (il resto è padding del batch)"""
+        eos = self.tokenizer.eos_token_id
+        eos_ids = set(eos) if isinstance(eos, (list, tuple)) else {eos}
+        for i, token in enumerate(generated.tolist()):
+            if token in eos_ids:
+                return i + 1
+        return len(generated)
     
-    template = "\n".join(template_parts)
+    def _encode_padded(self, texts: List[str], **kwargs):
+        """
+        Tokenizza e applica il padding (a sinistra) in Python: con padding=True il tokenizer
+        fast modificherebbe il proprio stato interno, mentre l'event loop lo sta usando per
+        compilare prompt e contare token ("Already borrowed")
+        """
+        encoded = self.tokenizer(texts, **kwargs)
+        return self.tokenizer.pad(encoded, return_tensors="pt")
     
-    return LLMChain(
-        llm=llm,
-        prompt=PromptTemplate(input_variables=task_config.input_fields, template=template)
-    )
+    def _decode(self, output_ids, prompt_len: int, params: GenerationParams) -> List[str]:
+        # Con il padding a sinistra i token generati iniziano tutti dalla stessa colonna
+        return [
+            trim_output(self.tokenizer.decode(ids[prompt_len:], skip_special_tokens=True), params)
+            for ids in output_ids
+        ]
+    
+    def generate_batch(self, prompts: List[str], params: GenerationParams,
+                       prefix: Optional[str] = None, timing: Optional[GenerationTiming] = None) -> List[str]:
+        """
+        Genera le risposte per più prompt con una sola chiamata a generate (padding a sinistra).
+        Se tutti i prompt iniziano con lo stesso prefisso statico, riparte dalla sua KV-cache.
+        """
+        if prefix and self.prefix_cache.enabled and all(p.startswith(prefix) for p in prompts):
+            try:
+                return self._generate_from_prefix(prefix, [p[len(prefix):] for p in prompts], params, timing)
+            except Exception as e:
+                print(f"⚠️ Prefix cache non utilizzabile, generazione completa: {e}")
+        
+        encoded = self._encode_padded(prompts)
+        inputs = {
+            "input_ids": encoded["input_ids"].to(self.model.device),
+            "attention_mask": encoded["attention_mask"].to(self.model.device),
+        }
+        
+        gen_kwargs = self._prepare_generate(params, inputs["input_ids"].shape[1])
+        output_ids = self._run_generate(inputs, gen_kwargs, timing)
+        
+        return self._decode(output_ids, inputs["input_ids"].shape[1], params)
+    
+    def generate_assisted(self, prompt: str, params: GenerationParams,
+                          timing: Optional[GenerationTiming] = None) -> Tuple[str, "SpeculativeRun"]:
+        """
+        Generazione assistita dal modello draft (un prompt alla volta): il draft propone
+        più token, il modello principale li verifica con un solo forward pass.
+        """
+        encoded = self.tokenizer(prompt, return_tensors="pt")
+        inputs = {
+            "input_ids": encoded["input_ids"].to(self.model.device),
+            "attention_mask": encoded["attention_mask"].to(self.model.device),
+        }
+        
+        gen_kwargs = self._prepare_generate(params, inputs["input_ids"].shape[1])
+        gen_kwargs["assistant_model"] = self.draft_model
+        if self.draft_tokenizer is not None:
+            gen_kwargs["tokenizer"] = self.tokenizer
+            gen_kwargs["assistant_tokenizer"] = self.draft_tokenizer
+        
+        calls_before = dict(self._forward_calls)
+        start = time.perf_counter()
+        output_ids = self._run_generate(inputs, gen_kwargs, timing)
+        elapsed = time.perf_counter() - start
+        
+        prompt_len = inputs["input_ids"].shape[1]
+        run = SpeculativeRun(
+            new_tokens=output_ids.shape[1] - prompt_len,
+            model_passes=self._forward_calls["model"] - calls_before["model"],
+            draft_tokens=self._forward_calls["draft"] - calls_before["draft"],
+            seconds=elapsed,
+        )
+        return self._decode(output_ids, prompt_len, params)[0], run
+    
+    def _prefix_entry(self, prefix: str) -> Tuple[Any, Any]:
+        """Restituisce (token ids, past_key_values) del prefisso, calcolandoli al primo uso"""
+        entry = self.prefix_cache.get(prefix)
+        if entry is None:
+            prefix_ids = self.tokenizer(prefix, return_tensors="pt")["input_ids"].to(self.model.device)
+            with torch.inference_mode():
+                out = self.model(input_ids=prefix_ids, use_cache=True)
+            entry = (prefix_ids, out.past_key_values)
+            self.prefix_cache.put(prefix, *entry)
+            print(f"💾 Prefisso in cache: {prefix_ids.shape[-1]} token")
+        return entry
+    
+    def _generate_from_prefix(self, prefix: str, suffixes: List[str], params: GenerationParams,
+                              timing: Optional[GenerationTiming] = None) -> List[str]:
+        """
+        Genera partendo dalla KV-cache del prefisso: viene fatto il prefill dei soli suffissi.
+        I suffissi sono paddati a sinistra, quindi il padding resta tra prefisso e suffisso
+        ed è mascherato dall'attention mask.
+        """
+        prefix_ids, prefix_kv = self._prefix_entry(prefix)
+        batch_size = len(suffixes)
+        
+        encoded = self._encode_padded(suffixes, add_special_tokens=False)
+        suffix_ids = encoded["input_ids"].to(self.model.device)
+        suffix_mask = encoded["attention_mask"].to(self.model.device)
+        
+        input_ids = torch.cat([prefix_ids.expand(batch_size, -1), suffix_ids], dim=1)
+        attention_mask = torch.cat([torch.ones_like(prefix_ids).expand(batch_size, -1), suffix_mask], dim=1)
+        
+        # La generate estende la cache: si lavora su una copia
+        past_key_values = copy.deepcopy(prefix_kv)
+        if batch_size > 1:
+            past_key_values.batch_repeat_interleave(batch_size)
+        
+        gen_kwargs = self._prepare_generate(params, input_ids.shape[1])
+        gen_kwargs["past_key_values"] = past_key_values
+        output_ids = self._run_generate(
+            {"input_ids": input_ids, "attention_mask": attention_mask}, gen_kwargs, timing
+        )
+        
+        return self._decode(output_ids, input_ids.shape[1], params)
+    
+    def score_continuations(self, prompt: str, continuations: List[str],
+                            prefix: Optional[str] = None) -> List[float]:
+        """
+        Log-probabilità di ciascuna continuazione dato il prompt, calcolate con un
+        solo forward pass (una riga per continuazione, padding a destra).
+        Se il prompt inizia con il prefisso statico del task, riparte dalla sua KV-cache.
+        """
+        past_key_values = None
+        use_prefix = bool(prefix) and self.prefix_cache.enabled and prompt.startswith(prefix)
+        if use_prefix:
+            prefix_ids, prefix_kv = self._prefix_entry(prefix)
+            context = prompt[len(prefix):]
+        else:
+            context = prompt
+        
+        # Contesto ed etichetta tokenizzati insieme, come nel testo generato: tokenizzati a parte, uno
+        # spazio finale del contesto (es. "Bool: ") diventerebbe un token a sé invece di unirsi all'etichetta.
+        # Si valuta dal primo token in cui una riga diverge dal contesto tokenizzato da solo: lo stesso
+        # punto per tutte le etichette, così ogni punteggio copre lo stesso testo
+        def encode(text: str) -> List[int]:
+            return self.tokenizer(text, add_special_tokens=not use_prefix)["input_ids"]
+        
+        def shared(row: List[int]) -> int:
+            """Token iniziali della riga uguali a quelli del contesto"""
+            for j, (a, b) in enumerate(zip(row, context_ids)):
+                if a != b:
+                    return j
+            return min(len(row), len(context_ids))
+        
+        context_ids = encode(context)
+        rows = [encode(context + c) for c in continuations]
+        start = min(shared(row) for row in rows)
+        # Almeno un token prima (i logit che predicono il primo valutato) e uno valutato per riga
+        start = max(1, min([start] + [len(row) - 1 for row in rows]))
+        width = max(len(row) for row in rows)
+        pad_id = self.tokenizer.pad_token_id
+        
+        input_ids = torch.tensor([row + [pad_id] * (width - len(row)) for row in rows], device=self.model.device)
+        attention_mask = torch.tensor(
+            [[1] * len(row) + [0] * (width - len(row)) for row in rows], device=self.model.device
+        )
+        
+        if use_prefix:
+            batch_size = len(rows)
+            past_key_values = copy.deepcopy(prefix_kv)
+            if batch_size > 1:
+                past_key_values.batch_repeat_interleave(batch_size)
+            attention_mask = torch.cat(
+                [torch.ones_like(prefix_ids).expand(batch_size, -1), attention_mask], dim=1
+            )
+        
+        with torch.inference_mode():
+            logits = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                use_cache=past_key_values is not None,
+            ).logits.float()
+        
+        # Il token in posizione j è predetto dai logit in posizione j-1
+        log_probs = torch.log_softmax(logits[:, :-1], dim=-1)
+        scores = []
+        for i, row in enumerate(rows):
+            targets = torch.tensor(row[start:], device=log_probs.device)
+            positions = torch.arange(start - 1, len(row) - 1, device=log_probs.device)
+            scores.append(log_probs[i, positions, targets].sum().item())
+        return scores
+    
+    def classify(self, prompt: str, classification: ClassificationConfig,
+                 prefix: Optional[str] = None) -> Tuple[str, float, str]:
+        """Sceglie l'etichetta più probabile: restituisce (etichetta, probabilità, testo della risposta)"""
+        continuations = classification.continuations()
+        scores = torch.tensor(self.score_continuations(prompt, continuations, prefix))
+        probs = torch.softmax(scores, dim=0)
+        best = int(torch.argmax(probs))
+        return classification.labels[best], float(probs[best]), continuations[best]
+    
+    def kv_bytes_per_token(self) -> int:
+        """Memoria occupata dalla KV-cache per ogni token di una sequenza"""
+        cfg = self.model.config
+        layers = getattr(cfg, "num_hidden_layers", 32)
+        heads = getattr(cfg, "num_attention_heads", 32)
+        kv_heads = getattr(cfg, "num_key_value_heads", None) or heads
+        head_dim = getattr(cfg, "head_dim", None) or cfg.hidden_size // heads
+        dtype = self.model.dtype if self.model.dtype.is_floating_point else torch.bfloat16
+        return 2 * layers * kv_heads * head_dim * torch.finfo(dtype).bits // 8
+    
+    def available_memory(self) -> Optional[int]:
+        """Memoria libera sul device del modello (None se non determinabile)"""
+        try:
+            if self.device == "cuda":
+                return torch.cuda.mem_get_info()[0]
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (AttributeError, ValueError, OSError, RuntimeError):
+            return None
+    
+    def memory_chunk_size(self, tokens_per_item: int, limit: int = BATCH_CHUNK_SIZE) -> int:
+        """Quante sequenze da tokens_per_item token stanno in metà della memoria libera (max limit)"""
+        free = self.available_memory()
+        if free is None:
+            return limit
+        fit = (free // 2) // max(1, tokens_per_item * self.kv_bytes_per_token())
+        return int(max(1, min(limit, fit)))
+
+# ---------------------------------------------------------------------------
+# METRICHE
+# ---------------------------------------------------------------------------
+
+# Bucket (secondi) degli istogrammi di latenza
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    """Etichette nel formato di Prometheus: {nome="valore",...}"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value: float) -> str:
+    """Valore di un campione: interi senza decimali, float con piena precisione"""
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Metric:
+    """Metrica con etichette, esportata nel formato testuale di Prometheus"""
+    kind = "untyped"
+    
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[Tuple[str, str], ...], Any] = {}
+    
+    @staticmethod
+    def _key(labels: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+    
+    def _add(self, amount: float, labels: Dict[str, Any]):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{format_labels(key)} {format_value(value)}" for key, value in self._values.items()]
+    
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+
+class Counter(Metric):
+    kind = "counter"
+    
+    def inc(self, amount: float = 1, **labels):
+        self._add(amount, labels)
+
+class Gauge(Metric):
+    kind = "gauge"
+    
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+    
+    def inc(self, amount: float = 1, **labels):
+        self._add(amount, labels)
+    
+    def dec(self, amount: float = 1, **labels):
+        self._add(-amount, labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+    
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+    
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # Conteggi per bucket (cumulativi), numero di osservazioni e somma
+            state = self._values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += 1
+            state[2] += value
+    
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, count, total) in self._values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+class ServerMetrics:
+    """Metriche del server per task e di processo, esposte da /metrics"""
+    
+    def __init__(self):
+        self.requests = Counter("llm_requests_total", "Richieste ricevute per task")
+        self.errors = Counter("llm_request_errors_total", "Richieste terminate con errore, per task e status HTTP")
+        self.queue_wait = Histogram("llm_queue_wait_seconds", "Attesa nella coda di inferenza")
+        self.priority_queue_wait = Histogram("llm_priority_queue_wait_seconds", "Attesa nella coda di inferenza per classe di priorità")
+        self.request_duration = Histogram("llm_priority_request_seconds", "Durata delle richieste ai task per classe di priorità")
+        self.priority_promotions = Counter("llm_priority_promotions_total", "Richieste servite prima delle classi più prioritarie per attesa eccessiva")
+        self.cancelled = Counter("llm_cancelled_requests_total", "Richieste annullate dal chiamante prima dell'esecuzione, scartate dalla coda")
+        self.prefill = Histogram("llm_prefill_seconds", "Durata del prefill (fino al primo token generato)")
+        self.decode = Histogram("llm_decode_seconds", "Durata della decodifica (dal primo all'ultimo token)")
+        self.inference = Histogram("llm_inference_seconds", "Durata complessiva dell'inferenza (generazione o chiamata)")
+        self.prompt_tokens = Counter("llm_prompt_tokens_total", "Token di prompt elaborati")
+        self.generated_tokens = Counter("llm_generated_tokens_total", "Token generati")
+        self.tokens_per_second = Gauge("llm_decode_tokens_per_second", "Velocità di decodifica dell'ultima generazione")
+        self.extraction_failures = Counter("llm_extraction_failures_total", "Output non estratti (None) per task e output")
+        self.cache_lookups = Counter("llm_response_cache_lookups_total", "Ricerche nella cache delle risposte per esito")
+        self.coalesced = Counter("llm_coalesced_requests_total", "Richieste servite dal risultato di una identica già in corso")
+        self.draft_tokens = Counter("llm_speculative_draft_tokens_total", "Token proposti dal modello draft")
+        self.accepted_tokens = Counter("llm_speculative_accepted_tokens_total", "Token del draft accettati")
+        self.compile_fallbacks = Counter("llm_compile_fallbacks_total", "Ritorni all'esecuzione eager dopo un errore di compilazione")
+        self.truncated = Counter("llm_truncated_generations_total", "Generazioni interrotte da max_new_tokens")
+        self.token_budget = Gauge("llm_generation_budget_tokens", "Budget adattivo di max_new_tokens per task")
+        self.active_generations = Gauge("llm_active_generations", "Sequenze in generazione in questo momento")
+        self.queue_depth = Gauge("llm_queue_depth", "Richieste in attesa nella coda di inferenza")
+        self.resident_memory = Gauge("process_resident_memory_bytes", "Memoria residente del processo")
+    
+    def record_generation(self, task_name: str, prompt_tokens: int, new_tokens: int,
+                          prefill_seconds: float, decode_seconds: float):
+        self.prompt_tokens.inc(prompt_tokens, task=task_name)
+        self.generated_tokens.inc(new_tokens, task=task_name)
+        self.prefill.observe(prefill_seconds, task=task_name)
+        self.decode.observe(decode_seconds, task=task_name)
+        if decode_seconds > 0 and new_tokens > 1:
+            self.tokens_per_second.set(round((new_tokens - 1) / decode_seconds, 2), task=task_name)
+    
+    def render(self) -> str:
+        rss = process_rss_bytes()
+        if rss is not None:
+            self.resident_memory.set(rss)
+        lines = []
+        for metric in vars(self).values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+METRICS = ServerMetrics()
+
+# ---------------------------------------------------------------------------
+# BATCH SCHEDULER
+# ---------------------------------------------------------------------------
+
+class QueueFullError(Exception):
+    """La coda di inferenza è piena: la richiesta va ritentata più tardi"""
+
+@dataclass
+class PendingGeneration:
+    """Richiesta di generazione in attesa di essere inserita in un batch"""
+    task_name: str
+    prompt: str
+    params: GenerationParams
+    future: Future
+    prefix: Optional[str] = None
+    priority: str = DEFAULT_PRIORITY
+    enqueued_at: float = field(default_factory=time.monotonic)
+    
+    @property
+    def batch_key(self) -> Any:
+        # Richieste (anche di task diversi) con gli stessi parametri finiscono nello stesso batch; quelle
+        # campionate con seed girano da sole, perché in un batch i numeri casuali estratti dipendono
+        # dalle altre righe e dal padding e l'output non sarebbe riproducibile
+        return (self.params, id(self)) if self.params.seeded else self.params
+
+def settle(future: Future, result: Any = None, error: Optional[BaseException] = None):
+    """Completa il Future di una richiesta, se nel frattempo non è già stato completato o annullato"""
+    if future.done():
+        return
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        # Annullato tra il controllo e il completamento
+        pass
+
+@dataclass
+class PendingCall:
+    """Lavoro generico (es. una classificazione) da eseguire sul thread di inferenza"""
+    task_name: str
+    fn: Callable[[], Any]
+    future: Future
+    priority: str = DEFAULT_PRIORITY
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+class QueueStats:
+    """Tempi di attesa in coda, per task"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: Dict[str, Dict[str, float]] = {}
+    
+    def record(self, task_name: str, wait: float):
+        with self._lock:
+            stats = self._tasks.setdefault(task_name, {"requests": 0, "total_wait": 0.0, "max_wait": 0.0})
+            stats["requests"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["last_wait"] = wait
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {
+                task_name: {
+                    "requests": int(stats["requests"]),
+                    "avg_wait_ms": round(stats["total_wait"] / stats["requests"] * 1000, 1),
+                    "max_wait_ms": round(stats["max_wait"] * 1000, 1),
+                    "last_wait_ms": round(stats["last_wait"] * 1000, 1),
+                }
+                for task_name, stats in self._tasks.items()
+            }
+
+@dataclass
+class SpeculativeRun:
+    """Conteggi di una generazione: token generati, forward pass del modello e token proposti dal draft"""
+    new_tokens: int
+    model_passes: int
+    draft_tokens: int
+    seconds: float
+    
+    @property
+    def accepted(self) -> int:
+        # Ogni forward pass del modello principale produce un token proprio più quelli accettati del draft
+        return max(0, self.new_tokens - self.model_passes)
+
+class SpeculativeStats:
+    """Tasso di accettazione e speedup della decodifica speculativa, per task"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: Dict[str, Dict[str, float]] = {}
+    
+    def _task(self, task_name: str) -> Dict[str, float]:
+        return self._tasks.setdefault(task_name, {
+            "requests": 0, "new_tokens": 0, "seconds": 0.0, "model_passes": 0, "draft_tokens": 0,
+            "accepted": 0, "baseline_requests": 0, "baseline_tokens": 0, "baseline_seconds": 0.0,
+        })
+    
+    def record(self, task_name: str, run: SpeculativeRun):
+        with self._lock:
+            stats = self._task(task_name)
+            stats["requests"] += 1
+            stats["new_tokens"] += run.new_tokens
+            stats["seconds"] += run.seconds
+            stats["model_passes"] += run.model_passes
+            stats["draft_tokens"] += run.draft_tokens
+            stats["accepted"] += run.accepted
+    
+    def record_baseline(self, task_name: str, new_tokens: int, seconds: float):
+        with self._lock:
+            stats = self._task(task_name)
+            stats["baseline_requests"] += 1
+            stats["baseline_tokens"] += new_tokens
+            stats["baseline_seconds"] += seconds
+    
+    def needs_baseline(self, task_name: str) -> bool:
+        """True se la prossima richiesta del task deve girare senza draft (misura di riferimento)"""
+        if DRAFT_BASELINE_EVERY <= 0:
+            return False
+        with self._lock:
+            stats = self._task(task_name)
+            return (stats["requests"] + stats["baseline_requests"]) % DRAFT_BASELINE_EVERY == DRAFT_BASELINE_EVERY - 1
+    
+    def task_snapshot(self, task_name: str) -> Dict[str, Any]:
+        with self._lock:
+            stats = self._task(task_name)
+            speed = stats["new_tokens"] / stats["seconds"] if stats["seconds"] else None
+            baseline = stats["baseline_tokens"] / stats["baseline_seconds"] if stats["baseline_seconds"] else None
+            return {
+                "requests": int(stats["requests"]),
+                "acceptance_rate": round(stats["accepted"] / stats["draft_tokens"], 3) if stats["draft_tokens"] else None,
+                "tokens_per_pass": round(stats["new_tokens"] / stats["model_passes"], 2) if stats["model_passes"] else None,
+                "tokens_per_second": round(speed, 1) if speed else None,
+                "baseline_tokens_per_second": round(baseline, 1) if baseline else None,
+                "speedup": round(speed / baseline, 2) if speed and baseline else None,
+            }
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            task_names = list(self._tasks)
+        return {task_name: self.task_snapshot(task_name) for task_name in task_names}
+
+def percentile(values, q: float) -> float:
+    """Percentile q (0-100) con il metodo nearest-rank"""
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+class OutputLengthStats:
+    """
+    Lunghezze degli output per task: token generati e token / caratteri utili
+    (quelli che restano dopo stop e troncamenti). Dal percentile delle lunghezze
+    utili più un margine si ricava il budget di max_new_tokens del task.
+    """
+    # Il budget è arrotondato a multipli di BUDGET_STEP token per non frammentare i batch
+    BUDGET_STEP = 16
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tasks: Dict[str, Dict[str, Any]] = {}
+    
+    def _task(self, task_name: str) -> Dict[str, Any]:
+        return self._tasks.setdefault(task_name, {
+            "generated": deque(maxlen=ADAPTIVE_BUDGET_WINDOW),
+            "useful_tokens": deque(maxlen=ADAPTIVE_BUDGET_WINDOW),
+            "useful_chars": deque(maxlen=ADAPTIVE_BUDGET_WINDOW),
+            "truncated": 0,
+            "budget": None,
+        })
+    
+    def record_generated(self, task_name: str, new_tokens: int, max_new_tokens: int):
+        with self._lock:
+            stats = self._task(task_name)
+            stats["generated"].append(new_tokens)
+            if new_tokens >= max_new_tokens:
+                stats["truncated"] += 1
+                METRICS.truncated.inc(task=task_name)
+    
+    def record_useful(self, task_name: str, tokens: int, chars: int):
+        with self._lock:
+            stats = self._task(task_name)
+            stats["useful_tokens"].append(tokens)
+            stats["useful_chars"].append(chars)
+            if ADAPTIVE_BUDGET_PERCENTILE <= 0 or len(stats["useful_tokens"]) < ADAPTIVE_BUDGET_MIN_SAMPLES:
+                return
+            # Se il budget tronca troppi output il percentile lo raggiunge e il margine lo fa risalire
+            target = percentile(stats["useful_tokens"], ADAPTIVE_BUDGET_PERCENTILE) * (1 + ADAPTIVE_BUDGET_MARGIN)
+            budget = self.BUDGET_STEP * max(1, math.ceil(target / self.BUDGET_STEP))
+            if budget != stats["budget"]:
+                print(f"📏 Task '{task_name}' - budget max_new_tokens: {budget} "
+                      f"(p{ADAPTIVE_BUDGET_PERCENTILE:g} utile {target / (1 + ADAPTIVE_BUDGET_MARGIN):.0f} token)")
+                stats["budget"] = budget
+                METRICS.token_budget.set(budget, task=task_name)
+    
+    def budget(self, task_name: str, max_new_tokens: int) -> int:
+        """max_new_tokens da usare per il task: il budget appreso, mai oltre il limite configurato"""
+        with self._lock:
+            stats = self._tasks.get(task_name)
+            budget = stats["budget"] if stats is not None else None
+        return max_new_tokens if budget is None else min(budget, max_new_tokens)
+    
+    def reset(self, task_names: List[str]):
+        """Dimentica le lunghezze dei task indicati (es. prompt modificato)"""
+        with self._lock:
+            for task_name in task_names:
+                self._tasks.pop(task_name, None)
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            result = {}
+            for task_name, stats in self._tasks.items():
+                task = {"samples": len(stats["useful_tokens"]), "truncated": stats["truncated"], "budget": stats["budget"]}
+                for name in ("generated", "useful_tokens", "useful_chars"):
+                    if stats[name]:
+                        task[f"{name}_p50"] = percentile(stats[name], 50)
+                        task[f"{name}_p95"] = percentile(stats[name], 95)
+                result[task_name] = task
+            return result
+
+class BatchScheduler:
+    """
+    Worker di inferenza dedicato alimentato da una coda limitata: raccoglie le
+    richieste concorrenti per una breve finestra temporale (o fino a MAX_BATCH_SIZE)
+    e le esegue con un'unica generate batched, restituendo a ciascun chiamante il
+    proprio risultato. Gli endpoint restano liberi di servire altre richieste.
+    
+    La coda è divisa per classe di priorità: le richieste delle classi più urgenti
+    vengono servite per prime, quelle in attesa da oltre max_wait_ms passano davanti.
+    """
+    
+    def __init__(self, engine: GenerationEngine, window_ms: float = BATCH_WINDOW_MS,
+                 max_batch_size: int = MAX_BATCH_SIZE, max_queue_size: int = MAX_QUEUE_SIZE,
+                 max_wait_ms: float = PRIORITY_MAX_WAIT_MS):
+        self.engine = engine
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_queue_size = max_queue_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.stats = QueueStats()
+        self.speculative = SpeculativeStats()
+        self.lengths = OutputLengthStats()
+        self._queues: Dict[str, "deque[Union[PendingGeneration, PendingCall]]"] = {
+            name: deque() for name in PRIORITY_CLASSES
+        }
+        self._size = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._worker, name="batch-scheduler", daemon=True)
+    
+    def start(self):
+        self._thread.start()
+        print(f"🧮 Batch scheduler avviato - finestra {self.window * 1000:.0f}ms, "
+              f"batch max {self.max_batch_size}, coda max {self.max_queue_size}, "
+              f"attesa max per priorità {self.max_wait:g}s")
+    
+    @property
+    def depth(self) -> int:
+        return self._size
+    
+    def _enqueue(self, item: Union[PendingGeneration, PendingCall]) -> Future:
+        with self._cond:
+            # Le richieste della classe più urgente non vengono respinte per il lavoro meno prioritario in coda
+            queued = len(self._queues[item.priority]) if item.priority == PRIORITY_CLASSES[0] else self._size
+            if queued >= self.max_queue_size:
+                raise QueueFullError(f"Coda di inferenza piena ({self.max_queue_size} richieste)")
+            self._queues[item.priority].append(item)
+            self._size += 1
+            self._cond.notify()
+        return item.future
+    
+    def submit(self, task_name: str, prompt: str, params: GenerationParams,
+               prefix: Optional[str] = None, priority: str = DEFAULT_PRIORITY) -> Future:
+        """Accoda un prompt (con l'eventuale prefisso statico) e restituisce il Future con il testo generato"""
+        return self._enqueue(PendingGeneration(task_name, prompt, params, Future(), prefix, priority))
+    
+    def submit_call(self, task_name: str, fn: Callable[[], Any], priority: str = DEFAULT_PRIORITY) -> Future:
+        """Accoda una funzione da eseguire sul thread di inferenza"""
+        return self._enqueue(PendingCall(task_name, fn, Future(), priority))
+    
+    async def generate(self, task_name: str, prompt: str, params: GenerationParams,
+                       prefix: Optional[str] = None, priority: str = DEFAULT_PRIORITY) -> str:
+        """Versione awaitable di submit, da usare negli endpoint"""
+        return await asyncio.wrap_future(self.submit(task_name, prompt, params, prefix, priority))
+    
+    async def call(self, task_name: str, fn: Callable[[], Any], priority: str = DEFAULT_PRIORITY) -> Any:
+        """Versione awaitable di submit_call"""
+        return await asyncio.wrap_future(self.submit_call(task_name, fn, priority))
+    
+    def snapshot(self) -> Dict[str, Any]:
+        """Stato della coda per l'endpoint /queue"""
+        return {
+            "depth": self.depth,
+            "capacity": self.max_queue_size,
+            "priorities": {name: len(pending) for name, pending in self._queues.items()},
+            "tasks": self.stats.snapshot(),
+            "lengths": self.lengths.snapshot(),
+            **({"speculative": self.speculative.snapshot()} if self.engine.draft_model is not None else {}),
+        }
+    
+    def _pop(self) -> Union[PendingGeneration, PendingCall]:
+        """
+        Prossima richiesta (con il lock acquisito): la prima della classe più urgente, oppure
+        la più vecchia tra quelle in attesa da oltre max_wait
+        """
+        heads = [(name, pending[0]) for name, pending in self._queues.items() if pending]
+        now = time.monotonic()
+        starving = [head for head in heads if now - head[1].enqueued_at >= self.max_wait]
+        name = min(starving, key=lambda head: head[1].enqueued_at)[0] if starving else heads[0][0]
+        if name != heads[0][0]:
+            METRICS.priority_promotions.inc(priority=name)
+        self._size -= 1
+        return self._queues[name].popleft()
+    
+    def _collect(self) -> List[Union[PendingGeneration, PendingCall]]:
+        """Attende la prima richiesta, poi la finestra, e preleva il batch in ordine di priorità"""
+        with self._cond:
+            while self._size == 0:
+                self._cond.wait()
+            deadline = time.monotonic() + self.window
+            while self._size < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return [self._pop() for _ in range(min(self._size, self.max_batch_size))]
+    
+    def _requeue(self, items: List[PendingGeneration]):
+        """Rimette in testa alla propria coda (in ordine) richieste prelevate ma non eseguite"""
+        with self._cond:
+            for item in reversed(items):
+                self._queues[item.priority].appendleft(item)
+                self._size += 1
+    
+    def _is_assisted(self, item: Union[PendingGeneration, PendingCall]) -> bool:
+        return isinstance(item, PendingGeneration) and item.params.assisted and self.engine.draft_model is not None
+    
+    def _worker(self):
+        while True:
+            pending = []
+            try:
+                pending = self._collect()
+                self._run_cycle(pending)
+            except Exception as e:
+                # Un errore imprevisto fallisce solo le richieste del ciclo: il worker continua
+                print(f"❌ Errore nello scheduler: {e}")
+                traceback.print_exc()
+                for item in pending:
+                    # Solo quelle già prese in carico: le altre sono tornate in coda o annullate
+                    if item.future.running():
+                        settle(item.future, error=e)
+    
+    def _run_cycle(self, pending: List[Union[PendingGeneration, PendingCall]]):
+        # Le generazioni assistite girano una alla volta: se ne esegue una per ciclo e le altre
+        # tornano in coda, così il lavoro più urgente arrivato nel frattempo passa davanti
+        assisted = [item for item in pending if self._is_assisted(item)]
+        if len(assisted) > 1:
+            deferred = {id(item) for item in assisted[1:]}
+            pending = [item for item in pending if id(item) not in deferred]
+            self._requeue(assisted[1:])
+        
+        # Le richieste il cui chiamante ha già rinunciato (es. client disconnesso) non si eseguono;
+        # le altre diventano non annullabili, così il risultato si può sempre consegnare
+        running = [item for item in pending if item.future.set_running_or_notify_cancel()]
+        for item in pending:
+            if item.future.cancelled():
+                METRICS.cancelled.inc(task=item.task_name)
+        pending = running
+        
+        # Gruppi eseguiti nell'ordine della loro richiesta più prioritaria
+        now = time.monotonic()
+        groups: Dict[Any, List[Union[PendingGeneration, PendingCall]]] = {}
+        for item in pending:
+            wait = now - item.enqueued_at
+            self.stats.record(item.task_name, wait)
+            METRICS.queue_wait.observe(wait, task=item.task_name)
+            METRICS.priority_queue_wait.observe(wait, priority=item.priority)
+            key = id(item) if isinstance(item, PendingCall) else item.batch_key
+            groups.setdefault(key, []).append(item)
+        
+        for group in groups.values():
+            if isinstance(group[0], PendingCall):
+                self._run_call(group[0])
+            else:
+                self._run_group(group)
+    
+    def _run_call(self, call: PendingCall):
+        METRICS.active_generations.inc()
+        start = time.perf_counter()
+        try:
+            settle(call.future, call.fn())
+        except Exception as e:
+            print(f"❌ Errore in task '{call.task_name}': {e}")
+            traceback.print_exc()
+            settle(call.future, error=e)
+        finally:
+            METRICS.active_generations.dec()
+            METRICS.inference.observe(time.perf_counter() - start, task=call.task_name)
+    
+    def _run_group(self, group: List[PendingGeneration]):
+        if self._is_assisted(group[0]):
+            # Una sola per ciclo (vedi _worker)
+            self._run_assisted(group[0])
+            return
+        
+        tasks = sorted({item.task_name for item in group})
+        print(f"🧮 Batch di {len(group)} richieste - task: {tasks}")
+        timing = GenerationTiming()
+        METRICS.active_generations.inc(len(group))
+        try:
+            # La KV-cache del prefisso si usa solo se tutto il batch condivide lo stesso prefisso
+            prefixes = {item.prefix for item in group}
+            results = self.engine.generate_batch(
+                [item.prompt for item in group],
+                group[0].params,
+                prefix=prefixes.pop() if len(prefixes) == 1 else None,
+                timing=timing
+            )
+        except Exception as e:
+            print(f"❌ Errore nel batch {tasks}: {e}")
+            traceback.print_exc()
+            for item in group:
+                settle(item.future, error=e)
+            return
+        finally:
+            METRICS.active_generations.dec(len(group))
+        
+        for i, (item, result) in enumerate(zip(group, results)):
+            self._record(item, timing, i)
+            settle(item.future, result)
+    
+    def _record(self, item: PendingGeneration, timing: GenerationTiming, index: int = 0):
+        METRICS.record_generation(
+            item.task_name, timing.prompt_tokens[index], timing.new_tokens[index],
+            timing.prefill_seconds, timing.decode_seconds
+        )
+        METRICS.inference.observe(timing.prefill_seconds + timing.decode_seconds, task=item.task_name)
+        self.lengths.record_generated(item.task_name, timing.new_tokens[index], item.params.max_new_tokens)
+    
+    def _run_assisted(self, item: PendingGeneration):
+        """Generazione assistita dal draft; periodicamente senza draft per misurare lo speedup"""
+        timing = GenerationTiming()
+        METRICS.active_generations.inc()
+        try:
+            # Con il seed l'output dipende dal draft: le richieste con seed non fanno da riferimento
+            if not item.params.seeded and self.speculative.needs_baseline(item.task_name):
+                result = self.engine.generate_batch(
+                    [item.prompt], replace(item.params, assisted=False), timing=timing
+                )[0]
+                new_tokens, elapsed = timing.new_tokens[0], timing.prefill_seconds + timing.decode_seconds
+                self.speculative.record_baseline(item.task_name, new_tokens, elapsed)
+                print(f"🪶 Task '{item.task_name}' - riferimento senza draft: {new_tokens / elapsed:.1f} token/s")
+            else:
+                result, run = self.engine.generate_assisted(item.prompt, item.params, timing=timing)
+                self.speculative.record(item.task_name, run)
+                METRICS.draft_tokens.inc(run.draft_tokens, task=item.task_name)
+                METRICS.accepted_tokens.inc(run.accepted, task=item.task_name)
+                stats = self.speculative.task_snapshot(item.task_name)
+                print(f"🪶 Task '{item.task_name}' - {run.new_tokens} token in {run.seconds:.2f}s, "
+                      f"accettati {run.accepted}/{run.draft_tokens} proposti "
+                      f"(tasso medio {stats['acceptance_rate']}, speedup {stats['speedup']})")
+        except Exception as e:
+            print(f"❌ Errore in task '{item.task_name}': {e}")
+            traceback.print_exc()
+            settle(item.future, error=e)
+            return
+        finally:
+            METRICS.active_generations.dec()
+        self._record(item, timing)
+        settle(item.future, result)
+
+# ---------------------------------------------------------------------------
+# RESPONSE CACHE
+# ---------------------------------------------------------------------------
+
+def normalize_inputs(task_config: TaskConfig, input_data: Dict[str, Any]) -> Dict[str, str]:
+    """Campi di input del task normalizzati (spazi compattati) per il confronto tra richieste"""
+    return {
+        name: " ".join(str(input_data[name]).split())
+        for name in task_config.input_fields
+        if name in input_data
+    }
+
+def response_cache_key(task_config: TaskConfig, input_data: Dict[str, Any], params: GenerationParams) -> str:
+    """
+    Chiave di cache: task, input normalizzati, modello con quantizzazione ed esecuzione (e draft per
+    le richieste assistite), hash del template e parametri di generazione. Il livello su disco
+    sopravvive ai riavvii: cambiando uno di questi valori l'output può cambiare.
+    """
+    payload = {
+        "task": task_config.name,
+        "inputs": normalize_inputs(task_config, input_data),
+        "model": MODEL_ID,
+        "quant": QUANT,
+        "execution": COMPILE_MODE,
+        "draft": DRAFT_MODEL_ID if params.assisted else "",
+        "template": task_config.template_hash,
+        "params": params.__dict__,
+    }
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, ensure_ascii=False, default=list).encode("utf-8")
+    ).hexdigest()
+
+class ResponseCache:
+    """
+    Cache delle risposte a due livelli: LRU in memoria con TTL e livello
+    persistente su disco (un file JSON per chiave), che sopravvive ai riavvii.
+    Su disco la data di modifica di ogni file è la sua scadenza: la pulizia (all'avvio
+    e quando si supera max_disk_entries) elimina le voci scadute e poi quelle più
+    vicine alla scadenza, senza leggere i file.
+    """
+    
+    # Oltre il limite la pulizia riporta le voci su disco a questa frazione del limite
+    DISK_SWEEP_TARGET = 0.9
+    # File temporanei più vecchi di così (secondi) sono resti di scritture interrotte
+    STALE_TMP_SECONDS = 3600
+    
+    def __init__(self, max_entries: int = RESPONSE_CACHE_SIZE, directory: Optional[str] = RESPONSE_CACHE_DIR,
+                 max_disk_entries: int = RESPONSE_CACHE_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.directory = pathlib.Path(directory) if directory else None
+        self._disk_entries = 0
+        self._sweeping = False
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {}
+        self.misses: Dict[str, int] = {}
+        
+        if self.directory is not None:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                print(f"⚠️ Cache su disco non disponibile in '{self.directory}': {e}")
+                self.directory = None
+        if self.directory is not None:
+            self._sweeping = True
+            threading.Thread(target=self._sweep_disk, name="response-cache-sweep", daemon=True).start()
+    
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / key[:2] / f"{key}.json"
+    
+    def _get_memory(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._memory[key]
+                return None
+            self._memory.move_to_end(key)
+            return value
+    
+    def _put_memory(self, key: str, value: Dict[str, Any], expires_at: float):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+    
+    def _get_disk(self, key: str) -> Optional[Tuple[float, Dict[str, Any]]]:
+        path = self._path(key)
+        try:
+            entry = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] < time.time():
+            path.unlink(missing_ok=True)
+            return None
+        return entry["expires_at"], entry["value"]
+    
+    def _put_disk(self, key: str, value: Dict[str, Any], expires_at: float):
+        path = self._path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            # File temporaneo per processo: più worker possono scrivere la stessa chiave
+            tmp = path.with_suffix(f".{os.getpid()}.tmp")
+            tmp.write_text(json.dumps({"expires_at": expires_at, "value": value}, ensure_ascii=False), "utf-8")
+            tmp.replace(path)
+            os.utime(path, (expires_at, expires_at))
+        except OSError as e:
+            print(f"⚠️ Scrittura cache su disco fallita: {e}")
+            return
+        with self._lock:
+            self._disk_entries += 1
+            full = 0 < self.max_disk_entries < self._disk_entries and not self._sweeping
+            self._sweeping = self._sweeping or full
+        if full:
+            self._sweep_disk()
+    
+    def _sweep_disk(self):
+        """Elimina dal disco le voci scadute e, oltre il limite, quelle più vicine alla scadenza"""
+        try:
+            self._sweep_disk_entries()
+        finally:
+            with self._lock:
+                self._sweeping = False
+    
+    def _sweep_disk_entries(self):
+        now = time.time()
+        expired, entries = 0, []
+        try:
+            for path in self.directory.glob("*/*"):
+                try:
+                    # Per i file temporanei mtime è l'istante della scrittura, per le voci la scadenza
+                    mtime = path.stat().st_mtime
+                    if path.suffix == ".tmp":
+                        if mtime < now - self.STALE_TMP_SECONDS:
+                            path.unlink(missing_ok=True)
+                    elif mtime < now:
+                        path.unlink(missing_ok=True)
+                        expired += 1
+                    else:
+                        entries.append((mtime, path))
+                except OSError:
+                    continue
+        except OSError as e:
+            print(f"⚠️ Pulizia cache su disco fallita: {e}")
+            return
+        
+        evicted = 0
+        if 0 < self.max_disk_entries < len(entries):
+            entries.sort()
+            evicted = len(entries) - int(self.max_disk_entries * self.DISK_SWEEP_TARGET)
+            for _, path in entries[:evicted]:
+                path.unlink(missing_ok=True)
+            entries = entries[evicted:]
+        with self._lock:
+            self._disk_entries = len(entries)
+        if expired or evicted:
+            print(f"🧹 Cache su disco: {expired} voci scadute e {evicted} oltre il limite rimosse, {len(entries)} rimaste")
+    
+    async def get(self, task_name: str, key: str) -> Optional[Dict[str, Any]]:
+        """Cerca la risposta prima in memoria e poi su disco (fuori dall'event loop)"""
+        value = self._get_memory(key)
+        if value is None and self.directory is not None:
+            entry = await asyncio.to_thread(self._get_disk, key)
+            if entry is not None:
+                expires_at, value = entry
+                self._put_memory(key, value, expires_at)
+        
+        counter = self.hits if value is not None else self.misses
+        counter[task_name] = counter.get(task_name, 0) + 1
+        METRICS.cache_lookups.inc(task=task_name, result="hit" if value is not None else "miss")
+        return value
+    
+    async def put(self, key: str, value: Dict[str, Any], ttl: float):
+        expires_at = time.time() + ttl
+        self._put_memory(key, value, expires_at)
+        if self.directory is not None:
+            await asyncio.to_thread(self._put_disk, key, value, expires_at)
+
+class SingleFlight:
+    """
+    Coalescenza delle richieste identiche in corso: la prima esegue il calcolo, quelle che
+    arrivano con la stessa chiave prima che termini ne attendono il risultato (o l'errore).
+    Se la prima viene annullata (es. client disconnesso) una di quelle in attesa riprende il calcolo.
+    """
+    
+    # Risultato di un calcolo abbandonato dal chiamante che lo eseguiva
+    _ABANDONED = object()
+    
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+    
+    async def run(self, key: str, compute: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Restituisce (risultato, condiviso): condiviso è True se il calcolo era già in corso"""
+        while (future := self._inflight.get(key)) is not None:
+            result = await asyncio.shield(future)
+            if result is not self._ABANDONED:
+                return result, True
+            # La prima richiesta in attesa trova la chiave libera e diventa lei a calcolare
+        
+        future = asyncio.get_running_loop().create_future()
+        # L'errore arriva comunque al chiamante: senza richieste in attesa non va segnalato come non letto
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = future
+        try:
+            result = await compute()
+        except asyncio.CancelledError:
+            # L'annullamento riguarda solo questo chiamante: le richieste in attesa non lo ricevono
+            future.set_result(self._ABANDONED)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+        future.set_result(result)
+        return result, False
+
+# ---------------------------------------------------------------------------
+# TASK LOADING
+# ---------------------------------------------------------------------------
+
+def load_task_configs(tokenizer=None, role_based: bool = True, strict: bool = False) -> Dict[str, TaskConfig]:
+    """
+    Carica tutte le configurazioni dei task dalle cartelle.
+    Se viene passato il tokenizer, compila anche il template del prompt di ogni task.
+    Un task che non si carica viene saltato; con strict=True (ricaricamento) solleva ValueError.
+    """
+    configs = {}
+    failed = []
+    
+    print(f"📁 Cercando task in: {TASKS_DIR.absolute()}")
+    
+    if not TASKS_DIR.exists():
+        print(f"⚠️ Directory '{TASKS_DIR}' non trovata. Creala e aggiungi i task.")
+        return configs
+    
+    task_dirs = list(TASKS_DIR.iterdir())
+    print(f"📂 Directory trovate: {[d.name for d in task_dirs if d.is_dir()]}")
+    
+    for task_dir in TASKS_DIR.iterdir():
+        if not task_dir.is_dir():
+            continue
+            
+        task_name = task_dir.name
+        system_prompt_file = task_dir / "system_prompt.txt"
+        examples_file = task_dir / "examples.json"
+        config_file = task_dir / "config.json"  # Opzionale per configurazioni extra
+        
+        if not system_prompt_file.exists() or not examples_file.exists():
+            print(f"⚠️ Task '{task_name}' manca di file richiesti, saltato.")
+            continue
+        
+        try:
+            # Carica system prompt
+            system_prompt = system_prompt_file.read_text("utf-8").strip()
+            
+            # Carica esempi
+            examples = json.loads(examples_file.read_text("utf-8"))
+            
+            # Carica configurazione extra se presente
+            extra_config = {}
+            if config_file.exists():
+                extra_config = json.loads(config_file.read_text("utf-8"))
+            
+            # Determina campi input/output dagli esempi
+            if not examples:
+                print(f"⚠️ Task '{task_name}' non ha esempi, saltato.")
+                continue
+                
+            first_example = examples[0]
+            all_fields = list(first_example.keys())
+            
+            # Campi di input
+            input_fields = extra_config.get("input_fields", [])
+            if not input_fields:
+                # Prova a indovinare dai nomi comuni
+                possible_inputs = ["question", "answer", "feedback", "llm_response", 
+                                 "text", "input", "prompt", "query", "content",
+                                 "argomento", "livello", "argument", "level", "theme"]
+                input_fields = [f for f in all_fields if f in possible_inputs]
+            
+            # Gestisci outputs
+            outputs = {}
+            
+            if "outputs" in extra_config:
+                # Nuova modalità: output multipli definiti esplicitamente
+                for output_name, output_cfg in extra_config["outputs"].items():
+                    outputs[output_name] = OutputConfig(
+                        name=output_name,
+                        extract_pattern=output_cfg.get("extract_pattern"),
+                        type=output_cfg.get("type", "str")
+                    )
+            else:
+                # Modalità legacy: singolo output
+                output_field = extra_config.get("output_field", "")
+                
+                if not output_field:
+                    # Prova a indovinare l'output
+                    possible_outputs = ["score", "humanized_response", "result", 
+                                      "output", "response", "tag", "tags", "summary",
+                                      "risposta", "bool", "question_generated"]
+                    for f in all_fields:
+                        if f in possible_outputs:
+                            output_field = f
+                            break
+                    if not output_field:
+                        output_field = "result"  # Default
+                
+                # Crea configurazione output legacy
+                outputs[output_field] = OutputConfig(
+                    name=output_field,
+                    extract_pattern=extra_config.get("extract_pattern"),
+                    type="int" if "score" in output_field else "str"
+                )
+            
+            # Classificazione: {"labels": [...], "output": nome output, "prefix": testo prima dell'etichetta}
+            classification = None
+            cls_cfg = extra_config.get("classification")
+            if cls_cfg:
+                cls_output = cls_cfg.get("output") or next(iter(outputs))
+                classification = ClassificationConfig(
+                    output=cls_output,
+                    labels=list(cls_cfg["labels"]),
+                    prefix=cls_cfg.get("prefix", f"{field_label(cls_output)}: ")
+                )
+            
+            # Cache delle risposte: "cache": true oppure {"enabled": true, "ttl": secondi}
+            cache_cfg = extra_config.get("cache", False)
+            if isinstance(cache_cfg, dict):
+                cache_enabled = cache_cfg.get("enabled", True)
+                cache_ttl = cache_cfg.get("ttl", RESPONSE_CACHE_TTL)
+            else:
+                cache_enabled = bool(cache_cfg)
+                cache_ttl = RESPONSE_CACHE_TTL
+            
+            # Esempi few-shot: {"token_budget": N, "selection": "priority" | "similarity", "max_examples": N}
+            few_shot = None
+            few_shot_cfg = extra_config.get("few_shot")
+            if few_shot_cfg:
+                few_shot = FewShotConfig(
+                    token_budget=int(few_shot_cfg["token_budget"]),
+                    selection=few_shot_cfg.get("selection", "priority"),
+                    max_examples=int(few_shot_cfg.get("max_examples", MAX_PROMPT_EXAMPLES))
+                )
+                if few_shot.selection not in ("priority", "similarity"):
+                    raise ValueError(f"Selezione degli esempi non supportata: {few_shot.selection}")
+            
+            priority = extra_config.get("priority", DEFAULT_PRIORITY)
+            if priority not in PRIORITY_CLASSES:
+                raise ValueError(f"Priorità non supportata: {priority} (valori: {list(PRIORITY_CLASSES)})")
+            
+            # Impronta di prompt e output: cambia se cambiano i file del task
+            template_hash = hashlib.sha256(json.dumps(
+                [system_prompt, examples, input_fields, {n: o.__dict__ for n, o in outputs.items()}]
+                + ([few_shot_cfg] if few_shot_cfg else []),
+                sort_keys=True, ensure_ascii=False, default=str
+            ).encode("utf-8")).hexdigest()
+            
+            # Crea configurazione
+            config = TaskConfig(
+                name=task_name,
+                system_prompt=system_prompt,
+                examples=examples,
+                input_fields=input_fields,
+                outputs=outputs,
+                max_new_tokens=extra_config.get("max_new_tokens", 512),
+                temperature=extra_config.get("temperature", 0.7),
+                top_p=extra_config.get("top_p", 0.9),
+                do_sample=extra_config.get("do_sample", True),
+                seed=extra_config.get("seed"),
+                stop=extra_config.get("stop", []),
+                stop_regex=[re.compile(p).pattern for p in extra_config.get("stop_regex", [])],
+                max_lines=int(extra_config.get("max_lines", 0)),
+                max_chars=int(extra_config.get("max_chars", 0)),
+                stop_on_match=bool(extra_config.get("stop_on_match", False)),
+                adaptive_budget=bool(extra_config.get("adaptive_budget", False)),
+                speculative=bool(extra_config.get("speculative", False)),
+                classification=classification,
+                few_shot=few_shot,
+                cache_enabled=cache_enabled,
+                cache_ttl=cache_ttl,
+                deterministic=bool(extra_config.get("deterministic", False)),
+                priority=priority,
+                template_hash=template_hash,
+                # Legacy fields per retrocompatibilità
+                output_field=list(outputs.keys())[0] if len(outputs) == 1 else None,
+                extract_pattern=list(outputs.values())[0].extract_pattern if len(outputs) == 1 else None
+            )
+            
+            # Un hit di cache (o un risultato condiviso) è valido solo se la decodifica è riproducibile
+            if (config.cache_enabled or config.deterministic) and not config.generation_params().deterministic:
+                reason = "cache" if config.cache_enabled else "deterministic"
+                print(f"ℹ️ Task '{task_name}' con {reason}: decodifica greedy (nessun seed configurato)")
+                config.do_sample = False
+            
+            config.extractor = TaskExtractor(config)
+            
+            output_names = list(outputs.keys())
+            configs[task_name] = config
+            print(f"✅ Task '{task_name}' caricato - Input: {input_fields}, Output: {output_names}")
+                
+        except Exception as e:
+            print(f"❌ Errore caricamento task '{task_name}': {e}")
+            traceback.print_exc()
+            failed.append(f"{task_name}: {e}")
+    
+    if strict and failed:
+        raise ValueError(f"Task non caricati: {failed}")
+    
+    if tokenizer is not None:
+        compile_task_prompts(configs, tokenizer, role_based)
+    
+    return configs
+
+def compile_task_prompts(configs: Dict[str, TaskConfig], tokenizer, role_based: bool = True):
+    """Precompila i template dei task e i selettori degli esempi (richiede il tokenizer del modello)"""
+    for config in configs.values():
+        try:
+            if config.few_shot is not None:
+                config.selector = ExampleSelector(config, tokenizer, role_based)
+            config.prompt = compile_task_prompt(config, tokenizer)
+        except Exception as e:
+            print(f"⚠️ Task '{config.name}': compilazione template fallita ({e})")
+
+# ---------------------------------------------------------------------------
+# PROMPT FORMATTING
+# ---------------------------------------------------------------------------
+
+def is_role_based_model(model_id: str, tokenizer) -> bool:
+    """Determina se il modello supporta role-based prompting"""
+    role_based_models = [
+        "gemma", "llama", "mistral", "mixtral", "qwen", "phi",
+        "chatglm", "baichuan", "internlm", "yi", "deepseek"
+    ]
+    
+    model_lower = model_id.lower()
+    for model_name in role_based_models:
+        if model_name in model_lower:
+            return True
+    
+    return hasattr(tokenizer, 'apply_chat_template')
+
+def example_messages(task_config: TaskConfig, ex: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Turno utente (campi di input) e risposta (output) di un esempio few-shot"""
+    # Costruisci contenuto user dai campi input
+    user_parts = []
+    for field in task_config.input_fields:
+        if field in ex:
+            # Capitalizza il nome del campo per renderlo più leggibile
+            field_name = field.replace("_", " ").title()
+            user_parts.append(f"{field_name}: {ex[field]}")
+    
+    user_content = "\n".join(user_parts)
+    
+    # Risposta assistant con tutti gli output
+    assistant_parts = []
+    for output_name in task_config.outputs:
+        if output_name in ex:
+            output_label = output_name.replace("_", " ").title()
+            assistant_parts.append(f"{output_label}: {ex[output_name]}")
+    
+    assistant_content = "\n".join(assistant_parts) if assistant_parts else ""
+    
+    return [{"role": "user", "content": user_content}, {"role": "assistant", "content": assistant_content}]
+
+def create_messages_for_task(task_config: TaskConfig, input_data: Dict[str, Any],
+                             selection: Optional[Tuple[int, ...]] = None) -> List[Dict[str, str]]:
+    """Crea messaggi per modelli role-based"""
+    messages = [{"role": "system", "content": task_config.system_prompt}]
+    
+    # Aggiungi esempi (selezione indicata o fissa del task)
+    for ex in task_config.prompt_examples(selection):
+        messages.extend(example_messages(task_config, ex))
+    
+    # Aggiungi input corrente
+    current_parts = []
+    for field in task_config.input_fields:
+        if field in input_data:
+            field_name = field.replace("_", " ").title()
+            current_parts.append(f"{field_name}: {input_data[field]}")
+    
+    current_content = "\n".join(current_parts)
+    messages.append({"role": "user", "content": current_content})
+    
+    return messages
+
+def format_messages(messages: List[Dict[str, str]], tokenizer, add_generation_prompt: bool = True) -> str:
+    """Formatta messaggi per il modello"""
+    if hasattr(tokenizer, 'apply_chat_template'):
+        return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+    else:
+        # Fallback generico
+        formatted = ""
+        for msg in messages:
+            role = msg["role"]
+            content = msg["content"]
+            if role == "system":
+                formatted += f"Sistema: {content}\n\n"
+            elif role == "user":
+                formatted += f"Utente: {content}\n"
+            elif role == "assistant":
+                formatted += f"Assistente: {content}\n\n"
+        return formatted
+
+def render_static_prefix(task_config: TaskConfig, tokenizer, selection: Optional[Tuple[int, ...]] = None) -> str:
+    """Prefisso statico del prompt (system prompt + esempi), uguale per tutte le richieste del task"""
+    messages = create_messages_for_task(task_config, {}, selection)[:-1]
+    return format_messages(messages, tokenizer, add_generation_prompt=False)
+
+def field_label(name: str) -> str:
+    """Etichetta leggibile di un campo (es. 'llm_response' -> 'Llm Response')"""
+    return name.replace("_", " ").title()
+
+# Segnaposto usato per ricavare dal chat template il testo attorno all'input corrente
+PROMPT_SENTINEL = "\x00INPUT\x00"
+
+@dataclass
+class CompiledPrompt:
+    """
+    Template del prompt di un task precompilato al caricamento:
+    prefisso statico già renderizzato (i suoi token servono solo a stimare la memoria:
+    in generazione il prefisso arriva dalla KV-cache dei prefissi), più il testo fisso
+    prima e dopo l'input corrente. A ogni richiesta si concatenano solo stringhe.
+    """
+    prefix: str
+    prefix_ids: List[int]
+    suffix_head: str
+    suffix_tail: str
+    field_labels: List[Tuple[str, str]]
+    strip_content: bool = False
+    
+    def user_content(self, input_data: Dict[str, Any]) -> str:
+        content = "\n".join(
+            f"{label}{input_data[name]}" for name, label in self.field_labels if name in input_data
+        )
+        return content.strip() if self.strip_content else content
+    
+    def suffix(self, input_data: Dict[str, Any]) -> str:
+        """Parte variabile del prompt (input corrente + prompt di generazione)"""
+        return self.suffix_head + self.user_content(input_data) + self.suffix_tail
+    
+    def render(self, input_data: Dict[str, Any]) -> str:
+        """Prompt completo, identico a format_messages(create_messages_for_task(...))"""
+        return self.prefix + self.suffix(input_data)
+
+def compile_task_prompt(task_config: TaskConfig, tokenizer,
+                        selection: Optional[Tuple[int, ...]] = None) -> Optional[CompiledPrompt]:
+    """
+    Compila il template del task (con gli esempi della selezione indicata o fissa)
+    renderizzando una sola volta il chat template con un segnaposto al posto
+    dell'input. Restituisce None se il template non è scomponibile: in quel caso
+    si usa il percorso completo a ogni richiesta.
+    """
+    prefix = render_static_prefix(task_config, tokenizer, selection)
+    base = create_messages_for_task(task_config, {}, selection)[:-1]
+    
+    def render_with(content: str) -> Optional[str]:
+        rendered = format_messages(base + [{"role": "user", "content": content}], tokenizer)
+        return rendered[len(prefix):] if rendered.startswith(prefix) else None
+    
+    # Alcuni chat template applicano trim al contenuto: lo si rileva con spazi attorno al segnaposto
+    suffix = render_with(f" {PROMPT_SENTINEL} ")
+    if suffix is None or PROMPT_SENTINEL not in suffix:
+        print(f"⚠️ Task '{task_config.name}': template non precompilabile")
+        return None
+    
+    strip_content = f" {PROMPT_SENTINEL} " not in suffix
+    if strip_content:
+        head, tail = suffix.split(PROMPT_SENTINEL, 1)
+    else:
+        head, tail = suffix.split(f" {PROMPT_SENTINEL} ", 1)
+    
+    compiled = CompiledPrompt(
+        prefix=prefix,
+        prefix_ids=tokenizer(prefix)["input_ids"],
+        suffix_head=head,
+        suffix_tail=tail,
+        field_labels=[(name, f"{field_label(name)}: ") for name in task_config.input_fields],
+        strip_content=strip_content,
+    )
+    
+    # Verifica su un input d'esempio che il risultato coincida con il percorso completo
+    sample = {name: f"{name} di prova " for name in task_config.input_fields}
+    expected = format_messages(create_messages_for_task(task_config, sample, selection), tokenizer)
+    if compiled.render(sample) != expected:
+        print(f"⚠️ Task '{task_config.name}': template precompilato non coerente, ignorato")
+        return None
+    
+    return compiled
+
+def legacy_example_text(task_config: TaskConfig, ex: Dict[str, Any]) -> str:
+    """Blocco di testo di un esempio few-shot nel prompt legacy"""
+    example_parts = []
+    
+    # Input fields
+    for field in task_config.input_fields:
+        if field in ex:
+            field_name = field.replace("_", " ").title()
+            example_parts.append(f"{field_name}: {ex[field]}")
+    
+    # Outputs
+    for output_name in task_config.outputs:
+        if output_name in ex:
+            output_label = output_name.replace("_", " ").title()
+            example_parts.append(f"{output_label}: {ex[output_name]}")
+    
+    return "\n".join(example_parts)
+
+@dataclass
+class LegacyPrompt:
+    """
+    Prompt testuale dei modelli senza chat template (modalità legacy): un template con un
+    "{campo}" per ogni input, riempito con str.format come faceva il PromptTemplate di LangChain.
+    Il testo fisso prima del primo campo (fino all'ultimo a capo) fa da prefisso per la KV-cache.
+    """
+    template: str
+    input_variables: List[str]
+    prefix: str = ""
+    
+    def __post_init__(self):
+        literal = next(string.Formatter().parse(self.template), ("",))[0]
+        self.prefix = literal[:literal.rfind("\n") + 1]
+    
+    def format(self, **kwargs) -> str:
+        return self.template.format(**kwargs)
+
+def build_legacy_prompt(task_config: TaskConfig, selection: Optional[Tuple[int, ...]] = None) -> LegacyPrompt:
+    """Crea il prompt per modelli legacy"""
+    parts = [task_config.system_prompt + "\n\nESEMPI:"]
+    
+    for ex in task_config.prompt_examples(selection):
+        parts.append(legacy_example_text(task_config, ex))
+    
+    base_prompt = "\n\n".join(parts)
+    
+    # Template con placeholders
+    template_parts = [base_prompt, "\n\nNUOVA VALUTAZIONE:"]
+    for field in task_config.input_fields:
+        field_name = field.replace("_", " ").title()
+        template_parts.append(f"{field_name}: {{{field}}}")
+    
+    # Aggiungi prompt per ogni output atteso
+    for output_name in task_config.outputs:
+        output_label = output_name.replace("_", " ").title()
+        template_parts.append(f"{output_label}: ")
+    
+    template = "\n".join(template_parts)
+    
+    return LegacyPrompt(template=template, input_variables=task_config.input_fields)
+
+def dynamic_prefix(task_config: TaskConfig, selection: Tuple[int, ...], prefix: Optional[str]) -> Optional[str]:
+    """
+    Prefisso per la KV-cache con la selezione degli esempi per similarità: solo quello della selezione
+    fissa (già in cache e condiviso da più richieste). Ogni altra selezione darebbe un prefisso quasi
+    sempre diverso, che occuperebbe la cache togliendo posto ai prefissi stabili degli altri task.
+    """
+    return prefix if selection == task_config.selector.fixed else None
+
+def lexical_terms(text: str) -> frozenset:
+    """Parole (minuscole, almeno 3 caratteri) e numeri di un testo, per la similarità tra input ed esempi"""
+    return frozenset(word for word in re.findall(r"\w+", text.lower()) if len(word) >= 3 or word.isdigit())
+
+class ExampleSelector:
+    """
+    Sceglie gli esempi few-shot che entrano nel budget di token del prompt: in
+    ordine di priorità (selezione fissa, calcolata al caricamento) oppure per
+    similarità lessicale con l'input corrente. Le lunghezze in token di system
+    prompt ed esempi sono calcolate una sola volta, sul testo che finisce nel prompt:
+    in modalità role-based renderizzato con il chat template (marcatori di ruolo e
+    di turno compresi), in modalità legacy sul blocco di testo dell'esempio.
+    """
+    # Prompt compilati / prompt legacy tenuti in cache per le selezioni più recenti
+    CACHE_SIZE = 64
+    
+    def __init__(self, task_config: TaskConfig, tokenizer, role_based: bool = True):
+        self.task_name = task_config.name
+        self.few_shot = task_config.few_shot
+        self.input_fields = task_config.input_fields
+        examples = task_config.examples
+        
+        def count(text: str) -> int:
+            return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+        
+        if role_based:
+            # Costo di ogni esempio: token che aggiunge al prefisso renderizzato dopo il system prompt
+            system = [{"role": "system", "content": task_config.system_prompt}]
+            self.system_tokens = count(format_messages(system, tokenizer, add_generation_prompt=False))
+            self.example_tokens = [
+                count(format_messages(system + example_messages(task_config, ex), tokenizer,
+                                      add_generation_prompt=False)) - self.system_tokens
+                for ex in examples
+            ]
+        else:
+            # Stessi separatori di build_legacy_prompt
+            self.system_tokens = count(task_config.system_prompt + "\n\nESEMPI:")
+            self.example_tokens = [count("\n\n" + legacy_example_text(task_config, ex)) for ex in examples]
+        self.budget = self.few_shot.token_budget - self.system_tokens
+        # Priorità: campo "priority" dell'esempio (più alta prima), a parità l'ordine del file
+        self.priority = sorted(range(len(examples)), key=lambda i: (-float(examples[i].get("priority", 0)), i))
+        self.terms = [
+            lexical_terms(" ".join(str(ex.get(name, "")) for name in self.input_fields)) for ex in examples
+        ]
+        self.fixed = self._fill(self.priority)
+        self._cache: "OrderedDict[Tuple, Any]" = OrderedDict()
+        
+        if self.budget <= 0:
+            print(f"⚠️ Task '{self.task_name}': il system prompt ({self.system_tokens} token) supera il budget, nessun esempio")
+        print(f"📚 Task '{self.task_name}' - esempi {self.few_shot.selection}: {len(self.fixed)}/{len(examples)} "
+              f"fissi {list(self.fixed)}, {self.tokens(self.fixed)}/{self.few_shot.token_budget} token")
+    
+    @property
+    def dynamic(self) -> bool:
+        """True se la selezione dipende dall'input della richiesta"""
+        return self.few_shot.selection == "similarity"
+    
+    def tokens(self, selection: Tuple[int, ...]) -> int:
+        """Token di system prompt ed esempi selezionati"""
+        return self.system_tokens + sum(self.example_tokens[i] for i in selection)
+    
+    def _fill(self, candidates: List[int]) -> Tuple[int, ...]:
+        """Prende i candidati in ordine finché entrano nel budget; nel prompt restano nell'ordine del file"""
+        chosen = []
+        used = 0
+        for i in candidates:
+            if len(chosen) >= self.few_shot.max_examples:
+                break
+            if used + self.example_tokens[i] <= self.budget:
+                chosen.append(i)
+                used += self.example_tokens[i]
+        return tuple(sorted(chosen))
+    
+    def select(self, input_data: Dict[str, Any]) -> Tuple[int, ...]:
+        """Indici degli esempi da includere nel prompt per questo input"""
+        if not self.dynamic:
+            return self.fixed
+        query = lexical_terms(" ".join(str(input_data.get(name, "")) for name in self.input_fields))
+        
+        def similarity(i: int) -> float:
+            terms = self.terms[i]
+            if not query or not terms:
+                return 0.0
+            return len(query & terms) / math.sqrt(len(query) * len(terms))
+        
+        # Ordinamento stabile: a parità di similarità vale la priorità
+        return self._fill(sorted(self.priority, key=lambda i: -similarity(i)))
+    
+    def cached(self, key: Tuple, build: Callable[[], Any]) -> Any:
+        """Oggetto costruito per una selezione (prompt compilato o legacy), con cache LRU"""
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        value = build()
+        self._cache[key] = value
+        if len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return value
 
 # ---------------------------------------------------------------------------
 # RESULT EXTRACTION
@@ -481,143 +2614,445 @@ def convert_value(value: str, target_type: str) -> Any:
     else:
         return value
 
-def extract_single_result(raw_output: str, output_config: OutputConfig, task_name: str) -> Any:
-    """Estrae un singolo risultato dall'output del modello"""
-    output = raw_output.strip()
-    
-    # Se c'è un pattern di estrazione specifico
-    if output_config.extract_pattern:
-        match = re.search(output_config.extract_pattern, output, re.IGNORECASE | re.DOTALL)
-        if match:
-            result = match.group(1) if match.groups() else match.group(0)
-            return convert_value(result, output_config.type)
-    
-    # Euristiche di fallback basate sul nome del campo
+_record_lock = threading.Lock()
+
+def record_raw_output(task_name: str, raw_output: str, examples: Optional[Tuple[int, ...]] = None):
+    """
+    Aggiunge un output grezzo al file RECORD_RAW_OUTPUTS (corpus per benchmarks/bench_extraction.py),
+    con gli indici degli esempi few-shot del prompt se il task li seleziona
+    """
+    record = {"task": task_name, "raw": raw_output}
+    if examples is not None:
+        record["examples"] = list(examples)
+    line = json.dumps(record, ensure_ascii=False)
+    try:
+        with _record_lock, open(RECORD_RAW_OUTPUTS, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    except OSError as e:
+        print(f"⚠️  Impossibile registrare l'output grezzo: {e}")
+
+def compile_fallback(output_config: OutputConfig) -> Callable[[str], Any]:
+    """Precompila le euristiche di fallback (per nome e tipo del campo) di un output"""
     output_name = output_config.name.lower()
     
-    # Campi che restituiscono punteggi numerici
     if "score" in output_name or output_name in ["punteggio", "voto", "rating"]:
-        # Cerca specificamente dopo "Punteggio:" o simili
         score_patterns = [
-            rf"{output_config.name}:\s*(\d+)",
-            r"Punteggio:\s*(\d+)",
-            r"Score:\s*(\d+)",
-            r"Voto:\s*(\d+)"
+            re.compile(p, re.IGNORECASE)
+            for p in [rf"{output_config.name}:\s*(\d+)", r"Punteggio:\s*(\d+)", r"Score:\s*(\d+)", r"Voto:\s*(\d+)"]
         ]
-        for pattern in score_patterns:
-            match = re.search(pattern, output, re.IGNORECASE)
-            if match:
-                return convert_value(match.group(1), output_config.type)
+        numbers = re.compile(r"\d+")
         
-        # Altrimenti prendi l'ultimo numero trovato
-        nums = re.findall(r"\d+", output)
-        if nums:
-            return convert_value(nums[-1], output_config.type)
+        def fallback(output: str) -> Any:
+            for pattern in score_patterns:
+                match = pattern.search(output)
+                if match:
+                    return convert_value(match.group(1), output_config.type)
+            nums = numbers.findall(output)
+            if nums:
+                return convert_value(nums[-1], output_config.type)
+            return None
     
-    # Campi che restituiscono booleani
     elif output_config.type == "bool" or output_name in ["bool", "boolean", "vero_falso"]:
-        bool_match = re.search(r"\b(Vero|Falso|True|False)\b", output, re.IGNORECASE)
-        if bool_match:
-            return convert_value(bool_match.group(1), "bool")
+        bool_pattern = re.compile(r"\b(Vero|Falso|True|False)\b", re.IGNORECASE)
+        
+        def fallback(output: str) -> Any:
+            match = bool_pattern.search(output)
+            return convert_value(match.group(1), "bool") if match else None
     
-    # Campi che restituiscono tag o etichette
     elif output_name in ["tag", "tags", "label", "etichetta"]:
-        # Cerca dopo "Tags:", "Tag:", etc.
         tag_patterns = [
-            rf"{output_config.name}:\s*(.+?)(?:\n|$)",
-            r"Tags?:\s*(.+?)(?:\n|$)",
-            r"Etichett[ae]:\s*(.+?)(?:\n|$)"
+            re.compile(p, re.IGNORECASE)
+            for p in [rf"{output_config.name}:\s*(.+?)(?:\n|$)", r"Tags?:\s*(.+?)(?:\n|$)", r"Etichett[ae]:\s*(.+?)(?:\n|$)"]
         ]
-        for pattern in tag_patterns:
-            match = re.search(pattern, output, re.IGNORECASE)
-            if match:
-                return match.group(1).strip().strip('"\'')
+        
+        def fallback(output: str) -> Any:
+            for pattern in tag_patterns:
+                match = pattern.search(output)
+                if match:
+                    return match.group(1).strip().strip('"\'')
+            return None
     
-    # Feedback o commenti
     elif output_name in ["feedback", "commento", "comment", "spiegazione"]:
         feedback_patterns = [
-            rf"{output_config.name}:\s*(.+?)(?:\n|$)",
-            r"Feedback:\s*(.+?)(?:\n|$)",
-            r"Commento:\s*(.+?)(?:\n|$)"
+            re.compile(p, re.IGNORECASE | re.DOTALL)
+            for p in [rf"{output_config.name}:\s*(.+?)(?:\n|$)", r"Feedback:\s*(.+?)(?:\n|$)", r"Commento:\s*(.+?)(?:\n|$)"]
         ]
-        for pattern in feedback_patterns:
-            match = re.search(pattern, output, re.IGNORECASE | re.DOTALL)
-            if match:
-                return match.group(1).strip()
-    
-    # Default: ritorna None se non trovato
-    return None
-
-def extract_results(raw_output: str, task_config: TaskConfig) -> Dict[str, Any]:
-    """Estrae tutti i risultati dall'output del modello"""
-    results = {}
-    
-    # Se c'è un solo output (modalità legacy)
-    if len(task_config.outputs) == 1 and task_config.output_field:
-        output_name = task_config.output_field
-        output_config = task_config.outputs[output_name]
-        result = extract_single_result(raw_output, output_config, task_config.name)
-        
-        # Se non trovato, prova euristica legacy
-        if result is None:
-            result = extract_result_legacy(raw_output, task_config)
         
-        results[output_name] = result
+        def fallback(output: str) -> Any:
+            for pattern in feedback_patterns:
+                match = pattern.search(output)
+                if match:
+                    return match.group(1).strip()
+            return None
+    
     else:
-        # Estrai ogni output definito
-        for output_name, output_config in task_config.outputs.items():
-            result = extract_single_result(raw_output, output_config, task_config.name)
-            if result is not None:
-                results[output_name] = result
+        def fallback(output: str) -> Any:
+            return None
     
-    return results
+    return fallback
 
-def extract_result_legacy(raw_output: str, task_config: TaskConfig) -> Any:
-    """Estrae il risultato usando le euristiche legacy (per retrocompatibilità)"""
-    output = raw_output.strip()
+def compile_legacy_fallback(task_config: TaskConfig) -> Callable[[str], Any]:
+    """Precompila le euristiche legacy (per nome del task) di un task con un solo output"""
     task_name = task_config.name.lower()
     
-    # Task che restituiscono punteggi numerici
     if task_name in ["red", "green_validity", "green_cultural", "green_coherence_qa"]:
-        score_match = re.search(r"Punteggio:\s*(\d+)", output, re.IGNORECASE)
-        if score_match:
-            return int(score_match.group(1))
-        nums = re.findall(r"\d+", output)
-        if nums:
-            return int(nums[-1])
-    
-    # Task che restituiscono booleani
+        score_pattern = re.compile(r"Punteggio:\s*(\d+)", re.IGNORECASE)
+        numbers = re.compile(r"\d+")
+        
+        def fallback(output: str) -> Any:
+            score_match = score_pattern.search(output)
+            if score_match:
+                return int(score_match.group(1))
+            nums = numbers.findall(output)
+            if nums:
+                return int(nums[-1])
+            return output
+    
     elif task_name == "green_coherence_qt":
-        bool_match = re.search(r"\b(Vero|Falso)\b", output, re.IGNORECASE)
-        if bool_match:
-            return bool_match.group(1).capitalize()
+        bool_pattern = re.compile(r"\b(Vero|Falso)\b", re.IGNORECASE)
+        
+        def fallback(output: str) -> Any:
+            bool_match = bool_pattern.search(output)
+            return bool_match.group(1).capitalize() if bool_match else output
     
-    # Task che restituiscono tag
     elif task_name == "orange":
-        clean_output = output
-        if clean_output.lower().startswith("tags:"):
-            clean_output = clean_output[5:].strip()
-        return clean_output.strip('"\'')
+        def fallback(output: str) -> Any:
+            clean_output = output
+            if clean_output.lower().startswith("tags:"):
+                clean_output = clean_output[5:].strip()
+            return clean_output.strip('"\'')
+    
+    else:
+        def fallback(output: str) -> Any:
+            return output
+    
+    return fallback
+
+class TaskExtractor:
+    """
+    Estrattore precompilato di un task (vedi benchmarks/bench_extraction.py per l'originale): i pattern
+    di ogni output e le euristiche di fallback sono compilati una sola volta e
+    tutti gli output sono estratti in un solo passaggio sullo stesso testo.
+    """
+    
+    def __init__(self, task_config: TaskConfig):
+        self.legacy_single = len(task_config.outputs) == 1 and bool(task_config.output_field)
+        self.legacy_fallback = compile_legacy_fallback(task_config) if self.legacy_single else None
+        
+        self.outputs = []  # (nome, config, pattern principale, fallback)
+        for name, output_config in task_config.outputs.items():
+            primary = None
+            if output_config.extract_pattern:
+                primary = re.compile(output_config.extract_pattern, re.IGNORECASE | re.DOTALL)
+            self.outputs.append((name, output_config, primary, compile_fallback(output_config)))
+    
+    def extract(self, raw_output: str) -> Dict[str, Any]:
+        """Estrae tutti gli output dal testo generato"""
+        output = raw_output.strip()
+        
+        results = {}
+        for name, output_config, primary, fallback in self.outputs:
+            match = primary.search(output) if primary is not None else None
+            if match:
+                result = match.group(1) if match.groups() else match.group(0)
+                result = convert_value(result, output_config.type)
+            else:
+                result = fallback(output)
+            
+            if self.legacy_single:
+                results[name] = result if result is not None else self.legacy_fallback(output)
+            elif result is not None:
+                results[name] = result
+        return results
+
+# ---------------------------------------------------------------------------
+# AVVIO IN BACKGROUND
+# ---------------------------------------------------------------------------
+
+def sample_task_input(task_config: TaskConfig) -> Dict[str, Any]:
+    """Input d'esempio per il warm-up: i campi del primo esempio del task"""
+    example = task_config.examples[0] if task_config.examples else {}
+    return {name: str(example.get(name) or name) for name in task_config.input_fields}
+
+def prefix_boundary_ok(tokenizer, prefix: str, prompt: str) -> bool:
+    """
+    True se prefisso e suffisso tokenizzati a parte danno gli stessi token del prompt intero, come
+    presuppone la KV-cache dei prefissi. Con i tokenizer SentencePiece (es. Llama) il suffisso può
+    ricevere un "▁" iniziale o fondersi diversamente con la fine del prefisso.
+    """
+    if not prompt.startswith(prefix):
+        return False
+    split = tokenizer(prefix)["input_ids"] + tokenizer(prompt[len(prefix):], add_special_tokens=False)["input_ids"]
+    return split == tokenizer(prompt)["input_ids"]
+
+def build_task_processors(task_configs: Dict[str, TaskConfig], tokenizer, use_role_based: bool) -> Dict[str, dict]:
+    """
+    Prepara i processori (prompt e parametri) di ogni task. Il prefisso per la KV-cache è None
+    se con questo tokenizer non si può separare dal resto del prompt (vedi prefix_boundary_ok).
+    """
+    task_processors = {}
+    for task_name, config in task_configs.items():
+        sample = sample_task_input(config)
+        if use_role_based:
+            processor = {"type": "role_based"}
+            prefix = config.prompt.prefix if config.prompt else render_static_prefix(config, tokenizer)
+            formatted = (config.prompt.render(sample) if config.prompt else
+                         format_messages(create_messages_for_task(config, sample), tokenizer))
+        else:
+            # Prompt testuale per modelli legacy, sullo stesso motore della modalità role-based
+            prompt = build_legacy_prompt(config)
+            processor = {"type": "legacy", "prompt": prompt}
+            prefix, formatted = prompt.prefix, prompt.format(**sample)
+        
+        if prefix and not prefix_boundary_ok(tokenizer, prefix, formatted):
+            print(f"⚠️ Task '{task_name}': il tokenizer unisce prefisso e input in modo diverso, "
+                  f"KV-cache del prefisso disattivata")
+            prefix = None
+        task_processors[task_name] = {**processor, "params": config.generation_params(), "prefix": prefix, "config": config}
+    return task_processors
+
+class StubEngine(GenerationEngine):
+    """
+    Motore senza modello per MODEL_ID="stub:", con la stessa interfaccia di GenerationEngine.
+    La risposta è una delle risposte few-shot presenti nel prompt, scelta in modo deterministico
+    dal prompt (e dal seed), quindi ha il formato atteso dal task; limiti di token e criteri di
+    arresto sono applicati come nella generazione reale. Ogni token (il primo fa da prefill)
+    costa STUB_TOKEN_LATENCY_MS.
+    """
+    
+    # Risposte dell'assistente già chiuse nel prompt (chat template offline)
+    ANSWER_PATTERN = re.compile(r"<\|assistant\|>\n(.*?)</s>", re.S)
+    FALLBACK_ANSWER = "Risposta simulata dal motore stub."
+    
+    def __init__(self, tokenizer, token_latency_ms: float = STUB_TOKEN_LATENCY_MS):
+        super().__init__(None, tokenizer, "cpu")
+        self.prefix_cache = PrefixCache(0)
+        self.token_latency = token_latency_ms / 1000
+    
+    def _pick(self, prompt: str, options: List[str], seed: Optional[int] = None) -> int:
+        digest = hashlib.sha256(f"{seed}\x00{prompt}".encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % len(options)
+    
+    def _answer(self, prompt: str, params: GenerationParams) -> Tuple[str, int]:
+        """Risposta simulata e numero di token generati (EOS compreso se non troncata)"""
+        answers = self.ANSWER_PATTERN.findall(prompt) or [self.FALLBACK_ANSWER]
+        text = answers[self._pick(prompt, answers, params.seed)]
+        ids = self.tokenizer(text, add_special_tokens=False)["input_ids"][:params.max_new_tokens]
+        output = trim_output(self.tokenizer.decode(ids, skip_special_tokens=True), params)
+        new_tokens = len(self.tokenizer(output, add_special_tokens=False)["input_ids"]) + 1
+        return output, min(new_tokens, params.max_new_tokens)
+    
+    def _simulate(self, steps: int) -> Tuple[float, float]:
+        """Attende steps token di latenza: restituisce (prefill, decodifica) in secondi"""
+        start = time.perf_counter()
+        time.sleep(self.token_latency)
+        first_token_at = time.perf_counter()
+        time.sleep(self.token_latency * max(0, steps - 1))
+        return first_token_at - start, time.perf_counter() - first_token_at
+    
+    def generate_batch(self, prompts: List[str], params: GenerationParams,
+                       prefix: Optional[str] = None, timing: Optional[GenerationTiming] = None) -> List[str]:
+        results = [self._answer(prompt, params) for prompt in prompts]
+        # Il batch dura quanto la sequenza più lunga
+        prefill_seconds, decode_seconds = self._simulate(max(new_tokens for _, new_tokens in results))
+        if timing is not None:
+            timing.prefill_seconds = prefill_seconds
+            timing.decode_seconds = decode_seconds
+            timing.prompt_tokens = [len(self.tokenizer(p, add_special_tokens=False)["input_ids"]) for p in prompts]
+            timing.new_tokens = [new_tokens for _, new_tokens in results]
+        return [output for output, _ in results]
+    
+    def generate_assisted(self, prompt: str, params: GenerationParams,
+                          timing: Optional[GenerationTiming] = None) -> Tuple[str, "SpeculativeRun"]:
+        raise RuntimeError("Decodifica speculativa non disponibile con il motore stub")
+    
+    def classify(self, prompt: str, classification: ClassificationConfig,
+                 prefix: Optional[str] = None) -> Tuple[str, float, str]:
+        """Etichetta di una risposta few-shot del prompt (o scelta dal prompt), con un solo passo di latenza"""
+        continuations = classification.continuations()
+        answers = self.ANSWER_PATTERN.findall(prompt)
+        best = self._pick(prompt, continuations)
+        if answers:
+            answer = answers[self._pick(prompt, answers)].strip()
+            best = next((i for i, c in enumerate(continuations) if answer.startswith(c.strip())), best)
+        self._simulate(1)
+        return classification.labels[best], 1.0, continuations[best]
+    
+    def kv_bytes_per_token(self) -> int:
+        return 0
+
+class ModelRuntime:
+    """
+    Modello, motore e scheduler caricati in un thread in background, così che il
+    server HTTP risponda subito: /live è sempre disponibile, i task restituiscono
+    503 finché caricamento e warm-up non sono completati.
+    """
+    
+    STAGES = ["modello", "template", "warm-up", "pronto"]
+    
+    def __init__(self, task_configs: Dict[str, TaskConfig]):
+        self.task_configs = task_configs
+        self.stage = "avvio"
+        self.error: Optional[str] = None
+        self.started_at = time.time()
+        self.ready_at: Optional[float] = None
+        self.warmed_up = 0
+        
+        self.tokenizer = None
+        self.device: Optional[str] = None
+        self.use_role_based: Optional[bool] = None
+        self.engine: Optional[GenerationEngine] = None
+        self.scheduler: Optional[BatchScheduler] = None
+        self.task_processors: Dict[str, dict] = {}
+    
+    @property
+    def ready(self) -> bool:
+        return self.stage == "pronto"
+    
+    def start(self):
+        threading.Thread(target=self._load, name="model-loader", daemon=True).start()
+    
+    def _load(self):
+        try:
+            self.stage = "modello"
+            model, tokenizer, device = load_model_and_tokenizer(MODEL_ID)
+            use_role_based = is_role_based_model(MODEL_ID, tokenizer)
+            print(f"🎯 Modalità: {'Role-based' if use_role_based else 'Legacy'}")
+            
+            draft_model, draft_tokenizer = None, None
+            if DRAFT_MODEL_ID and model is not None:
+                draft_model, draft_tokenizer = load_draft_model(DRAFT_MODEL_ID, model, tokenizer)
+            
+            self.stage = "template"
+            compile_task_prompts(self.task_configs, tokenizer, use_role_based)
+            if model is None:
+                engine = StubEngine(tokenizer)
+            else:
+                engine = GenerationEngine(model, tokenizer, device, draft_model, draft_tokenizer)
+                if COMPILE_MODE:
+                    engine.configure_compilation(COMPILE_MODE)
+            self.task_processors = build_task_processors(self.task_configs, tokenizer, use_role_based)
+            self.tokenizer, self.device, self.use_role_based, self.engine = tokenizer, device, use_role_based, engine
+            
+            self.stage = "warm-up"
+            if WARMUP_MAX_NEW_TOKENS > 0:
+                for task_name, processor in self.task_processors.items():
+                    self._warm_up(task_name, processor)
+                    self.warmed_up += 1
+            
+            # Un solo worker di inferenza con coda limitata: le richieste concorrenti vengono
+            # generate in batch senza bloccare l'event loop
+            self.scheduler = BatchScheduler(engine)
+            self.scheduler.start()
+            
+            self.ready_at = time.time()
+            self.stage = "pronto"
+            print(f"🟢 Server pronto in {self.ready_at - self.started_at:.1f}s")
+        except Exception as e:
+            self.error = str(e)
+            self.stage = "errore"
+            print(f"❌ Caricamento del modello fallito: {e}")
+            traceback.print_exc()
+    
+    def _warm_up(self, task_name: str, processor: dict):
+        """Una generazione breve per task: inizializza kernel, allocatore e cache dei prefissi"""
+        config = processor["config"]
+        data = sample_task_input(config)
+        params = replace(processor["params"], max_new_tokens=min(WARMUP_MAX_NEW_TOKENS, config.max_new_tokens))
+        start = time.perf_counter()
+        try:
+            classification = config.classification
+            if processor["type"] == "role_based":
+                if config.prompt is not None:
+                    formatted = config.prompt.render(data)
+                else:
+                    formatted = format_messages(create_messages_for_task(config, data), self.tokenizer)
+            else:
+                formatted = processor["prompt"].format(**data)
+                if classification is not None:
+                    classification = replace(classification, prefix="")
+            if classification is not None:
+                self.engine.classify(formatted, classification, processor["prefix"])
+            elif params.assisted and self.engine.draft_model is not None:
+                self.engine.generate_assisted(formatted, params)
+            else:
+                self.engine.generate_batch([formatted], params, prefix=processor["prefix"])
+            print(f"🔥 Warm-up '{task_name}': {time.perf_counter() - start:.2f}s")
+        except Exception as e:
+            print(f"⚠️  Warm-up '{task_name}' fallito: {e}")
+    
+    def progress(self) -> Dict[str, Any]:
+        """Avanzamento del caricamento per /ready"""
+        completed = self.STAGES.index(self.stage) if self.stage in self.STAGES else 0
+        if self.stage == "warm-up" and self.task_configs:
+            completed += self.warmed_up / len(self.task_configs)
+        elapsed = (self.ready_at or time.time()) - self.started_at
+        return {
+            "ready": self.ready,
+            "stage": self.stage,
+            "progress": round(completed / (len(self.STAGES) - 1), 3),
+            "warmed_up": f"{self.warmed_up}/{len(self.task_configs)}",
+            "elapsed_seconds": round(elapsed, 1),
+            "error": self.error,
+        }
+    
+    def prepare_tasks(self) -> Tuple[Dict[str, TaskConfig], Dict[str, dict]]:
+        """Rilegge le directory dei task e prepara configurazioni e processori (senza attivarli)"""
+        configs = load_task_configs(self.tokenizer, self.use_role_based, strict=True)
+        if not configs:
+            raise ValueError(f"Nessun task trovato in '{TASKS_DIR}'")
+        # Un task attivo si considera rimosso solo se non c'è più la sua cartella, non se è
+        # incompleta (es. file in corso di salvataggio)
+        incomplete = [name for name in self.task_configs if name not in configs and (TASKS_DIR / name).is_dir()]
+        if incomplete:
+            raise ValueError(f"Task incompleti (cartella presente ma file mancanti): {incomplete}")
+        processors = build_task_processors(configs, self.tokenizer, self.use_role_based)
+        return configs, processors
+    
+    def swap_tasks(self, configs: Dict[str, TaskConfig], processors: Dict[str, dict]):
+        """
+        Attiva i nuovi task. Va chiamata dall'event loop: le richieste già avviate
+        conservano il processore (e la configurazione) che avevano letto.
+        """
+        changed = [
+            name for name, config in configs.items()
+            if name not in self.task_configs or self.task_configs[name].template_hash != config.template_hash
+        ]
+        self.task_configs, self.task_processors = configs, processors
+        # Le lunghezze osservate con il vecchio prompt non valgono per il nuovo
+        self.scheduler.lengths.reset(changed)
+        # I prefissi dei vecchi template non servono più; il modello resta caricato
+        self.engine.prefix_cache.clear()
     
-    # Default
-    return output
+    def require_ready(self):
+        """Solleva 503 (con Retry-After) finché il modello non è pronto"""
+        if self.ready:
+            return
+        if self.error is not None:
+            detail = f"Caricamento del modello fallito: {self.error}"
+        else:
+            detail = f"Modello in caricamento (fase: {self.stage})"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(RETRY_AFTER_SECONDS)})
 
 # ---------------------------------------------------------------------------
 # FASTAPI APP
 # ---------------------------------------------------------------------------
 
+def tasks_signature() -> Tuple:
+    """Impronta dei file dei task (percorso, data di modifica, dimensione) per il ricaricamento automatico"""
+    files = []
+    for path in sorted(TASKS_DIR.rglob("*")):
+        if path.is_file():
+            stat = path.stat()
+            files.append((str(path), stat.st_mtime_ns, stat.st_size))
+    return tuple(files)
+
 def create_app():
     """Crea e configura l'app FastAPI"""
     
-    # Carica modello
     print("🚀 Inizializzazione server unificato...")
-    model, tokenizer, device = load_model_and_tokenizer(MODEL_ID)
     
-    # Determina tipo di modello
-    use_role_based = is_role_based_model(MODEL_ID, tokenizer)
-    print(f"🎯 Modalità: {'Role-based' if use_role_based else 'Legacy'}")
-    
-    # Carica configurazioni task
+    # Carica configurazioni task (i template vengono compilati quando il tokenizer è disponibile)
     task_configs = load_task_configs()
     
     print(f"\n📊 Task caricati: {len(task_configs)}")
@@ -625,160 +3060,757 @@ def create_app():
         print("❌ Nessun task trovato! Crea la directory 'tasks' con le configurazioni.")
         sys.exit(1)
     
-    # Prepara pipeline/chains per ogni task
-    task_processors = {}
+    # Il modello si carica in background: il server HTTP risponde subito
+    runtime = ModelRuntime(task_configs)
+    runtime.start()
     
-    for task_name, config in task_configs.items():
-        if use_role_based:
-            # Pipeline diretta per modelli moderni
-            pipeline = create_pipeline(model, tokenizer, device, config.max_new_tokens)
-            task_processors[task_name] = {
-                "type": "role_based",
-                "pipeline": pipeline,
-                "config": config
-            }
-        else:
-            # LangChain per modelli legacy
-            llm = HuggingFacePipeline(
-                pipeline=create_pipeline(model, tokenizer, device, config.max_new_tokens)
-            )
-            chain = build_legacy_chain(llm, config)
-            task_processors[task_name] = {
-                "type": "legacy",
-                "chain": chain,
-                "config": config
-            }
+    response_cache = ResponseCache()
+    single_flight = SingleFlight()
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        watcher = asyncio.create_task(watch_tasks()) if TASKS_WATCH_INTERVAL > 0 else None
+        yield
+        if watcher is not None:
+            watcher.cancel()
     
     # Crea app
     app = FastAPI(
         title="Unified LLM Server",
         description="Server unificato per tutti i task LLM con supporto output multipli",
-        version="2.0.0"
+        version="2.0.0",
+        lifespan=lifespan
     )
     
     # Endpoint di health check
     @app.get("/")
     async def root():
+        mode = None
+        if runtime.use_role_based is not None:
+            mode = "role_based" if runtime.use_role_based else "legacy"
         return {
-            "status": "online",
+            "status": "online" if runtime.ready else runtime.stage,
             "model": MODEL_ID,
-            "tasks": list(task_configs.keys()),
-            "mode": "role_based" if use_role_based else "legacy"
+            "tasks": list(runtime.task_configs.keys()),
+            "mode": mode,
+            "execution": (runtime.engine.compile_mode or "eager") if runtime.engine is not None else None
         }
     
-    # Crea endpoint dinamicamente per ogni task
-    for task_name, processor in task_processors.items():
-        config = processor["config"]
+    # Liveness: il processo risponde (fallisce solo se il caricamento del modello è fallito)
+    @app.get("/live")
+    async def live():
+        if runtime.error is not None:
+            return JSONResponse(status_code=503, content={"status": "error", "error": runtime.error})
+        return {"status": "alive"}
+    
+    # Readiness: modello caricato e warm-up completato, con avanzamento del caricamento
+    @app.get("/ready")
+    async def ready():
+        return JSONResponse(status_code=200 if runtime.ready else 503, content=runtime.progress())
+    
+    # Metriche in formato Prometheus
+    @app.get("/metrics")
+    async def metrics():
+        if runtime.scheduler is not None:
+            METRICS.queue_depth.set(runtime.scheduler.depth)
+        return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+    
+    # Stato della coda di inferenza: profondità e attese per task
+    @app.get("/queue")
+    async def queue_status():
+        runtime.require_ready()
+        return runtime.scheduler.snapshot()
+    
+    async def run_task(t_name: str, data: Dict[str, Any], priority: Optional[str] = None,
+                       count: bool = True) -> Dict[str, Any]:
+        """
+        Esegue un task su un input: validazione, cache, coalescenza, inferenza ed estrazione degli
+        output. La priorità della richiesta (se indicata) prevale su quella del task. Con count=False
+        la richiesta non viene contata (il chiamante l'ha già fatto, es. tentativi ripetuti di /batch).
+        """
+        if count:
+            METRICS.requests.inc(task=t_name)
+        runtime.require_ready()
+        processor = runtime.task_processors.get(t_name)
+        if processor is None:
+            raise HTTPException(status_code=404, detail=f"Task '{t_name}' non trovato")
         
-        # Crea modello Pydantic dinamico per request
-        request_fields = {}
-        for field in config.input_fields:
-            # Rendi tutti i campi opzionali per flessibilità
-            request_fields[field] = (Optional[str], Field(None, description=f"Campo {field}"))
+        priority = priority or processor["config"].priority
+        start = time.perf_counter()
+        try:
+            return await process_request(t_name, processor, data, priority)
+        finally:
+            METRICS.request_duration.observe(time.perf_counter() - start, task=t_name, priority=priority)
+    
+    async def process_request(t_name: str, processor: dict, data: Dict[str, Any], priority: str) -> Dict[str, Any]:
+        """Validazione, cache delle risposte e coalescenza; l'inferenza è in generate_response"""
+        # Valida che ci siano i campi richiesti
+        missing_fields = []
+        for field in processor["config"].input_fields:
+            if field not in data or not data[field]:
+                missing_fields.append(field)
         
-        RequestModel = create_model(
-            f"{task_name.capitalize()}Request",
-            **request_fields
-        )
+        if missing_fields:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Campi mancanti o vuoti: {missing_fields}"
+            )
         
-        # Crea modello response con tutti gli output definiti
-        response_fields = {
-            "raw": (str, Field(..., description="Output grezzo del modello"))
-        }
+        # Parametri di generazione: default del task + eventuali override della richiesta
+        try:
+            params = processor["params"].with_overrides(data.get("generation"))
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        print(f"📨 Task '{t_name}' - Input: {data}")
         
-        # Aggiungi tutti gli output definiti nella configurazione
-        for output_name, output_config in config.outputs.items():
-            if output_config.type == "int":
-                field_type = int
-            elif output_config.type == "float":
-                field_type = float
-            elif output_config.type == "bool":
-                field_type = bool
+        # Cache delle risposte (solo task abilitati e decodifica riproducibile)
+        cache_key = None
+        if processor["config"].cache_enabled and params.deterministic:
+            cache_key = response_cache_key(processor["config"], data, params)
+            cached = await response_cache.get(t_name, cache_key)
+            if cached is not None:
+                print(f"💾 Task '{t_name}' - Cache hit")
+                return {**cached, "cache": "hit"}
+        
+        # Coalescenza: le richieste identiche a una già in corso ne attendono il risultato
+        if processor["config"].deterministic and params.deterministic:
+            key = cache_key or response_cache_key(processor["config"], data, params)
+            response, shared = await single_flight.run(
+                key, lambda: generate_response(t_name, processor, data, params, cache_key, priority)
+            )
+            if shared:
+                METRICS.coalesced.inc(task=t_name)
+                print(f"🔗 Task '{t_name}' - Risultato condiviso con una richiesta identica in corso")
+            return dict(response)
+        
+        return await generate_response(t_name, processor, data, params, cache_key, priority)
+    
+    async def generate_response(t_name: str, processor: dict, data: Dict[str, Any], params: GenerationParams,
+                                cache_key: Optional[str], priority: str) -> Dict[str, Any]:
+        """Inferenza ed estrazione degli output di una richiesta già validata"""
+        engine, scheduler, tokenizer = runtime.engine, runtime.scheduler, runtime.tokenizer
+        
+        # Budget adattivo: se la richiesta non fissa max_new_tokens si usa quello appreso per il task
+        overrides = data.get("generation") or {}
+        if processor["config"].adaptive_budget and overrides.get("max_new_tokens") is None:
+            params = replace(params, max_new_tokens=scheduler.lengths.budget(t_name, params.max_new_tokens))
+        
+        classification = processor["config"].classification
+        probability = None
+        
+        # Esempi few-shot: con la selezione per similarità il prompt dipende dall'input
+        config = processor["config"]
+        selection = config.selector.select(data) if config.selector is not None else None
+        dynamic = selection is not None and config.selector.dynamic
+        if dynamic:
+            print(f"📚 Task '{t_name}' - esempi {list(selection)} ({config.selector.tokens(selection)} token)")
+        
+        if processor["type"] == "role_based":
+            # Modalità role-based
+            compiled, prefix = config.prompt, processor["prefix"]
+            if dynamic:
+                compiled = config.selector.cached(
+                    ("prompt", selection), lambda: compile_task_prompt(config, tokenizer, selection)
+                )
+                prefix = dynamic_prefix(config, selection, prefix)
+            
+            if compiled is not None:
+                formatted = compiled.render(data)
+            else:
+                messages = create_messages_for_task(config, data, selection)
+                formatted = format_messages(messages, tokenizer)
+            
+            if classification is not None:
+                # Un solo forward pass sulle etichette, nessuna decodifica libera
+                label, probability, raw_output = await scheduler.call(
+                    t_name, lambda: engine.classify(formatted, classification, prefix), priority
+                )
+            else:
+                generated = await scheduler.generate(
+                    t_name, formatted, params, prefix=prefix, priority=priority
+                )
+                raw_output = generated.strip()
+        else:
+            # Modalità legacy: prompt testuale, stesso motore e stesso scheduler
+            prompt, prefix = processor["prompt"], processor["prefix"]
+            if dynamic:
+                prompt = config.selector.cached(("legacy", selection), lambda: build_legacy_prompt(config, selection))
+                prefix = dynamic_prefix(config, selection, prefix)
+            formatted = prompt.format(**{field: data.get(field, "") for field in config.input_fields})
+            
+            if classification is not None:
+                # Il template legacy termina già con l'etichetta dell'output
+                legacy_classification = replace(classification, prefix="")
+                label, probability, raw_output = await scheduler.call(
+                    t_name, lambda: engine.classify(formatted, legacy_classification, prefix), priority
+                )
             else:
-                field_type = str
+                generated = await scheduler.generate(
+                    t_name, formatted, params, prefix=prefix, priority=priority
+                )
+                raw_output = generated.strip()
+        
+        if RECORD_RAW_OUTPUTS:
+            record_raw_output(t_name, raw_output, selection)
+        
+        if classification is None and not any(name in overrides for name in LENGTH_CAP_OVERRIDES):
+            useful_tokens = len(tokenizer(raw_output, add_special_tokens=False)["input_ids"])
+            scheduler.lengths.record_useful(t_name, useful_tokens, len(raw_output))
+        
+        # Estrai tutti i risultati (ogni task caricato ha il suo estrattore precompilato)
+        extracted_results = processor["config"].extractor.extract(raw_output)
+        
+        print(f"✅ Task '{t_name}' - Outputs: {extracted_results}")
+        for output_name in processor["config"].outputs:
+            if extracted_results.get(output_name) is None:
+                METRICS.extraction_failures.inc(task=t_name, output=output_name)
+        
+        # Costruisci risposta
+        response = {"raw": raw_output}
+        response.update(extracted_results)
+        if probability is not None:
+            response["probability"] = round(probability, 4)
+        
+        if cache_key is not None:
+            await response_cache.put(cache_key, response, processor["config"].cache_ttl)
+            response = {**response, "cache": "miss"}
+        
+        return response
+    
+    def request_priority(request: Request) -> Optional[str]:
+        """Classe di priorità dall'header X-Priority (None = default del task)"""
+        value = request.headers.get("x-priority")
+        if value is None:
+            return None
+        value = value.strip().lower()
+        if value not in PRIORITY_CLASSES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"X-Priority non valida: '{value}' (valori: {list(PRIORITY_CLASSES)})"
+            )
+        return value
+    
+    def task_http_error(t_name: str, error: Exception) -> HTTPException:
+        """Converte un errore di esecuzione del task nella risposta HTTP corrispondente"""
+        if isinstance(error, HTTPException):
+            http_error = error
+        elif isinstance(error, QueueFullError):
+            print(f"⏳ Task '{t_name}' rifiutato: {error}")
+            http_error = HTTPException(
+                status_code=503,
+                detail=str(error),
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+            )
+        else:
+            print(f"❌ Errore in task '{t_name}': {error}")
+            traceback.print_exc()
+            http_error = HTTPException(status_code=500, detail=str(error))
+        METRICS.errors.inc(task=t_name, status=http_error.status_code)
+        return http_error
+    
+    def build_task_routes(configs: Dict[str, TaskConfig]) -> List[APIRoute]:
+        """Crea gli endpoint di tutti i task"""
+        routes = []
+        for task_name, config in configs.items():
+            
+            # Crea modello Pydantic dinamico per request
+            request_fields = {}
+            for field in config.input_fields:
+                # Rendi tutti i campi opzionali per flessibilità
+                request_fields[field] = (Optional[str], Field(None, description=f"Campo {field}"))
+            
+            RequestModel = create_model(
+                f"{task_name.capitalize()}Request",
+                **request_fields
+            )
+            
+            # Crea modello response con tutti gli output definiti
+            response_fields = {
+                "raw": (str, Field(..., description="Output grezzo del modello")),
+                "cache": (Optional[str], Field(None, description="Esito della cache: 'hit' o 'miss' (solo task con cache)"))
+            }
+            if config.classification is not None:
+                response_fields["probability"] = (Optional[float], Field(None, description="Probabilità dell'etichetta scelta"))
+            
+            # Aggiungi tutti gli output definiti nella configurazione
+            for output_name, output_config in config.outputs.items():
+                if output_config.type == "int":
+                    field_type = int
+                elif output_config.type == "float":
+                    field_type = float
+                elif output_config.type == "bool":
+                    field_type = bool
+                else:
+                    field_type = str
+                
+                response_fields[output_name] = (Optional[field_type], Field(None, description=f"Output: {output_name}"))
+            
+            ResponseModel = create_model(
+                f"{task_name.capitalize()}Response",
+                **response_fields
+            )
+            
+            # Usa una lambda per catturare correttamente le variabili
+            def create_endpoint_handler(t_name: str):
+                async def endpoint_handler(request: Request):
+                    try:
+                        # Ottieni dati JSON direttamente
+                        data = await request.json()
+                        return await run_task(t_name, data, request_priority(request))
+                        
+                    except Exception as e:
+                        raise task_http_error(t_name, e)
+                
+                # Imposta il nome della funzione per FastAPI
+                endpoint_handler.__name__ = f"handle_{t_name}"
+                return endpoint_handler
+            
+            # Crea e registra l'handler
+            handler = create_endpoint_handler(task_name)
+            
+            # Crea la route dell'endpoint
+            routes.append(APIRoute(
+                f"/{task_name}",
+                handler,
+                methods=["POST"],
+                response_model=ResponseModel,
+                summary=f"Esegui task {task_name}",
+                tags=[task_name]
+            ))
+            
+            print(f"📌 Endpoint '/{task_name}' registrato")
+        return routes
+    
+    # Crea endpoint dinamicamente per ogni task
+    task_routes = build_task_routes(runtime.task_configs)
+    app.router.routes.extend(task_routes)
+    
+    reload_lock = asyncio.Lock()
+    
+    async def reload_tasks() -> Dict[str, Any]:
+        """
+        Rilegge le directory dei task e sostituisce in blocco configurazioni ed
+        endpoint, mantenendo il modello caricato. Se il caricamento fallisce i task
+        attuali restano attivi.
+        """
+        nonlocal task_routes
+        runtime.require_ready()
+        async with reload_lock:
+            start = time.perf_counter()
+            configs, processors = await asyncio.to_thread(runtime.prepare_tasks)
+            routes = build_task_routes(configs)
+            
+            # Sostituzione sull'event loop, senza await: nessuna richiesta vede uno stato intermedio
+            previous = runtime.task_configs
+            app.router.routes = [r for r in app.router.routes if r not in task_routes] + routes
+            task_routes = routes
+            runtime.swap_tasks(configs, processors)
+            app.openapi_schema = None
+            
+            elapsed = time.perf_counter() - start
+            print(f"🔄 Task ricaricati in {elapsed:.2f}s: {list(configs)}")
+            return {
+                "tasks": list(configs),
+                "added": sorted(set(configs) - set(previous)),
+                "removed": sorted(set(previous) - set(configs)),
+                "reload_ms": round(elapsed * 1000, 1),
+            }
+    
+    async def watch_tasks():
+        """Ricarica i task quando cambia un file sotto TASKS_DIR"""
+        signature = await asyncio.to_thread(tasks_signature)
+        while True:
+            await asyncio.sleep(TASKS_WATCH_INTERVAL)
+            current = await asyncio.to_thread(tasks_signature)
+            if current == signature or not runtime.ready:
+                continue
+            print("👀 Modifiche rilevate nei task, ricaricamento...")
+            signature = current
+            try:
+                await reload_tasks()
+            except Exception as e:
+                print(f"❌ Ricaricamento task fallito: {e}")
+    
+    # Ricaricamento dei task senza riavviare il container
+    @app.post("/admin/reload", summary="Ricarica le configurazioni dei task", tags=["admin"])
+    async def admin_reload():
+        try:
+            return await reload_tasks()
+        except HTTPException:
+            raise
+        except Exception as e:
+            print(f"❌ Ricaricamento task fallito: {e}")
+            raise HTTPException(status_code=400, detail=f"Ricaricamento fallito, task invariati: {e}")
+    
+    print("📌 Endpoint '/admin/reload' registrato")
+    
+    # Catena di task eseguita in un'unica richiesta (es. cyan -> magenta)
+    @app.post("/pipeline", summary="Esegui una sequenza di task", tags=["pipeline"])
+    async def run_pipeline(pipeline: PipelineRequest, request: Request):
+        runtime.require_ready()
+        priority = request_priority(request)
+        if not pipeline.steps:
+            raise HTTPException(status_code=400, detail="La pipeline non contiene passi")
+        unknown = [step.task for step in pipeline.steps if step.task not in runtime.task_configs]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Task sconosciuti: {unknown}")
+        # Mappe verificate prima di eseguire: ogni sorgente deve essere un output del passo precedente
+        for index, step in enumerate(pipeline.steps):
+            available = {"raw", *runtime.task_configs[pipeline.steps[index - 1].task].outputs} if index else set()
+            invalid = [source for source in step.map if source not in available]
+            if invalid:
+                raise HTTPException(
+                    status_code=422,
+                    detail=f"Passo {index} ('{step.task}'): map non valida, output {invalid} non previsti "
+                           f"dal passo precedente (disponibili: {sorted(available)})"
+                )
+        
+        steps = []
+        previous: Dict[str, Any] = {}
+        for index, step in enumerate(pipeline.steps):
+            # Input del passo: input iniziali + input del passo + output mappati dal passo precedente
+            data = {**pipeline.inputs, **step.inputs}
+            for source, target in step.map.items():
+                if previous.get(source) is None:
+                    # Output previsto ma non estratto dal testo generato dal passo precedente
+                    raise HTTPException(
+                        status_code=502,
+                        detail=f"Passo {index} ('{step.task}'): il passo {index - 1} "
+                               f"('{pipeline.steps[index - 1].task}') non ha prodotto l'output '{source}'"
+                    )
+                data[target] = previous[source]
+            data.pop("generation", None)
+            if step.generation:
+                data["generation"] = step.generation
             
-            response_fields[output_name] = (Optional[field_type], Field(None, description=f"Output: {output_name}"))
+            try:
+                previous = await run_task(step.task, data, priority)
+            except Exception as e:
+                error = task_http_error(step.task, e)
+                error.detail = f"Passo {index} ('{step.task}'): {error.detail}"
+                raise error
+            steps.append({"task": step.task, **previous})
+        
+        return {"steps": steps, "output": previous}
+    
+    print("📌 Endpoint '/pipeline' registrato")
+    
+    # Versione bulk di ogni task: lista di input, risultati in ordine con errori per elemento
+    @app.post("/batch/{task_name}", summary="Esegui un task su una lista di input", tags=["batch"])
+    async def run_batch(task_name: str, request: Request, stream: bool = False):
+        if task_name not in runtime.task_configs:
+            raise HTTPException(status_code=404, detail=f"Task '{task_name}' non trovato")
+        runtime.require_ready()
+        priority = request_priority(request)
         
-        ResponseModel = create_model(
-            f"{task_name.capitalize()}Response",
-            **response_fields
+        items = await request.json()
+        if isinstance(items, dict):
+            items = items.get("items")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Il corpo deve essere una lista di input")
+        
+        # Dimensione dei blocchi in base alla memoria: prompt + token generati per elemento
+        config = runtime.task_configs[task_name]
+        prompt_tokens = len(config.prompt.prefix_ids) if config.prompt else 0
+        chunk_size = min(
+            runtime.engine.memory_chunk_size(prompt_tokens + 256 + config.max_new_tokens),
+            max(1, runtime.scheduler.max_queue_size // 2)
         )
+        print(f"📦 Batch '{task_name}': {len(items)} elementi, blocchi da {chunk_size}")
         
-        # Usa una lambda per catturare correttamente le variabili
-        def create_endpoint_handler(t_name: str, t_processor: dict):
-            async def endpoint_handler(request: Request):
+        async def run_item(index: int, item: Any) -> Dict[str, Any]:
+            if not isinstance(item, dict):
+                return {"index": index, "error": {"status": 400, "detail": "L'elemento deve essere un oggetto JSON"}}
+            # Un elemento è una richiesta, anche se la coda piena la fa ritentare più volte
+            METRICS.requests.inc(task=task_name)
+            while True:
                 try:
-                    # Ottieni dati JSON direttamente
-                    data = await request.json()
-                    
-                    # Valida che ci siano i campi richiesti
-                    missing_fields = []
-                    for field in t_processor["config"].input_fields:
-                        if field not in data or not data[field]:
-                            missing_fields.append(field)
-                    
-                    if missing_fields:
-                        raise HTTPException(
-                            status_code=400,
-                            detail=f"Campi mancanti o vuoti: {missing_fields}"
-                        )
-                    
-                    print(f"📨 Task '{t_name}' - Input: {data}")
-                    
-                    if t_processor["type"] == "role_based":
-                        # Modalità role-based
-                        messages = create_messages_for_task(t_processor["config"], data)
-                        formatted = format_messages(messages, tokenizer)
-                        
-                        outputs = t_processor["pipeline"](formatted)
-                        raw_output = outputs[0]['generated_text'].strip()
-                    else:
-                        # Modalità legacy
-                        chain_inputs = {
-                            field: data.get(field, "") 
-                            for field in t_processor["config"].input_fields
-                        }
-                        
-                        result = t_processor["chain"].invoke(chain_inputs)
-                        if isinstance(result, dict):
-                            raw_output = result.get("text", str(result))
-                        else:
-                            raw_output = str(result)
-                    
-                    # Estrai tutti i risultati
-                    extracted_results = extract_results(raw_output, t_processor["config"])
-                    
-                    print(f"✅ Task '{t_name}' - Outputs: {extracted_results}")
-                    
-                    # Costruisci risposta
-                    response = {"raw": raw_output}
-                    response.update(extracted_results)
-                    
-                    return response
-                    
-                except HTTPException:
-                    raise
+                    return {"index": index, "result": await run_task(task_name, item, priority, count=False)}
+                except QueueFullError:
+                    # I lavori bulk attendono invece di fallire quando la coda è piena, finché c'è il client
+                    if await request.is_disconnected():
+                        return {"index": index, "error": {"status": 499, "detail": "Client disconnesso"}}
+                    await asyncio.sleep(0.5)
                 except Exception as e:
-                    print(f"❌ Errore in task '{t_name}': {e}")
-                    traceback.print_exc()
-                    raise HTTPException(status_code=500, detail=str(e))
-            
-            # Imposta il nome della funzione per FastAPI
-            endpoint_handler.__name__ = f"handle_{t_name}"
-            return endpoint_handler
+                    error = task_http_error(task_name, e)
+                    return {"index": index, "error": {"status": error.status_code, "detail": error.detail}}
+        
+        async def run_chunks():
+            # Se il client si disconnette non si accodano altri blocchi; con lo streaming l'annullamento
+            # del blocco in corso toglie dalla coda gli elementi non ancora eseguiti
+            for start in range(0, len(items), chunk_size):
+                if await request.is_disconnected():
+                    print(f"🔌 Batch '{task_name}': client disconnesso, {len(items) - start} elementi non eseguiti")
+                    return
+                chunk = items[start:start + chunk_size]
+                for result in await asyncio.gather(*(run_item(start + i, item) for i, item in enumerate(chunk))):
+                    yield result
+        
+        if stream:
+            async def ndjson():
+                async for result in run_chunks():
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+        
+        return {"results": [result async for result in run_chunks()]}
+    
+    print("📌 Endpoint '/batch/{task}' registrato")
+    
+    return app
+
+# ---------------------------------------------------------------------------
+# WORKER POOL (MULTI-PROCESSO)
+# ---------------------------------------------------------------------------
+
+# Intervallo (secondi) di controllo di stato e readiness dei worker
+WORKER_POLL_INTERVAL = 1.0
+
+# Header da non inoltrare tra client, dispatcher e worker
+HOP_BY_HOP_HEADERS = {"host", "connection", "keep-alive", "transfer-encoding", "content-length"}
+
+def split_cores(cores: List[int], workers: int) -> List[List[int]]:
+    """Divide i core in insiemi disgiunti e contigui, di dimensione il più possibile uguale"""
+    return [cores[i * len(cores) // workers:(i + 1) * len(cores) // workers] for i in range(workers)]
+
+class InferenceWorker:
+    """Processo server.py (modello, scheduler e coda propri) legato a un insieme di core"""
+    
+    def __init__(self, index: int, cores: List[int], port: int):
+        self.index = index
+        self.cores = cores
+        self.port = port
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.ready = False
+        self.inflight = 0
+        self.restarts = 0
+    
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+    
+    def start(self):
+        env = dict(
+            os.environ,
+            WORKERS="1",
+            HOST="127.0.0.1",
+            PORT=str(self.port),
+            CPU_CORES=",".join(str(core) for core in self.cores),
+            WORKER_INDEX=str(self.index),
+        )
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.ready = False
+        print(f"👷 Worker {self.index} avviato (pid {self.process.pid}, porta {self.port}, core {env['CPU_CORES']})")
+    
+    def stop(self):
+        if not self.alive:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class WorkerPool:
+    """Worker di inferenza su core disgiunti; le richieste vanno al worker pronto meno carico"""
+    
+    def __init__(self, workers: int, cores: List[int], base_port: int):
+        self.workers = [
+            InferenceWorker(i, worker_cores, base_port + i)
+            for i, worker_cores in enumerate(split_cores(cores, workers))
+        ]
+        self._turn = 0
+    
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+    
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+    
+    @property
+    def ready(self) -> List[InferenceWorker]:
+        return [worker for worker in self.workers if worker.ready]
+    
+    def pick(self) -> Optional[InferenceWorker]:
+        """Worker pronto con meno richieste in corso (a parità di carico, a rotazione)"""
+        ready = self.ready
+        if not ready:
+            return None
+        self._turn = (self._turn + 1) % len(self.workers)
+        return min(ready, key=lambda w: (w.inflight, (w.index - self._turn) % len(self.workers)))
+    
+    async def monitor(self, client: httpx.AsyncClient):
+        """Aggiorna la readiness dei worker e riavvia quelli terminati"""
+        while True:
+            for worker in self.workers:
+                if not worker.alive:
+                    print(f"💥 Worker {worker.index} terminato (exit {worker.process.returncode}), riavvio")
+                    worker.restarts += 1
+                    worker.start()
+                    continue
+                try:
+                    ready = (await client.get(f"{worker.url}/ready", timeout=5)).status_code == 200
+                except httpx.HTTPError:
+                    ready = False
+                if ready and not worker.ready:
+                    print(f"🟢 Worker {worker.index} pronto")
+                worker.ready = ready
+            await asyncio.sleep(WORKER_POLL_INTERVAL)
+    
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "worker": worker.index,
+                "port": worker.port,
+                "cores": worker.cores,
+                "pid": worker.process.pid if worker.process is not None else None,
+                "alive": worker.alive,
+                "ready": worker.ready,
+                "inflight": worker.inflight,
+                "restarts": worker.restarts,
+            }
+            for worker in self.workers
+        ]
+
+def create_dispatcher_app():
+    """Crea l'app FastAPI di front-end che avvia i worker e inoltra loro le richieste"""
+    
+    cores = available_cores()
+    print(f"🚀 Avvio di {WORKERS} worker di inferenza su {len(cores)} core")
+    if WORKERS > len(cores):
+        print(f"❌ WORKERS ({WORKERS}) maggiore dei core disponibili ({len(cores)})")
+        sys.exit(1)
+    if torch.cuda.is_available():
+        print("⚠️  GPU disponibile: ogni worker carica una propria copia del modello sulla GPU")
+    
+    pool = WorkerPool(WORKERS, cores, WORKER_BASE_PORT)
+    # Nessun timeout: una generazione lunga può durare minuti
+    client = httpx.AsyncClient(timeout=None)
+    
+    dispatched = Counter("llm_worker_requests_total", "Richieste inoltrate per worker")
+    inflight = Gauge("llm_worker_inflight", "Richieste in corso per worker")
+    ready = Gauge("llm_worker_ready", "Worker pronti (1) o non pronti (0)")
+    restarts = Gauge("llm_worker_restarts", "Riavvii dei worker terminati")
+    
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        pool.start()
+        monitor = asyncio.create_task(pool.monitor(client))
+        yield
+        monitor.cancel()
+        await client.aclose()
+        pool.stop()
+    
+    # Documentazione e schema OpenAPI sono quelli dei worker (inoltrati)
+    app = FastAPI(
+        title="Unified LLM Server - dispatcher",
+        lifespan=lifespan,
+        docs_url=None,
+        redoc_url=None,
+        openapi_url=None
+    )
+    
+    def no_worker_ready() -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail="Nessun worker pronto",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+    
+    async def broadcast(method: str, path: str) -> Dict[int, Tuple[int, Any]]:
+        """Stessa richiesta a tutti i worker pronti: {worker: (status, JSON)}"""
+        async def send(worker: InferenceWorker):
+            try:
+                response = await client.request(method, f"{worker.url}{path}")
+                return worker.index, (response.status_code, response.json())
+            except (httpx.HTTPError, ValueError) as e:
+                return worker.index, (502, {"detail": str(e)})
+        return dict(await asyncio.gather(*(send(worker) for worker in pool.ready)))
+    
+    # Liveness del dispatcher (i worker terminati vengono riavviati)
+    @app.get("/live")
+    async def live():
+        return {"status": "alive", "workers": sum(worker.alive for worker in pool.workers)}
+    
+    # Pronto se almeno un worker lo è
+    @app.get("/ready")
+    async def ready_status():
+        return JSONResponse(
+            status_code=200 if pool.ready else 503,
+            content={"ready": len(pool.ready), "workers": pool.snapshot()}
+        )
+    
+    @app.get("/workers")
+    async def workers():
+        return pool.snapshot()
+    
+    # Metriche del dispatcher; quelle di inferenza sono su /metrics di ogni worker
+    @app.get("/metrics")
+    async def metrics():
+        for worker in pool.workers:
+            inflight.set(worker.inflight, worker=worker.index)
+            ready.set(int(worker.ready), worker=worker.index)
+            restarts.set(worker.restarts, worker=worker.index)
+        lines = []
+        for metric in (dispatched, inflight, ready, restarts):
+            lines.extend(metric.render())
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+    
+    # Stato delle code di tutti i worker
+    @app.get("/queue")
+    async def queue_status():
+        if not pool.ready:
+            raise no_worker_ready()
+        return {str(index): body for index, (_, body) in sorted((await broadcast("GET", "/queue")).items())}
+    
+    # Il ricaricamento dei task va fatto su tutti i worker
+    @app.post("/admin/reload")
+    async def reload():
+        if not pool.ready:
+            raise no_worker_ready()
+        results = await broadcast("POST", "/admin/reload")
+        status = max(status for status, _ in results.values())
+        return JSONResponse(
+            status_code=status,
+            content={str(index): body for index, (_, body) in sorted(results.items())}
+        )
+    
+    # Tutto il resto (task, /pipeline, /batch, /docs...) va al worker pronto meno carico
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+    async def forward(path: str, request: Request):
+        worker = pool.pick()
+        if worker is None:
+            raise no_worker_ready()
         
-        # Crea e registra l'handler
-        handler = create_endpoint_handler(task_name, processor)
+        worker.inflight += 1
+        dispatched.inc(worker=worker.index)
+        try:
+            upstream = await client.send(client.build_request(
+                request.method,
+                f"{worker.url}/{path}",
+                params=request.query_params,
+                headers=[(k, v) for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS],
+                content=await request.body()
+            ), stream=True)
+        except httpx.HTTPError as e:
+            worker.inflight -= 1
+            raise HTTPException(status_code=502, detail=f"Worker {worker.index} non raggiungibile: {e}")
         
-        # Registra l'endpoint
-        app.post(
-            f"/{task_name}",
-            response_model=ResponseModel,
-            summary=f"Esegui task {task_name}",
-            tags=[task_name]
-        )(handler)
+        async def body():
+            # La richiesta resta in carico al worker finché la risposta non è stata inoltrata
+            try:
+                async for chunk in upstream.aiter_raw():
+                    yield chunk
+            finally:
+                await upstream.aclose()
+                worker.inflight -= 1
         
-        print(f"📌 Endpoint '/{task_name}' registrato")
+        headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        headers["X-Worker"] = str(worker.index)
+        return StreamingResponse(body(), status_code=upstream.status_code, headers=headers)
     
     return app
 
@@ -787,7 +3819,8 @@ def create_app():
 # ---------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    app = create_app()
-    print(f"\n🚀 Server avviato su http://0.0.0.0:{PORT}")
-    print(f"📋 Documentazione API: http://0.0.0.0:{PORT}/docs")
-    uvicorn.run(app, host="0.0.0.0", port=PORT, log_level="info")
\ No newline at end of file
+    app = create_dispatcher_app() if WORKERS > 1 else create_app()
+    print(f"\n🚀 Server avviato su http://{HOST}:{PORT}")
+    print(f"📋 Documentazione API: http://{HOST}:{PORT}/docs")
+    # Nei worker il log degli accessi riporterebbe anche i controlli di readiness del dispatcher
+    uvicorn.run(app, host=HOST, port=PORT, log_level="info", access_log=not WORKER_INDEX)
\ No newline at end of file
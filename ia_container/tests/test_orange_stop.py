@@ -0,0 +1,77 @@
+"""
+Criteri di arresto del task orange: la generazione si ferma alla fine della riga
+dei tag (max_lines: 1), prima di max_new_tokens, e il valore estratto è lo stesso
+della sola risposta completa. Con stop_on_match (task green_*) il taglio cade subito
+dopo l'ultima corrispondenza.
+"""
+import pathlib
+import sys
+
+import pytest
+import torch
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+# Risposta attesa seguita da testo che il modello continuerebbe a generare
+GENERATIONS = [
+    ("Tags: ['arte', 'storia', 'cultura']", "\nQuestion: Chi era Dante?\nTags: ['letteratura', 'poesia', 'biografia']"),
+    ("arte, storia, cultura", "\n\nDomanda successiva, altro testo, ancora altro"),
+    ("\nTags: musica, teatro, tradizione", "\nQuestion: Cos'è l'Opera?"),
+    ("scienza,  biografia , astronomia.", "\n, , ,"),
+]
+
+
+@pytest.fixture(scope="module")
+def orange():
+    server.TASKS_DIR = ROOT / "tasks"
+    config = server.load_task_configs()["orange"]
+    return config, config.generation_params(), server.TaskExtractor(config)
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    server.TASKS_DIR = ROOT / "tasks"
+    return server.build_offline_tokenizer()
+
+
+def generate_until_stop(tokenizer, params, text):
+    """Simula la generazione token per token di text: token generati quando scatta lo stop"""
+    ids = tokenizer(text, add_special_tokens=False)["input_ids"]
+    criteria = server.OutputStoppingCriteria(tokenizer, params, prompt_len=0)
+    for count in range(1, len(ids) + 1):
+        if criteria(torch.tensor([ids[:count]]), None)[0]:
+            return ids[:count], len(ids)
+    return ids, len(ids)
+
+
+@pytest.mark.parametrize("answer, continuation", GENERATIONS)
+def test_generation_stops_at_end_of_tag_line(orange, tokenizer, answer, continuation):
+    config, params, extractor = orange
+    generated, total = generate_until_stop(tokenizer, params, answer + continuation)
+    assert len(generated) < total
+
+    output = server.trim_output(tokenizer.decode(generated), params).strip()
+    assert output == answer.strip()
+    assert extractor.extract(output) == extractor.extract(answer)
+
+
+def test_orange_has_a_real_stop(orange):
+    _, params, _ = orange
+    assert params.max_lines == 1
+    assert params.max_new_tokens == 50
+
+
+@pytest.mark.parametrize("text, answer", [
+    ("Punteggio: 4\nFeedback: chiaro\nPunteggio: 2", "Punteggio: 4\nFeedback: chiaro\n"),
+    ("Feedback: chiaro\n\n\nPunteggio: 3 e altro testo", "Feedback: chiaro\n\n\nPunteggio: 3"),
+])
+def test_stop_on_match_cuts_right_after_whitespace(text, answer):
+    """Con stop_on_match una corrispondenza che termina con spazi si taglia subito dopo, senza altri caratteri"""
+    server.TASKS_DIR = ROOT / "tasks"
+    params = server.load_task_configs()["green_cultural"].generation_params()
+    assert params.stop_patterns
+    assert server.output_stop_index(text, params) == len(answer)
+    assert server.trim_output(text, params) == answer
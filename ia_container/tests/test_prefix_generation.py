@@ -0,0 +1,73 @@
+"""
+KV-cache dei prefissi: la generazione che riparte dal prefisso in cache deve dare lo
+stesso output della generazione sul prompt intero, e con un tokenizer che unisce
+prefisso e input in modo diverso (SentencePiece, "▁" iniziale) il prefisso del task
+viene disattivato.
+"""
+import pathlib
+import sys
+
+import pytest
+import transformers
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+PARAMS = server.GenerationParams(max_new_tokens=8, do_sample=False)
+
+
+@pytest.fixture(scope="module")
+def engine():
+    server.TASKS_DIR = ROOT / "tasks"
+    model, tokenizer, device = server.load_model_and_tokenizer("random:1x64")
+    return server.GenerationEngine(model, tokenizer, device)
+
+
+@pytest.fixture(scope="module")
+def configs(engine):
+    return server.load_task_configs(engine.tokenizer)
+
+
+@pytest.fixture(scope="module")
+def sentencepiece_tokenizer():
+    """Tokenizer BPE con pre-tokenizzazione Metaspace, come i modelli SentencePiece (Llama, Minerva)"""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+
+    texts = [path.read_text(encoding="utf-8") for path in sorted((ROOT / "tasks").rglob("*")) if path.is_file()]
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.Metaspace(replacement="▁", prepend_scheme="always")
+    bpe.decoder = decoders.Metaspace(replacement="▁", prepend_scheme="always")
+    bpe.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=2000, special_tokens=["<unk>", "<s>", "</s>", "<pad>"], show_progress=False
+    ))
+    return transformers.PreTrainedTokenizerFast(
+        tokenizer_object=bpe, unk_token="<unk>", bos_token="<s>", eos_token="</s>", pad_token="<pad>"
+    )
+
+
+@pytest.mark.parametrize("role_based", [True, False])
+def test_prefix_generation_matches_full_prompt(engine, configs, role_based):
+    processors = server.build_task_processors(configs, engine.tokenizer, role_based)
+    for name, processor in processors.items():
+        config = processor["config"]
+        sample = server.sample_task_input(config)
+        if role_based:
+            prompt = config.prompt.render(sample)
+        else:
+            prompt = processor["prompt"].format(**sample)
+        assert processor["prefix"], f"prefisso disattivato per '{name}'"
+
+        from_prefix = engine.generate_batch([prompt], PARAMS, prefix=processor["prefix"])
+        full = engine.generate_batch([prompt], PARAMS)
+        assert from_prefix == full, name
+
+
+def test_sentencepiece_boundary_disables_prefix(configs, sentencepiece_tokenizer):
+    processors = server.build_task_processors(configs, sentencepiece_tokenizer, use_role_based=False)
+    for name, processor in processors.items():
+        prompt = processor["prompt"]
+        formatted = prompt.format(**server.sample_task_input(processor["config"]))
+        assert not server.prefix_boundary_ok(sentencepiece_tokenizer, prompt.prefix, formatted), name
+        assert processor["prefix"] is None, name
@@ -0,0 +1,78 @@
+"""
+Scheduler e richieste annullate: un chiamante che rinuncia (es. client disconnesso),
+mentre la sua richiesta è in coda o già in esecuzione, non deve fermare il worker
+di inferenza; le richieste successive vengono servite normalmente.
+"""
+import asyncio
+import pathlib
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+PARAMS = server.GenerationParams(max_new_tokens=4, do_sample=False)
+
+
+class SlowEngine:
+    """Motore finto: ogni batch restituisce i prompt dopo un'attesa, segnalando l'inizio"""
+    draft_model = None
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.started = threading.Event()
+        self.batches = []
+
+    def generate_batch(self, prompts, params, prefix=None, timing=None):
+        self.started.set()
+        self.batches.append(list(prompts))
+        time.sleep(self.seconds)
+        if timing is not None:
+            timing.prompt_tokens = [1] * len(prompts)
+            timing.new_tokens = [1] * len(prompts)
+        return list(prompts)
+
+
+@pytest.fixture
+def scheduler():
+    def build(seconds=0.2, window_ms=1.0):
+        engine = SlowEngine(seconds)
+        scheduler = server.BatchScheduler(engine, window_ms=window_ms, max_batch_size=4)
+        scheduler.start()
+        return scheduler, engine
+    return build
+
+
+def test_cancel_while_running(scheduler):
+    scheduler, engine = scheduler()
+
+    async def run():
+        first = asyncio.ensure_future(scheduler.generate("cyan", "primo", PARAMS))
+        await asyncio.to_thread(engine.started.wait, 5)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await asyncio.wait_for(scheduler.generate("red", "secondo", PARAMS), 5)
+
+    assert asyncio.run(run()) == "secondo"
+    assert scheduler._thread.is_alive()
+
+
+def test_cancel_while_queued_is_dropped(scheduler):
+    scheduler, engine = scheduler(window_ms=300)
+
+    async def run():
+        queued = asyncio.ensure_future(scheduler.generate("cyan", "annullato", PARAMS))
+        await asyncio.sleep(0.05)
+        queued.cancel()
+        await asyncio.sleep(0)
+        return await asyncio.wait_for(scheduler.generate("red", "secondo", PARAMS), 5)
+
+    assert asyncio.run(run()) == "secondo"
+    assert all("annullato" not in batch for batch in engine.batches)
+    assert scheduler._thread.is_alive()
@@ -0,0 +1,70 @@
+"""
+Punteggi delle etichette in modalità classificazione: contesto ed etichetta sono
+tokenizzati insieme, quindi con il prompt legacy (che termina con "Bool: ") lo
+spazio finale si unisce all'etichetta come nel testo generato, con o senza la
+KV-cache del prefisso.
+"""
+import pathlib
+import sys
+
+import pytest
+import torch
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import server  # noqa: E402
+
+LABELS = ["Vero", "Falso"]
+
+
+@pytest.fixture(scope="module")
+def engine():
+    server.TASKS_DIR = ROOT / "tasks"
+    model, tokenizer, device = server.load_model_and_tokenizer("random:1x64")
+    return server.GenerationEngine(model, tokenizer, device)
+
+
+@pytest.fixture(scope="module")
+def legacy_prompt():
+    server.TASKS_DIR = ROOT / "tasks"
+    config = server.load_task_configs()["green_coherence_QT"]
+    prompt = server.build_legacy_prompt(config)
+    return prompt, prompt.format(question="Come si prepara la carbonara?", theme="Cucina romana")
+
+
+def joint_scores(engine, prompt):
+    """Riferimento: log-probabilità delle etichette sulla tokenizzazione congiunta di prompt ed etichetta"""
+    rows = [engine.tokenizer(prompt + label)["input_ids"] for label in LABELS]
+    context_ids = engine.tokenizer(prompt)["input_ids"]
+    start = min(
+        next((j for j, (a, b) in enumerate(zip(row, context_ids)) if a != b), len(context_ids)) for row in rows
+    )
+    scores = []
+    for row in rows:
+        with torch.inference_mode():
+            logits = engine.model(input_ids=torch.tensor([row])).logits.float()
+        log_probs = torch.log_softmax(logits[0, :-1], dim=-1)
+        scores.append(sum(log_probs[j - 1, row[j]].item() for j in range(start, len(row))))
+    return scores
+
+
+def test_trailing_space_joins_label(engine, legacy_prompt):
+    _, text = legacy_prompt
+    assert text.endswith("Bool: ")
+    tokenizer = engine.tokenizer
+    separate = tokenizer(text)["input_ids"] + tokenizer("Vero", add_special_tokens=False)["input_ids"]
+    assert separate != tokenizer(text + "Vero")["input_ids"]
+
+
+def test_scores_follow_joint_tokenization(engine, legacy_prompt):
+    _, text = legacy_prompt
+    scores = engine.score_continuations(text, LABELS)
+    assert scores == pytest.approx(joint_scores(engine, text), abs=1e-4)
+
+
+def test_prefix_cache_same_scores(engine, legacy_prompt):
+    prompt, text = legacy_prompt
+    assert prompt.prefix and text.startswith(prompt.prefix)
+    with_prefix = engine.score_continuations(text, LABELS, prefix=prompt.prefix)
+    assert with_prefix == pytest.approx(engine.score_continuations(text, LABELS), abs=1e-4)